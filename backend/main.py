@@ -1,11 +1,47 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import logging
 import os
 
+from utils.log import configure_logging
+
+configure_logging()
+
 from routes import csv_routes, chat_routes
+from services import csv_service, readiness
+from utils.metrics import CONTENT_TYPE, DATASETS_MEMORY, REGISTRY, MetricsMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Load the model at startup instead of on the first chat message
+WARM_MODEL = os.environ.get("CSVAI_WARM_MODEL", "1") != "0"
 
-app = FastAPI(title="CSV AI", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start serving at once; warm the dataset cache and the model in the background."""
+    readiness.register("datasets")
+    tasks = [asyncio.create_task(
+        readiness.track("datasets", run_in_threadpool(csv_service.warm_up)))]
+    if WARM_MODEL:
+        readiness.register("model")
+        tasks.append(asyncio.create_task(
+            readiness.track("model", chat_routes.chat_service.warm_up())))
+    else:
+        readiness.register("model", "ready", "loads on the first chat message")
+    DATASETS_MEMORY.set_function(csv_service.registry.memory_usage)
+    logger.info("CSV AI started", extra={"warm_model": WARM_MODEL})
+    yield
+    for task in tasks:
+        task.cancel()
+    chat_routes.chat_service.generation_queue.shutdown()
+    csv_service.chunked.shutdown()
+
+app = FastAPI(title="CSV AI", version="1.0.0", lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -15,11 +51,33 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Include routers
 app.include_router(csv_routes.router, prefix="/api", tags=["CSV"])
 app.include_router(chat_routes.router, prefix="/api", tags=["Chat"])
 
+# Health routes come before the static mount at "/", which would shadow them
+@app.get("/api/health")
+async def health_check():
+    """Liveness plus the warm-up state of the dataset cache and the model."""
+    return readiness.snapshot()
+
+@app.get("/api/health/live")
+async def liveness():
+    return {"status": "live"}
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    """200 once background warm-up has finished, 503 while it is running."""
+    snapshot = readiness.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
 # Serve frontend
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 app.mount("/", StaticFiles(directory=frontend_path, html=True), name="frontend")
@@ -28,10 +86,6 @@ photos_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "photos")
 if os.path.exists(photos_path):
     app.mount("/photos", StaticFiles(directory=photos_path), name="photos")
 
-@app.get("/api/health")
-async def health_check():
-    return {"status": "healthy"}
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
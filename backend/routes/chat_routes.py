@@ -1,7 +1,14 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
+import asyncio
+import json
 import os
+import threading
 from pydantic import BaseModel
 from services.chat_service import ChatService
+from services.generation_queue import GenerationCancelled, QueueFullError
 
 router = APIRouter()
 chat_service = ChatService()
@@ -9,45 +16,125 @@ chat_service = ChatService()
 class ChatRequest(BaseModel):
     message: str
     session_id: str = "default"
+    # False asks for a freshly sampled answer instead of a cached one
+    cache: bool = True
 
 class ClearHistoryRequest(BaseModel):
     session_id: str = "default"
 
+async def _watch_disconnect(http_request: Request, cancel_event: threading.Event):
+    """Set `cancel_event` if the client goes away while its request is pending."""
+    while not cancel_event.is_set():
+        if await http_request.is_disconnected():
+            cancel_event.set()
+            return
+        await asyncio.sleep(0.5)
+
 @router.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """Send a message and get AI response"""
+    cancel_event = threading.Event()
+    watcher = asyncio.create_task(_watch_disconnect(http_request, cancel_event))
     try:
-        response = await chat_service.get_response(request.message, request.session_id)
-        return {
+        prompt_stats = {}
+        response = await chat_service.get_response(
+            request.message, request.session_id, cancel_event=cancel_event,
+            use_cache=request.cache, prompt_stats=prompt_stats,
+        )
+        result = {
             "response": response,
             "session_id": request.session_id
         }
+        if prompt_stats:
+            result["prompt_tokens"] = prompt_stats
+        return result
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"message": str(e), "queue_depth": e.depth, "max_pending": e.max_pending},
+            headers={"Retry-After": "5"},
+        )
+    except GenerationCancelled as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        watcher.cancel()
+
+def _sse(event: dict) -> str:
+    return f"data: {json.dumps(event)}\n\n"
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Send a message and stream the AI response as Server-Sent Events"""
+    cancel_event = threading.Event()
+    events = chat_service.stream_response(
+        request.message, request.session_id, cancel_event=cancel_event,
+        use_cache=request.cache,
+    )
+    try:
+        # Admission happens before the first event, so a full queue is still a 429
+        first = await events.__anext__()
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail={"message": str(e), "queue_depth": e.depth, "max_pending": e.max_pending},
+            headers={"Retry-After": "5"},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    async def body():
+        watcher = asyncio.create_task(_watch_disconnect(http_request, cancel_event))
+        try:
+            yield _sse({**first, "session_id": request.session_id})
+            async for event in events:
+                yield _sse(event)
+        except Exception as e:
+            yield _sse({"type": "error", "detail": str(e)})
+        finally:
+            watcher.cancel()
+            await events.aclose()
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.post("/clear-history")
 async def clear_history(request: ClearHistoryRequest):
     """Clear chat history for a session"""
     try:
-        chat_service.clear_history(request.session_id)
+        await run_in_threadpool(chat_service.clear_history, request.session_id)
         return {"message": "Chat history cleared"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/chat-history")
-async def get_chat_history(session_id: str = "default"):
-    """Get chat history for a session"""
+async def get_chat_history(session_id: str = "default", offset: Optional[int] = None,
+                           limit: int = 50):
+    """Get a page of chat history for a session.
+
+    Messages are oldest first; `offset`/`limit` select the page, and without
+    `offset` the latest `limit` messages are returned. `total` counts the
+    messages kept for the session.
+    """
     try:
-        history = chat_service.get_history(session_id)
-        return {"history": history}
+        return await run_in_threadpool(chat_service.get_history, session_id, offset, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/cache-stats")
+async def cache_stats():
+    """Response cache hit/miss counters and the generation time hits saved."""
+    return chat_service.response_cache.stats()
+
 @router.get("/health/llm")
 async def llm_health():
-    """Report AI model device, params, and load status."""
+    """Report AI model device, params, load status and pool occupancy."""
     try:
-        ai_service = getattr(chat_service, "ai_service", None)
+        ai_service = chat_service.model_pool.any_model()
         device = getattr(ai_service, "device", None) if ai_service is not None else None
         model_path = getattr(ai_service, "model_path", None) if ai_service is not None else None
         return {
@@ -57,8 +144,18 @@ async def llm_health():
                 "CSVAI_DEVICE": os.environ.get("CSVAI_DEVICE", "cuda"),
                 "CSVAI_N_CTX": os.environ.get("CSVAI_N_CTX", "1024"),
                 "CSVAI_NGL": os.environ.get("CSVAI_NGL", "50"),
+                "CSVAI_POOL_SIZE": os.environ.get("CSVAI_POOL_SIZE", "1"),
+            },
+            "settings": {
+                "n_ctx": getattr(ai_service, "n_ctx", None),
+                "n_batch": getattr(ai_service, "n_batch", None),
+                "n_threads": getattr(ai_service, "n_threads", None),
             },
-            "loaded": ai_service.is_model_loaded() if ai_service is not None else False,
+            "tuning_profile": getattr(ai_service, "tuning_profile", None),
+            "loaded": chat_service.model_pool.loaded and ai_service.is_model_loaded(),
+            "pool": chat_service.model_pool.stats(),
+            "queue": chat_service.generation_queue.stats(),
+            "response_cache": chat_service.response_cache.stats(),
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
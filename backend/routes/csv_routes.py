@@ -1,31 +1,27 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
-import os
-import shutil
+from fastapi import APIRouter, UploadFile, File, Form, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+import logging
 from services import csv_service
+from utils.arrow_ipc import ARROW_MEDIA_TYPE, prefers_arrow
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
-UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
 @router.post("/upload")
-async def upload_csv(file: UploadFile = File(...)):
+async def upload_csv(file: UploadFile = File(...), session_id: str = Form("default")):
     """Upload a CSV file"""
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Only CSV files are allowed")
     
     try:
-        # Save file
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
-        print(f"Received file: {file.filename}")
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        print(f"Saved file to: {file_path}")
-
-        # Load CSV into service
-        csv_info = csv_service.load_csv(file_path)
-        print(f"Loaded CSV info: {csv_info}")
+        # Save and parse in one pass; run off the event loop since it is CPU/disk bound
+        logger.info("Received file %s", file.filename)
+        csv_info = await run_in_threadpool(
+            csv_service.ingest_upload, file.file, file.filename, session_id
+        )
+        logger.debug("Loaded CSV info: %s", csv_info)
         
         return JSONResponse(content={
             "message": "File uploaded successfully",
@@ -33,14 +29,14 @@ async def upload_csv(file: UploadFile = File(...)):
             "info": csv_info
         })
     except Exception as e:
-        print(f"Error during upload: {str(e)}")
+        logger.error("Error during upload: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/csv-info")
-async def get_csv_info():
-    """Get information about the currently loaded CSV"""
+async def get_csv_info(session_id: str = "default"):
+    """Get information about the session's CSV"""
     try:
-        info = csv_service.get_csv_info()
+        info = await run_in_threadpool(csv_service.get_csv_info, session_id)
         if not info:
             raise HTTPException(status_code=404, detail="No CSV file loaded")
         return info
@@ -48,12 +44,68 @@ async def get_csv_info():
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/csv-preview")
-async def get_csv_preview(rows: int = 10):
-    """Get a preview of the CSV data"""
+async def get_csv_preview(session_id: str = "default", offset: int = 0,
+                          limit: Optional[int] = None, rows: int = 10,
+                          sort: Optional[str] = None, order: str = "asc",
+                          filter: Optional[List[str]] = Query(None),
+                          accept: Optional[str] = Header(None)):
+    """Get a page of the CSV data in columnar form.
+
+    `offset`/`limit` select the page (`rows` is the older name for `limit`),
+    `sort` and `order` (asc/desc) order it and each `filter` is an
+    expression like `Age>=30`, `Gender=Female` or `Name~smith`.
+    Clients accepting application/vnd.apache.arrow.stream get an Arrow IPC
+    stream with the page counts in its schema metadata.
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    fmt = "arrow" if prefers_arrow(accept) else "json"
     try:
-        preview = csv_service.get_preview(rows)
-        if preview is None:
-            raise HTTPException(status_code=404, detail="No CSV file loaded")
-        return {"preview": preview}
+        page = await run_in_threadpool(
+            csv_service.get_page, session_id, offset, limit if limit is not None else rows,
+            sort, order == "desc", filter, fmt,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="No CSV file loaded")
+    return Response(
+        content=page,
+        media_type=ARROW_MEDIA_TYPE if fmt == "arrow" else "application/json",
+        headers={"Vary": "Accept"},
+    )
+
+@router.get("/export")
+async def export_csv(session_id: str = "default", format: Optional[str] = None,
+                     columns: Optional[str] = None, start: int = 0,
+                     limit: Optional[int] = None, gzip: bool = False,
+                     accept: Optional[str] = Header(None)):
+    """Stream the session's data as NDJSON, a JSON array or an Arrow IPC stream.
+
+    `format` is ndjson, json or arrow; without it, clients accepting
+    application/vnd.apache.arrow.stream get Arrow and others NDJSON.
+    `columns` is a comma-separated subset, `start`/`limit` select a row range
+    and `gzip=true` returns a compressed download.
+    """
+    format = format or ("arrow" if prefers_arrow(accept) else "ndjson")
+    selected = [c.strip() for c in columns.split(",") if c.strip()] if columns else None
+    try:
+        chunks = await run_in_threadpool(
+            csv_service.export_records, session_id, format, selected, start, limit, gzip
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="No CSV file loaded")
+
+    media_type = {"ndjson": "application/x-ndjson", "arrow": ARROW_MEDIA_TYPE}.get(format, "application/json")
+    filename = "export.arrows" if format == "arrow" else f"export.{format}"
+    if gzip:
+        media_type, filename = "application/gzip", filename + ".gz"
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
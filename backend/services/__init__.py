@@ -1,4 +1,8 @@
 from .csv_service import CSVService
+from .readiness import Readiness
 
 # Shared CSVService instance used by routes and chat
 csv_service = CSVService()
+
+# Startup warm-up progress reported by /api/health
+readiness = Readiness()
@@ -1,139 +1,418 @@
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
+import logging
 import os
-from gpt4all import GPT4All
+import threading
+import time
+from utils.metrics import GENERATED_TOKENS, PROMPT_TOKENS, TOKENS_PER_SECOND, observe_stage, span
+from utils.token_budget import estimate_tokens, fit_lines, truncate
+from utils.tuning_profile import load_profile, profile_path
+
+logger = logging.getLogger(__name__)
+
+# Sampling parameters for chat replies; part of the response cache key
+GENERATION_PARAMS = dict(max_tokens=500, temp=0.7, top_k=40, top_p=0.9, repeat_penalty=1.1)
+# Largest share of the context window a reply may take; small windows get
+# shorter replies rather than no room for the prompt
+MAX_OUTPUT_SHARE = float(os.environ.get("CSVAI_MAX_OUTPUT_SHARE", "0.5"))
+# Past messages replayed into a new chat session
+HISTORY_MESSAGES = 10
+# Query plans are short JSON objects
+PLAN_MAX_TOKENS = 200
+# Tokens reserved per turn for the chat template and role markers
+TEMPLATE_TOKENS = 32
+# Shares of the prompt budget left after the question for the schema context
+# and for retrieved rows; history gets the rest plus whatever they leave unused
+CONTEXT_SHARE = float(os.environ.get("CSVAI_CONTEXT_SHARE", "0.4"))
+RETRIEVED_SHARE = float(os.environ.get("CSVAI_RETRIEVED_SHARE", "0.3"))
+# Longest single history message replayed, and the summary of dropped turns
+HISTORY_MESSAGE_TOKENS = 200
+SUMMARY_TOKENS = 60
 
 class AIService:
     """Service for AI model interactions using GPT4All"""
     
-    def __init__(self):
+    def __init__(self, n_threads: Optional[int] = None):
         self.model = None
         self.model_path = None
         self.device = None
+        self.n_threads = n_threads
+        self.n_ctx = 2048
+        # Prompt tokens processed per batch; gpt4all's own default is 8
+        self.n_batch = 8
+        # Settings from tools/sweep_cpu_params.py, if measured for this model and host
+        self.tuning_profile: Optional[Dict] = None
+        # Live chat_session kept open across turns so its KV cache is reused
+        self._session_id: Optional[str] = None
+        self._session_cm = None
+        self._session_context: Optional[str] = None
+        self._session_turns = 0
+        self._session_tokens = 0
         self._initialize_model()
     
     def _initialize_model(self):
         """Initialize GPT4All similarly to bujhinAI (prefer CUDA, CPU fallback)."""
         project_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-        ai_model_dir = os.path.join(project_root, "ai Model")
+        ai_model_dir = os.environ.get("CSVAI_MODEL_DIR") or os.path.join(project_root, "ai Model")
 
         if not os.path.exists(ai_model_dir):
-            print(f"ai_model directory not found at {ai_model_dir}")
-            print("Please create 'ai Model' and add a GPT4All .gguf model")
+            logger.warning("Model directory not found at %s; create 'ai Model' and add a "
+                           "GPT4All .gguf model", ai_model_dir)
             return
 
         model_files = [f for f in os.listdir(ai_model_dir) if f.endswith('.gguf')]
         if not model_files:
-            print(f"No .gguf model files found in {ai_model_dir}")
-            print("Please download a GPT4All model (e.g., Mistral-7B-Instruct-v0.3-Q4_K_M.gguf)")
+            logger.warning("No .gguf model files found in %s; download a GPT4All model "
+                           "(e.g., Mistral-7B-Instruct-v0.3-Q4_K_M.gguf)", ai_model_dir)
             return
 
         model_name = model_files[0]
         model_full_path = os.path.join(ai_model_dir, model_name)
-        print(f"Found model: {model_name}")
-        print(f"Model path: {model_full_path}")
-        print(f"Found model file at '{model_full_path}'")
+        # Deferred so importing this module (e.g. for GENERATION_PARAMS) stays cheap
+        try:
+            from gpt4all import GPT4All
+        except ImportError as e:
+            logger.error("gpt4all is not available: %s", e)
+            return
+
+        logger.info("Found model %s at %s", model_name, model_full_path)
 
-        # Read tuning from environment (to match bujhinAI patterns but configurable)
-        preferred_device = os.environ.get("CSVAI_DEVICE", "cuda").lower()  # 'cuda' or 'cpu'
-        try_n_ctx = int(os.environ.get("CSVAI_N_CTX", "1024"))
+        # Read tuning from environment (to match bujhinAI patterns but configurable);
+        # a tuning profile supplies the defaults, explicit env vars still win
+        self.tuning_profile = load_profile(profile_path(ai_model_dir), model_name)
+        tuned = self.tuning_profile or {}
+        if tuned:
+            logger.info("Using tuning profile: %s", tuned)
+        preferred_device = os.environ.get("CSVAI_DEVICE", tuned.get("device", "cuda")).lower()  # 'cuda' or 'cpu'
+        try_n_ctx = int(os.environ.get("CSVAI_N_CTX", tuned.get("n_ctx", 1024)))
         try_ngl = int(os.environ.get("CSVAI_NGL", "50"))
-        print(f"Init params -> device={preferred_device}, n_ctx={try_n_ctx}, ngl={try_ngl}")
+        self.n_batch = int(os.environ.get("CSVAI_N_BATCH", tuned.get("n_batch", self.n_batch)))
+        if "n_threads" in tuned and "CSVAI_N_THREADS" not in os.environ:
+            # The pool's share of the cores is an upper bound; the profile may find fewer faster
+            self.n_threads = min(self.n_threads or tuned["n_threads"], tuned["n_threads"])
+        logger.info("Init params -> device=%s, n_ctx=%s, ngl=%s, n_threads=%s, n_batch=%s",
+                    preferred_device, try_n_ctx, try_ngl, self.n_threads, self.n_batch)
 
         # Try CUDA first (or CPU if preferred), then fallback
         try:
-            print(f"Attempting to load model with device='{preferred_device}'...")
+            logger.info("Attempting to load model with device=%s", preferred_device)
             self.model = GPT4All(
                 model_name=model_name,
                 model_path=ai_model_dir,
                 device=preferred_device,
                 n_ctx=try_n_ctx,
                 ngl=try_ngl,
+                n_threads=self.n_threads,
                 allow_download=False,
                 verbose=True,
             )
             self.device = preferred_device
-            print(f"✓ Model loaded successfully with device='{preferred_device}'")
+            self.n_ctx = try_n_ctx
+            logger.info("Model loaded with device=%s", preferred_device)
         except Exception as gpu_error:
-            print(f"GPU initialization failed: {gpu_error}")
-            print("Falling back to CPU...")
+            logger.warning("GPU initialization failed: %s; falling back to CPU", gpu_error)
             try:
                 self.model = GPT4All(
                     model_name=model_name,
                     model_path=ai_model_dir,
                     device='cpu',
+                    n_threads=self.n_threads,
                     allow_download=False,
                     verbose=True,
                 )
                 self.device = 'cpu'
-                print("✓ Model loaded successfully with CPU")
+                logger.info("Model loaded with CPU")
             except Exception as cpu_error:
-                print(f"CPU initialization also failed: {cpu_error}")
-                print("Trying with default device (CPU) without explicit flags...")
-                self.model = GPT4All(model_name=model_name, model_path=ai_model_dir, allow_download=False)
+                logger.warning("CPU initialization also failed: %s; trying the default device "
+                               "without explicit flags", cpu_error)
+                self.model = GPT4All(model_name=model_name, model_path=ai_model_dir,
+                                     n_threads=self.n_threads, allow_download=False)
                 self.device = 'cpu'
-                print("✓ Model loaded with default device (CPU)")
+                logger.info("Model loaded with default device (CPU)")
 
         self.model_path = model_full_path
 
-    async def generate_response(
+    def generate_response(
         self,
         message: str,
         context: str = "",
         history: List[Dict] = None,
+        cancel_event: Optional[threading.Event] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        session_id: Optional[str] = None,
+        retrieved_rows: Optional[List[str]] = None,
+        prompt_stats: Optional[Dict] = None,
     ) -> str:
-        """Generate a response using the AI model (chat_session like bujhinAI)."""
+        """Generate a response using the AI model (chat_session like bujhinAI).
+
+        Blocking; run it on the generation queue's executor. Setting
+        `cancel_event` stops generation at the next token. When `on_token` is
+        given the model streams and each token is passed to it as produced.
+
+        If this instance still holds `session_id`'s chat session (same context,
+        history unchanged since the last turn) and the new turn fits in what is
+        left of the context window, only the new message is processed;
+        otherwise the session is restarted with the context and history
+        replayed as the system prompt. Either way the prompt is fitted to
+        `n_ctx` (see _assemble_prompt) and, if `prompt_stats` is given, its
+        token breakdown is written into it.
+        """
         if self.model is None:
             return (
                 "AI model is not initialized. Please ensure a model file is in the ai_model "
                 "folder and restart the server."
             )
 
+        history = history or []
+        retrieved_rows = retrieved_rows or []
         try:
-            prompt = self._build_prompt(message, context, history or [])
-            print(f"Generating response with device: {self.device}")
-            print(f"Prompt: {prompt[:200]}...")
-
-            with self.model.chat_session():
-                response = self.model.generate(
-                    prompt,
-                    max_tokens=500,
-                    temp=0.7,
-                    top_k=40,
-                    top_p=0.9,
-                    repeat_penalty=1.1,
-                )
+            with span("prompt_build"):
+                turn, stats = None, None
+                if self._can_continue(session_id, context, history):
+                    turn, stats = self._assemble_turn(
+                        message, retrieved_rows, self._prompt_budget() - self._session_tokens)
+                if turn is None:
+                    system_prompt, turn, stats = self._assemble_prompt(context, history, message, retrieved_rows)
+                    self._start_session(session_id, context, history, system_prompt, stats["system"])
+                    stats["reused_session"] = False
+                else:
+                    stats["reused_session"] = True
+                stats["session_tokens"] = self._session_tokens + stats["turn"]
+            if prompt_stats is not None:
+                prompt_stats.update(stats)
+            logger.debug("Generating response with device %s (session turn %d)", self.device,
+                         self._session_turns // 2 + 1, extra={"prompt_tokens": stats})
+
+            timing = {"first_token": None, "tokens": 0}
+
+            def keep_going(token_id: int, token: str) -> bool:
+                if timing["first_token"] is None:
+                    timing["first_token"] = time.perf_counter()
+                timing["tokens"] += 1
+                return cancel_event is None or not cancel_event.is_set()
 
-            print(f"Response generated: {len(response)} chars")
+            params = dict(GENERATION_PARAMS, max_tokens=self._max_tokens(), n_batch=self.n_batch,
+                          callback=keep_going)
+            started = time.perf_counter()
+            if on_token is None:
+                response = self.model.generate(turn, **params)
+            else:
+                parts = []
+                for token in self.model.generate(turn, streaming=True, **params):
+                    parts.append(token)
+                    on_token(token)
+                response = "".join(parts)
+
+            self._record_generation(started, timing["first_token"], timing["tokens"], stats)
+
+            self._session_turns = len(history) + 2
+            self._session_tokens += stats["turn"] + estimate_tokens(response) + TEMPLATE_TOKENS
             return response.strip()
         except Exception as e:
-            print(f"Generation error: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Generation error")
+            self.end_session()
             return f"Error generating response: {str(e)}"
-    
-    def _build_prompt(self, message: str, context: str, history: List[Dict]) -> str:
-        """Build a prompt with context and conversation history"""
+
+    def generate_plan(self, question: str, system_prompt: str,
+                      cancel_event: Optional[threading.Event] = None) -> str:
+        """Ask the model for a JSON query plan. Blocking.
+
+        Runs in a throwaway chat session with near-greedy sampling, so any live
+        session on this instance is closed first.
+        """
+        if self.model is None:
+            return ""
+
+        def keep_going(token_id: int, token: str) -> bool:
+            return cancel_event is None or not cancel_event.is_set()
+
+        self.end_session()
+        try:
+            with span("plan_generation"), self.model.chat_session(system_prompt):
+                return self.model.generate(
+                    question,
+                    max_tokens=min(PLAN_MAX_TOKENS, self._max_tokens()),
+                    temp=0.1,
+                    top_k=1,
+                    repeat_penalty=1.0,
+                    n_batch=self.n_batch,
+                    callback=keep_going,
+                ).strip()
+        except Exception:
+            logger.exception("Plan generation error")
+            return ""
+
+    def _record_generation(self, started: float, first_token: Optional[float], tokens: int, stats: Dict):
+        """Split a generation into prompt ingestion (up to the first token) and
+        token generation, and record both with the token counts."""
+        finished = time.perf_counter()
+        first_token = first_token or finished
+        observe_stage("prompt_ingest", first_token - started)
+        observe_stage("generation", finished - first_token)
+        GENERATED_TOKENS.inc(tokens)
+        PROMPT_TOKENS.labels("turn").observe(stats["turn"])
+        if not stats["reused_session"]:
+            PROMPT_TOKENS.labels("system").observe(stats["system"])
+        rate = (tokens - 1) / (finished - first_token) if tokens > 1 and finished > first_token else None
+        if rate is not None:
+            TOKENS_PER_SECOND.set(rate)
+        logger.info("Response generated", extra={
+            "tokens": tokens, "ingest_seconds": round(first_token - started, 3),
+            "generation_seconds": round(finished - first_token, 3),
+            "tokens_per_second": round(rate, 2) if rate is not None else None,
+            "reused_session": stats["reused_session"], "turn_tokens": stats["turn"],
+        })
+
+    def _max_tokens(self) -> int:
+        """Reply length: GENERATION_PARAMS' max_tokens, capped at
+        MAX_OUTPUT_SHARE of the context window."""
+        return max(1, min(GENERATION_PARAMS["max_tokens"], int(MAX_OUTPUT_SHARE * self.n_ctx)))
+
+    def _prompt_budget(self) -> int:
+        """Prompt tokens available once the reply and chat template are reserved."""
+        return max(0, self.n_ctx - self._max_tokens() - TEMPLATE_TOKENS)
+
+    def _assemble_turn(self, message: str, retrieved_rows: List[str], available: int):
+        """The user turn (retrieved rows, then the question) within `available`
+        tokens; (None, None) if the question alone does not fit."""
+        message_tokens = estimate_tokens(message)
+        if message_tokens > available:
+            return None, None
+        share = int(RETRIEVED_SHARE * max(0, self._prompt_budget() - message_tokens))
+        header, question = "Relevant rows from the data:\n", "\n\nQuestion: "
+        wrapper = estimate_tokens(header + question)
+        rows, row_tokens = fit_lines(retrieved_rows, min(share, available - message_tokens - wrapper))
+        if rows:
+            turn = header + "\n".join(rows) + question + message
+        else:
+            turn = message
+        return turn, {
+            "n_ctx": self.n_ctx,
+            "reserved_output": self._max_tokens(),
+            "message": message_tokens,
+            "retrieved": row_tokens,
+            "retrieved_rows": len(rows),
+            "turn": estimate_tokens(turn),
+        }
+
+    def _assemble_prompt(self, context: str, history: List[Dict], message: str,
+                         retrieved_rows: List[str]):
+        """Fit a fresh session's system prompt and first turn into the budget.
+
+        After the question, CONTEXT_SHARE of the remaining tokens goes to the
+        schema context (trimmed line by line, keeping its closing
+        instructions) and RETRIEVED_SHARE to retrieved rows; history gets the
+        rest, newest messages first. History that does not fit is replaced
+        by a one-line summary of the questions asked, or dropped. A question
+        longer than the whole budget is cut to fit.
+        """
+        budget = self._prompt_budget()
+        message_tokens = estimate_tokens(message)
+        truncated = message_tokens > budget
+        if truncated:
+            logger.warning("Question of %d tokens exceeds the %d-token prompt budget; truncating it",
+                           message_tokens, budget)
+            message = truncate(message, budget)
+            message_tokens = estimate_tokens(message)
+        remaining = max(0, budget - message_tokens)
+
+        context_lines, context_tokens = fit_lines(
+            context.split("\n") if context else [], int(CONTEXT_SHARE * remaining), keep_last=True)
+        turn, stats = self._assemble_turn(message, retrieved_rows, max(message_tokens, budget))
+        # The turn's wrapper and the system prompt's section headings count too
+        overhead = stats["turn"] - message_tokens - stats["retrieved"]
+        overhead += estimate_tokens("Context:\n\nConversation History:\n")
+        history_budget = max(0, remaining - context_tokens - stats["retrieved"] - overhead)
+        history_lines, history_tokens, kept, dropped = self._fit_history(history, history_budget)
+
+        system_prompt = self._build_session_prompt("\n".join(context_lines), history_lines)
+        stats.update({
+            "context": context_tokens,
+            "context_lines_dropped": len(context.split("\n")) - len(context_lines) if context else 0,
+            "history": history_tokens,
+            "history_messages": kept,
+            "history_dropped": dropped,
+            "message_truncated": truncated,
+            "system": estimate_tokens(system_prompt),
+        })
+        return system_prompt, turn, stats
+
+    @staticmethod
+    def _fit_history(history: List[Dict], budget: int):
+        """History lines within `budget`, newest first, plus a summary of what
+        was left out. Returns (lines, tokens, messages kept, messages dropped)."""
+        window = history[-HISTORY_MESSAGES:]
+        lines, used = [], 0
+        for entry in reversed(window):
+            line = f"{entry['role'].capitalize()}: " + truncate(entry["content"], HISTORY_MESSAGE_TOKENS)
+            cost = estimate_tokens(line) + 1
+            if used + cost > budget:
+                break
+            lines.insert(0, line)
+            used += cost
+        kept = len(lines)
+        dropped = len(history) - kept
+        if dropped:
+            older = history[:len(history) - kept]
+            asked = "; ".join(truncate(m["content"], 16) for m in older if m["role"] == "user")
+            summary = truncate(f"(Earlier the user asked: {asked})", min(SUMMARY_TOKENS, budget - used - 1))
+            if asked and summary:
+                lines.insert(0, summary)
+                used += estimate_tokens(summary) + 1
+        return lines, used, kept, dropped
+
+    def _can_continue(self, session_id: Optional[str], context: str, history: List[Dict]) -> bool:
+        """True if the live session's KV state matches this request."""
+        if session_id is None or self._session_cm is None:
+            return False
+        if session_id != self._session_id or context != self._session_context:
+            return False
+        # A cancelled or cleared exchange leaves the KV state out of step with the history
+        return len(history) == self._session_turns
+
+    def _start_session(self, session_id: Optional[str], context: str, history: List[Dict],
+                       system_prompt: str, system_tokens: int):
+        """Open a fresh chat session with an assembled system prompt."""
+        self.end_session()
+        self._session_cm = self.model.chat_session(system_prompt)
+        self._session_cm.__enter__()
+        self._session_id = session_id
+        self._session_context = context
+        self._session_turns = len(history)
+        self._session_tokens = system_tokens + TEMPLATE_TOKENS
+
+    def end_session(self):
+        """Close the live chat session, discarding its KV state."""
+        if self._session_cm is not None:
+            try:
+                self._session_cm.__exit__(None, None, None)
+            except Exception as e:
+                logger.warning("Error closing chat session: %s", e)
+        self._session_cm = None
+        self._session_id = None
+        self._session_context = None
+        self._session_turns = 0
+        self._session_tokens = 0
+
+    @property
+    def live_session(self) -> Optional[str]:
+        return self._session_id
+
+    def _build_session_prompt(self, context: str, history_lines: List[str]) -> str:
+        """Build the system prompt with context and conversation history"""
         prompt_parts = []
-        
+
         # Add context
         if context:
             prompt_parts.append(f"Context:\n{context}\n")
-        
-        # Add conversation history (last 5 exchanges)
-        if history:
+
+        # Add conversation history (already fitted to the token budget)
+        if history_lines:
             prompt_parts.append("Conversation History:")
-            for entry in history[-10:]:  # Last 5 exchanges (10 messages)
-                role = entry['role'].capitalize()
-                content = entry['content']
-                prompt_parts.append(f"{role}: {content}")
+            prompt_parts.extend(history_lines)
             prompt_parts.append("")
-        
-        # Add current message
-        prompt_parts.append(f"User: {message}")
-        prompt_parts.append("Assistant:")
-        
+
         return "\n".join(prompt_parts)
-    
+
     def is_model_loaded(self) -> bool:
         """Check if model is loaded"""
         return self.model is not None
@@ -1,7 +1,36 @@
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import functools
+import logging
 import os
-from services.csv_service import CSVService
-from services.ai_service import AIService
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+from services.generation_queue import GenerationQueue
+from services.model_pool import ModelPool
+from services.query_engine import QueryEngine, QueryError
+from services.response_cache import ResponseCache, cache_key
+from services.row_index import row_text
+from services.session_store import SessionStore
+from utils.metrics import MODELS_BUSY, QUEUE_DEPTH, span
+from utils.token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Approximate token budget for the dataset description in the prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CSVAI_CONTEXT_TOKENS", "384"))
+# Rows retrieved into the prompt per message (AIService fits them to its budget)
+RETRIEVAL_ROWS = int(os.environ.get("CSVAI_RETRIEVAL_ROWS", "5"))
+# Ask the model for a query plan when a data question is not parsed directly
+QUERY_PLANNING = os.environ.get("CSVAI_QUERY_PLANNING", "1") != "0"
+# Let the model phrase a computed result instead of returning it verbatim
+PLAN_SUMMARIZE = os.environ.get("CSVAI_PLAN_SUMMARIZE", "0") == "1"
+# Seconds the model pool may take to load; loading is not a generation request
+MODEL_LOAD_TIMEOUT = float(os.environ.get("CSVAI_MODEL_LOAD_TIMEOUT", "1800"))
+# Largest page of chat history served by get_history
+MAX_HISTORY_PAGE = 500
+# Failure messages from AIService are never cached
+UNCACHEABLE_PREFIXES = ("Error generating response", "AI model is not initialized")
 
 class ChatService:
     """Service for handling chat interactions"""
@@ -9,86 +38,340 @@ class ChatService:
     def __init__(self):
         from services import csv_service as shared_csv
         self.csv_service = shared_csv
-        # Don't initialize AIService immediately to avoid heavy initialization on startup.
-        # We'll lazy-load AIService on first use (when a chat message requires AI response).
-        self.ai_service = None
-        self.chat_histories: Dict[str, List[Dict]] = {}
-    
-    async def get_response(self, message: str, session_id: str = "default") -> str:
-        """Get AI response for a user message"""
-        # Initialize history for new sessions
-        if session_id not in self.chat_histories:
-            self.chat_histories[session_id] = []
+        # Models are not loaded here: the app warms them up in the background at
+        # startup (see warm_up), or the first chat message that needs one loads them.
+        self.model_pool = ModelPool()
+        self._model_load: Optional[asyncio.Future] = None
+        # Model loading and generation run here, off the event loop, one worker per instance
+        self.generation_queue = GenerationQueue(workers=self.model_pool.size)
+        QUEUE_DEPTH.set_function(lambda: self.generation_queue.depth)
+        MODELS_BUSY.set_function(lambda: self.model_pool.stats()["busy"])
+        # Chat histories are shared with the other worker processes
+        self.sessions = SessionStore(self.csv_service.registry.db_path)
+        # Model-produced answers, keyed on dataset, question, history and parameters
+        self.response_cache = ResponseCache(
+            os.path.join(self.csv_service.UPLOAD_DIR, "response_cache.sqlite3")
+        )
 
-        # Ensure CSV is loaded from persisted state if needed, then get CSV context
-        try:
-            self.csv_service._load_last_uploaded()
-        except Exception:
-            pass
-        csv_info = self.csv_service.get_csv_info()
-        context = self._build_context(csv_info)
-
-        # Add user message to history
-        self.chat_histories[session_id].append({
-            "role": "user",
-            "content": message
-        })
-
-        # Check if the message is a query for the CSV
-        if csv_info and any(keyword in message.lower() for keyword in ["count", "average", "total", "json", "how many"]):
-            if "json" in message.lower():
-                json_data = self.csv_service.convert_to_json()
-                response = f"CSV JSON Data: {json_data[:500]}..."  # Limit response to 500 characters
-            else:
-                query_result = self.csv_service.query_data(message)
-                response = f"Query Result: {query_result}"
+    async def warm_up(self) -> Dict:
+        """Load the model pool ahead of the first chat message."""
+        await self._ensure_models()
+        ai_service = self.model_pool.any_model()
+        if not ai_service.is_model_loaded():
+            raise RuntimeError("No model could be loaded; chat answers only from the data")
+        return {"device": ai_service.device, "instances": self.model_pool.size}
+
+    async def _ensure_models(self):
+        """Wait for the model pool, starting its load if nobody has yet.
+
+        Every caller awaits the same load, so a request arriving during the
+        startup warm-up does not start another one, and a cancelled request
+        does not abort it. The load has its own timeout rather than the
+        generation timeout; a failed load is retried by the next caller.
+        """
+        if self.model_pool.loaded:
+            return
+        load = self._model_load
+        if load is None or (load.done() and (load.cancelled() or load.exception() is not None)):
+            from services.ai_service import AIService
+            load = self._model_load = asyncio.ensure_future(self.generation_queue.run(
+                self.model_pool.load, AIService, timeout=MODEL_LOAD_TIMEOUT))
+        await asyncio.shield(load)
+
+    async def get_response(self, message: str, session_id: str = "default",
+                           cancel_event: Optional[threading.Event] = None,
+                           use_cache: bool = True, prompt_stats: Optional[Dict] = None) -> str:
+        """Get AI response for a user message.
+
+        Raises QueueFullError when the model queue is full and
+        GenerationCancelled when `cancel_event` fires or the request times out;
+        in both cases the exchange is not recorded in the history. With
+        `use_cache=False` a fresh response is produced (and cached). If the
+        model generated the reply, `prompt_stats` receives its prompt token
+        breakdown.
+        """
+        # The registry lazily loads the session's dataset if it was evicted
+        csv_info = await run_in_threadpool(self.csv_service.get_csv_info, session_id)
+        cancel_event = cancel_event or threading.Event()
+        history = await run_in_threadpool(self.sessions.history, session_id)
+        started = time.perf_counter()
+        key = self._cache_key(csv_info, message, history)
+        response, context = await self._answer_from_data(
+            message, csv_info, session_id, cancel_event, key, use_cache)
+        if response is None:
+            await self._ensure_models()
+            rows = await run_in_threadpool(self._retrieved_rows, message, session_id)
+            generate = functools.partial(
+                self.model_pool.call,
+                lambda ai_service: ai_service.generate_response(
+                    message=message,
+                    context=context,
+                    history=history,
+                    cancel_event=cancel_event,
+                    session_id=session_id,
+                    retrieved_rows=rows,
+                    prompt_stats=prompt_stats,
+                ),
+                session_id,
+            )
+            response = await self.generation_queue.run(generate, cancel_event=cancel_event)
+            await self._cache_response(key, response, started)
+
+        await run_in_threadpool(self._record_exchange, session_id, message, response)
+        return response
+
+    async def stream_response(self, message: str, session_id: str = "default",
+                              cancel_event: Optional[threading.Event] = None,
+                              use_cache: bool = True) -> AsyncIterator[Dict]:
+        """Yield chat events as the model produces them.
+
+        Events are dicts: one `start` (with the queue position), any number of
+        `token`, then `done` with the full response (and the prompt token
+        breakdown when the model generated it). QueueFullError is raised
+        before the first event; the exchange is recorded only on completion.
+        """
+        prompt_stats: Dict = {}
+        csv_info = await run_in_threadpool(self.csv_service.get_csv_info, session_id)
+        cancel_event = cancel_event or threading.Event()
+        history = await run_in_threadpool(self.sessions.history, session_id)
+        started = time.perf_counter()
+        key = self._cache_key(csv_info, message, history)
+        response, context = await self._answer_from_data(
+            message, csv_info, session_id, cancel_event, key, use_cache)
+        if response is not None:
+            yield {"type": "start", "queue_position": 0}
+            yield {"type": "token", "text": response}
         else:
-                # If AI service isn't initialized, initialize it lazily now.
-                if self.ai_service is None:
-                    from services.ai_service import AIService
-                    self.ai_service = AIService()
-
-                # Get AI response
-                response = await self.ai_service.generate_response(
-                message=message,
-                context=context,
-                history=self.chat_histories[session_id][:-1]  # Exclude the current message
+            await self._ensure_models()
+            loop = asyncio.get_running_loop()
+            tokens: asyncio.Queue = asyncio.Queue()
+            rows = await run_in_threadpool(self._retrieved_rows, message, session_id)
+
+            def on_token(token: str):
+                loop.call_soon_threadsafe(tokens.put_nowait, token)
+
+            generate = functools.partial(
+                self.model_pool.call,
+                lambda ai_service: ai_service.generate_response(
+                    message=message,
+                    context=context,
+                    history=history,
+                    cancel_event=cancel_event,
+                    on_token=on_token,
+                    session_id=session_id,
+                    retrieved_rows=rows,
+                    prompt_stats=prompt_stats,
+                ),
+                session_id,
             )
+            position = self.generation_queue.admit()
+            task = asyncio.create_task(
+                self.generation_queue.run(generate, cancel_event=cancel_event, admitted=True)
+            )
+            # Tokens are queued before the task completes, so None always comes last
+            task.add_done_callback(lambda _: tokens.put_nowait(None))
+            try:
+                yield {"type": "start", "queue_position": position}
+                while True:
+                    token = await tokens.get()
+                    if token is None:
+                        break
+                    yield {"type": "token", "text": token}
+                response = await task
+                await self._cache_response(key, response, started)
+            finally:
+                if not task.done():
+                    # Consumer went away: stop the worker, let run() free the slot
+                    cancel_event.set()
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
-        # Add AI response to history
-        self.chat_histories[session_id].append({
-            "role": "assistant",
-            "content": response
-        })
+        await run_in_threadpool(self._record_exchange, session_id, message, response)
+        done = {"type": "done", "response": response}
+        if prompt_stats:
+            done["prompt_tokens"] = prompt_stats
+        yield done
+
+    async def _answer_from_data(self, message: str, csv_info: Optional[Dict], session_id: str,
+                                cancel_event: threading.Event, key: str,
+                                use_cache: bool) -> Tuple[Optional[str], str]:
+        """Try to answer without free generation: directly from the data, from
+        the response cache, or with a model-written query plan.
+
+        Returns (response, context): a response, or None with the context the
+        model should answer from (including the computed result when
+        PLAN_SUMMARIZE is on).
+        """
+        started = time.perf_counter()
+        with span("prompt_build"):
+            context = self._build_context(csv_info)
+        response = await run_in_threadpool(self._answer_directly, message, csv_info, session_id)
+        if response is not None:
+            return response, context
+        if use_cache:
+            cached = await run_in_threadpool(self.response_cache.get, key)
+            if cached is not None:
+                return cached, context
+        else:
+            self.response_cache.record_bypass()
+        result = await self._answer_with_plan(message, csv_info, session_id, cancel_event)
+        if result is None:
+            return None, context
+        if not PLAN_SUMMARIZE:
+            await self._cache_response(key, result, started)
+            return result, context
+        return None, f"{context}\n\nExact result computed from the full dataset:\n{result}"
+
+    async def _answer_with_plan(self, message: str, csv_info: Optional[Dict], session_id: str,
+                                cancel_event: threading.Event) -> Optional[str]:
+        """Have the model translate a data question into a JSON query plan and
+        execute it over the full dataset; None if no valid plan came back."""
+        if not QUERY_PLANNING or not csv_info:
+            return None
+        engine = self.csv_service.query_engine
+        df = await run_in_threadpool(self.csv_service.get_schema_frame, session_id)
+        if df is None or not await run_in_threadpool(
+                engine.mentions_data, message, df, csv_info["version"]):
+            return None
+
+        await self._ensure_models()
+        system_prompt = engine.plan_prompt(csv_info)
+        generate = functools.partial(
+            self.model_pool.call,
+            lambda ai_service: ai_service.generate_plan(message, system_prompt, cancel_event),
+        )
+        text = await self.generation_queue.run(generate, cancel_event=cancel_event)
+        try:
+            plan = QueryEngine.parse_plan_text(text)
+            if plan is None:
+                return None
+            logger.info("Executing model query plan: %s", plan.to_dict())
+            return await run_in_threadpool(self.csv_service.execute_plan, plan, session_id)
+        except QueryError as e:
+            logger.info("Model query plan rejected: %s", e)
+            return None
+
+    def _answer_directly(self, message: str, csv_info: Optional[Dict],
+                         session_id: str) -> Optional[str]:
+        """Answer data questions without the model; None if the model is needed."""
+        if not csv_info:
+            return None
+        if "json" in message.lower():
+            # Serialize only the rows that fit in the reply; the full data is at /api/export
+            json_data = self.csv_service.convert_to_json(session_id, max_chars=500)
+            return f"CSV JSON Data: {json_data[:500]}..."  # Limit response to 500 characters
+        # Questions that map onto a query plan get an exact pandas answer
+        try:
+            return self.csv_service.answer_query(message, session_id)
+        except Exception:
+            logger.exception("Error answering query directly")
+            return None
+
+    def _retrieved_rows(self, message: str, session_id: str) -> List[str]:
+        """The dataset rows most relevant to the message, one line each, best
+        first. AIService puts them in the user turn rather than the system
+        context, so the live chat session (and its KV cache) is kept."""
+        if RETRIEVAL_ROWS <= 0:
+            return []
+        try:
+            with span("retrieval"):
+                rows = self.csv_service.retrieve_rows(message, session_id, RETRIEVAL_ROWS)
+        except Exception:
+            logger.exception("Error retrieving rows")
+            return []
+        if rows is None:
+            return []
+        return [f"- {row_text(row)}" for _, row in rows.iterrows()]
+
+    def _cache_key(self, csv_info: Optional[Dict], message: str, history: List[Dict]) -> str:
+        from services.ai_service import GENERATION_PARAMS, HISTORY_MESSAGES
+        params = dict(GENERATION_PARAMS, retrieval_rows=RETRIEVAL_ROWS, planning=QUERY_PLANNING,
+                      summarize=PLAN_SUMMARIZE)
+        version = csv_info["version"] if csv_info else None
+        return cache_key(version, message, history[-HISTORY_MESSAGES:], params)
+
+    async def _cache_response(self, key: str, response: str, started: float):
+        """Cache a model-produced response unless it reports a failure."""
+        if response and not response.startswith(UNCACHEABLE_PREFIXES):
+            await run_in_threadpool(
+                self.response_cache.put, key, response, time.perf_counter() - started)
+
+    def _record_exchange(self, session_id: str, message: str, response: str):
+        """Record a completed exchange in the session history"""
+        self.sessions.append(session_id, [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": response},
+        ])
+        for idle_session in self.sessions.evict_idle():
+            self.csv_service.release_session(idle_session)
 
-        return response
-    
     def _build_context(self, csv_info: Optional[Dict]) -> str:
-        """Build context string from CSV information"""
+        """Build context string from the dataset profile, within CONTEXT_TOKEN_BUDGET"""
         if not csv_info:
             return "No CSV file is currently loaded. Please upload a CSV file first."
-        
-        context = f"""Current CSV file: {csv_info['filename']}
+
+        header = f"""Current CSV file: {csv_info['filename']}
 Rows: {csv_info['rows']}
-Columns: {csv_info['columns']}
-Column names: {', '.join(csv_info['column_names'])}
+Columns: {csv_info['columns']}"""
+        footer = ("You are an AI assistant helping users analyze their CSV data. Answer questions "
+                  "about the data, provide insights, and help with data analysis tasks.")
+
+        # Columns are described until the budget runs out
+        budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(header) - estimate_tokens(footer) - 4
+        lines = ["Column details:"]
+        described = 0
+        for name in csv_info["column_names"]:
+            line = self._describe_column(name, csv_info["column_stats"].get(name, {}))
+            cost = estimate_tokens(line) + 1
+            if budget - cost < 0:
+                break
+            lines.append(line)
+            budget -= cost
+            described += 1
+        if described < len(csv_info["column_names"]):
+            remaining = csv_info["column_names"][described:]
+            names = f"Other columns: {', '.join(remaining)}"
+            lines.append(names if estimate_tokens(names) <= budget else f"... and {len(remaining)} more columns")
+        else:
+            sample = f"Sample row: {csv_info['sample_rows'][0]}" if csv_info["sample_rows"] else ""
+            if sample and estimate_tokens(sample) <= budget:
+                lines.append(sample)
+
+        return "\n".join([header, *lines, "", footer])
+
+    @staticmethod
+    def _describe_column(name: str, stats: Dict) -> str:
+        """One-line summary of a profiled column"""
+        parts = [f"- {name} ({stats.get('dtype', '?')}"]
+        if "cardinality" in stats:
+            parts.append(f", {stats['cardinality']} distinct")
+        if stats.get("nulls"):
+            parts.append(f", {stats['nulls']} missing")
+        parts.append(")")
+        if "min" in stats:
+            parts.append(f": min {stats['min']}, max {stats['max']}, mean {stats['mean']}")
+        elif stats.get("top_values"):
+            top = ", ".join(str(v["value"]) for v in stats["top_values"][:3])
+            parts.append(f": e.g. {top}")
+        return "".join(parts)
 
-You are an AI assistant helping users analyze their CSV data. Answer questions about the data, provide insights, and help with data analysis tasks."""
-        
-        return context
-    
     def clear_history(self, session_id: str = "default"):
         """Clear chat history for a session"""
-        if session_id in self.chat_histories:
-            self.chat_histories[session_id] = []
+        self.sessions.clear(session_id)
     
-    def get_history(self, session_id: str = "default") -> List[Dict]:
-        """Get chat history for a session"""
-        return self.chat_histories.get(session_id, [])
+    def get_history(self, session_id: str = "default", offset: Optional[int] = None,
+                    limit: int = 50) -> Dict:
+        """A page of a session's chat history, oldest message first.
+
+        Without `offset` the page is the latest `limit` messages.
+        """
+        limit = max(0, min(limit, MAX_HISTORY_PAGE))
+        if offset is None:
+            offset = self.sessions.count(session_id) - limit
+        offset = max(0, offset)
+        messages, total = self.sessions.page(session_id, offset, limit)
+        return {"history": messages, "offset": offset, "limit": limit, "total": total}
 
     def clear_session(self, session_id: str = "default"):
-        """Clear session and reset chat history"""
-        self.chat_histories.pop(session_id, None)
-        self.csv_service.df = None
-        self.csv_service.filename = None
-        self.csv_service.file_path = None
+        """Clear session history and release its dataset binding"""
+        self.sessions.clear(session_id)
+        self.csv_service.release_session(session_id)
@@ -0,0 +1,311 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import replace
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from services.query_engine import (
+    MAX_GROUPS,
+    PLAN_MEMORY_MB,
+    Filter,
+    QueryEngine,
+    QueryError,
+    QueryPlan,
+)
+from utils.chunked_store import PartStore, read_part
+from utils.columnar_cache import combine_chunks
+
+logger = logging.getLogger(__name__)
+
+# Processes evaluating parts in parallel; 0 evaluates them in the calling thread
+WORKERS = int(os.environ.get("CSVAI_OUT_OF_CORE_WORKERS", "0"))
+# Wall-clock seconds a plan may spend scanning parts
+TIMEOUT = float(os.environ.get("CSVAI_OUT_OF_CORE_TIMEOUT", "300"))
+# Deepest row (offset + limit) a sorted page may reach
+MAX_SORTED_WINDOW = 100000
+# Column holding each row's position in the dataset while pages are merged
+_ROW = "__row__"
+
+_engine = QueryEngine()
+
+
+def _plain(series: pd.Series) -> pd.Series:
+    """Categorical values as plain objects, so parts whose categories differ
+    (or that were not categorical at all) merge by value."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(object)
+    return series
+
+
+def _plain_index(result):
+    if isinstance(result.index, pd.CategoricalIndex):
+        result.index = result.index.astype(object)
+    return result
+
+
+def _wide(series: pd.Series) -> pd.Series:
+    """Floats summed as float64, so per-part float32 sums add up exactly."""
+    return series.astype(np.float64) if pd.api.types.is_float_dtype(series) else series
+
+
+def _plan_columns(plan: QueryPlan) -> Optional[List[str]]:
+    if plan.op == "rows":
+        return None
+    names = [f.column for f in plan.filters] + [plan.column, plan.group_by]
+    return [c for c in dict.fromkeys(names) if c is not None]
+
+
+def _filtered(part: pd.DataFrame, filters: List[Filter], deadline: Optional[float]) -> pd.DataFrame:
+    try:
+        mask = _engine.filter_mask(part, filters, deadline)
+    except (TypeError, ValueError) as e:
+        raise QueryError(f"Filter does not match the column type: {e}") from e
+    return part[mask] if mask is not None else part
+
+
+def _partial(path: str, plan: QueryPlan, deadline: float):
+    """Evaluate `plan` over one part, leaving what the parts' results need to
+    be merged: counts, sums, extremes, distinct values or the best rows.
+    Module level so a process pool can run it."""
+    sub = _filtered(read_part(path, _plan_columns(plan)), plan.filters, deadline)
+    if plan.op == "rows":
+        return _engine.execute(sub, replace(plan, filters=[]))
+    if plan.group_by:
+        if plan.op in ("median", "nunique"):
+            pairs = pd.DataFrame({"key": _plain(sub[plan.group_by]), "value": _plain(sub[plan.column])})
+            pairs = pairs.dropna()
+            return pairs if plan.op == "median" else pairs.drop_duplicates()
+        groups = sub.groupby(plan.group_by, observed=True, sort=False)
+        if plan.op == "count":
+            return _plain_index(groups.size())
+        values = groups[plan.column]
+        if plan.op in ("sum", "mean"):
+            values = _wide(sub[plan.column]).groupby(sub[plan.group_by], observed=True, sort=False)
+            return _plain_index(values.agg(["sum", "count"]))
+        return _plain_index(getattr(values, plan.op)())
+    if plan.op == "count":
+        return len(sub)
+    values = _plain(sub[plan.column]).dropna()
+    if plan.op in ("sum", "mean"):
+        return _wide(values).sum(), len(values)
+    if plan.op in ("min", "max"):
+        return getattr(values, plan.op)() if len(values) else None
+    if plan.op == "median":
+        return values.to_numpy()
+    return pd.unique(values.to_numpy())
+
+
+def _check_size(nbytes: int):
+    if nbytes > PLAN_MEMORY_MB * 1024 * 1024:
+        raise QueryError(f"Query needs more than the {PLAN_MEMORY_MB} MB limit")
+
+
+def _frame_bytes(frame) -> int:
+    return int(frame.memory_usage(deep=True).sum()) if isinstance(frame, pd.DataFrame) \
+        else int(frame.memory_usage(deep=True))
+
+
+def _sort_key(series: pd.Series) -> pd.Series:
+    # Categoricals sort by their labels, as build_sort_index does
+    return series.astype(str).where(series.notna()) if isinstance(series.dtype, pd.CategoricalDtype) \
+        else series
+
+
+class ChunkedExecutor:
+    """Evaluates query plans and pages over datasets kept on disk as parts.
+
+    Each part is filtered and reduced to a partial result on its own, so a
+    plan holds one part's columns at a time plus what it accumulates:
+    counts, sums and extremes merge exactly, as do grouped results (one
+    entry per group). Medians and distinct counts need the values
+    themselves, which are bounded by PLAN_MEMORY_MB like in-memory plans.
+    With CSVAI_OUT_OF_CORE_WORKERS set, parts are evaluated by a pool of
+    processes, each mapping its own parts.
+    """
+
+    def __init__(self, engine: QueryEngine, workers: int = WORKERS):
+        self.engine = engine
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def execute(self, store: PartStore, plan: QueryPlan, timeout: Optional[float] = None):
+        """Run a plan over every part and merge the partial results; returns
+        what QueryEngine.execute would for the whole dataset."""
+        self.engine.validate(plan, store.sample)
+        deadline = time.monotonic() + (timeout or TIMEOUT)
+        if plan.op == "count" and not plan.group_by and not plan.filters:
+            return store.rows
+        partials = self._map(store.paths, plan, deadline)
+        if plan.op == "rows":
+            return self._merge_rows(partials, plan)
+        if plan.group_by:
+            result = self._merge_groups(partials, plan)
+            if plan.order:
+                result = result.sort_values(ascending=plan.order == "asc")
+            else:
+                result = result.sort_index()
+            return result.head(plan.limit or MAX_GROUPS)
+        return self._merge_scalar(partials, plan)
+
+    def _map(self, paths: List[str], plan: QueryPlan, deadline: float) -> Iterator:
+        """Partial results in part order, computed here or by the pool."""
+        if self.workers <= 0 or len(paths) < 2:
+            for path in paths:
+                _engine._check_deadline(deadline)
+                yield _partial(path, plan, deadline)
+            return
+        pool = self._get_pool()
+        futures = [pool.submit(_partial, path, plan, deadline) for path in paths]
+        try:
+            for future in futures:
+                yield future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeout:
+            raise QueryError("Query took too long and was stopped")
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                logger.info("Starting %d out-of-core worker processes", self.workers)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+    def _merge_rows(self, partials: Iterator[pd.DataFrame], plan: QueryPlan) -> pd.DataFrame:
+        """Each part's best rows; without a sort column the first matches
+        end the scan."""
+        limit = plan.limit or 10
+        kept, found = [], 0
+        for rows in partials:
+            kept.append(rows.reset_index(drop=True))
+            found += len(rows)
+            if plan.column is None and found >= limit:
+                break
+            if plan.column is not None and len(kept) > 1:
+                kept = [self.engine.execute(combine_chunks(kept), replace(plan, filters=[]))]
+        rows = combine_chunks(kept).reset_index(drop=True)
+        return self.engine.execute(rows, replace(plan, filters=[]))
+
+    def _merge_groups(self, partials: Iterator, plan: QueryPlan) -> pd.Series:
+        merged = None
+        for partial in partials:
+            if plan.op in ("median", "nunique"):
+                merged = partial if merged is None else pd.concat([merged, partial], ignore_index=True)
+                if plan.op == "nunique":
+                    merged = merged.drop_duplicates()
+            else:
+                merged = partial if merged is None else pd.concat([merged, partial])
+                grouped = merged.groupby(level=0, sort=False)
+                merged = grouped.min() if plan.op == "min" else \
+                    grouped.max() if plan.op == "max" else grouped.sum()
+            _check_size(_frame_bytes(merged))
+        if merged is None or merged.empty:
+            result = pd.Series(dtype=float)
+        elif plan.op in ("median", "nunique"):
+            result = getattr(merged.groupby("key", sort=False)["value"], plan.op)()
+        elif plan.op == "mean":
+            result = merged["sum"] / merged["count"].where(merged["count"] > 0)
+        elif plan.op == "sum":
+            result = merged["sum"]
+        else:
+            result = merged
+        return result.rename(plan.column).rename_axis(plan.group_by)
+
+    def _merge_scalar(self, partials: Iterator, plan: QueryPlan):
+        if plan.op == "count":
+            return int(sum(partials))
+        if plan.op in ("sum", "mean"):
+            total, count = 0, 0
+            for part_total, part_count in partials:
+                total += part_total
+                count += part_count
+            if plan.op == "sum":
+                return total
+            return total / count if count else np.nan
+        if plan.op in ("min", "max"):
+            values = [v for v in partials if v is not None]
+            if not values:
+                return np.nan
+            return min(values) if plan.op == "min" else max(values)
+        merged = np.empty(0)
+        for values in partials:
+            merged = np.concatenate([merged, values]) if len(merged) else values
+            if plan.op == "nunique":
+                merged = pd.unique(merged)
+            _check_size(_frame_bytes(pd.Series(merged)))
+        if plan.op == "nunique":
+            return len(merged)
+        return pd.Series(merged).median()
+
+    # Pages
+
+    def match_counts(self, store: PartStore, filters: List[Filter]) -> np.ndarray:
+        """Rows matching `filters` in each part."""
+        plan = QueryPlan(op="count", filters=filters)
+        try:
+            counts = list(self._map(store.paths, plan, time.monotonic() + TIMEOUT))
+        except QueryError as e:
+            raise ValueError(str(e)) from e
+        return np.array(counts, dtype=np.int64)
+
+    def filtered_slice(self, store: PartStore, filters: List[Filter], counts: np.ndarray,
+                       start: int, stop: int) -> pd.DataFrame:
+        """Matching rows [start, stop), given each part's match count; only
+        the parts holding them are read."""
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        frames = []
+        for index in range(len(counts)):
+            if starts[index + 1] <= start or not counts[index]:
+                continue
+            if starts[index] >= stop:
+                break
+            sub = self._checked_filter(store.read(index), filters)
+            frames.append(sub.iloc[max(0, start - starts[index]):stop - starts[index]])
+        return self._combine(store, frames)
+
+    def sorted_slice(self, store: PartStore, filters: List[Filter], sort: str, descending: bool,
+                     start: int, stop: int) -> Tuple[pd.DataFrame, int]:
+        """Rows [start, stop) of the (filtered) dataset sorted by `sort`, nulls
+        last, and the number of matching rows. Each part contributes its best
+        `stop` rows, so `stop` is capped at MAX_SORTED_WINDOW."""
+        if stop > MAX_SORTED_WINDOW:
+            raise ValueError(f"Sorted pages of this dataset must end within the first "
+                             f"{MAX_SORTED_WINDOW} rows")
+        best, total = None, 0
+        for index in range(len(store.files)):
+            sub = self._checked_filter(store.read(index), filters)
+            total += len(sub)
+            sub = sub.assign(**{_ROW: np.arange(len(sub)) + int(store.starts[index])})
+            best = sub if best is None else combine_chunks([best, sub.reset_index(drop=True)])
+            # Descending ties come last row first, as in the in-memory sort index
+            best = best.sort_values([sort, _ROW], ascending=not descending, kind="stable",
+                                    na_position="last", key=_sort_key).head(stop)
+        if best is None:
+            return store.sample.iloc[:0], 0
+        return best.iloc[start:stop].drop(columns=_ROW).reset_index(drop=True), total
+
+    def _checked_filter(self, part: pd.DataFrame, filters: List[Filter]) -> pd.DataFrame:
+        if not filters:
+            return part
+        try:
+            return _filtered(part, filters, None)
+        except QueryError as e:
+            raise ValueError(str(e)) from e
+
+    @staticmethod
+    def _combine(store: PartStore, frames: List[pd.DataFrame]) -> pd.DataFrame:
+        if not frames:
+            return store.sample.iloc[:0]
+        return combine_chunks([f.reset_index(drop=True) for f in frames]).reset_index(drop=True)
@@ -1,136 +1,445 @@
+import functools
+import itertools
+import json
+import logging
+import numpy as np
 import pandas as pd
 import os
-from typing import Optional, Dict, List
+from typing import Optional, Dict, Iterator, List, IO, Tuple
+from utils.columnar_cache import (
+    TeeReader,
+    cache_path_for,
+    content_hash,
+    read_cache,
+    read_csv_chunked,
+    write_cache,
+)
+from utils.chunked_store import parts_path_for, wants_parts, write_parts
+from utils.dataset_profile import profile_path_for, save_profile
+from utils.sort_index import ordered_positions, take_rows
+from utils.metrics import span, timed_iter
+from utils.record_stream import FORMATS, columnar_json, gzip_stream, iter_records, json_excerpt
+from utils.arrow_ipc import iter_stream, table_bytes, to_table
+from utils.shared_state import file_lock, lock_path_for
+from services.dataset_registry import DatasetRegistry
+from services.row_index import RowIndexService
+from services.chunked_query import ChunkedExecutor
+from services.query_engine import QueryEngine, QueryError, QueryPlan, parse_filter
+
+logger = logging.getLogger(__name__)
+
+# Largest page served by get_page
+MAX_PAGE_ROWS = 1000
+# Most recently used datasets brought into memory by warm_up
+WARM_DATASETS = int(os.environ.get("CSVAI_WARM_DATASETS", "1"))
 
 class CSVService:
     """Service for handling CSV file operations"""
-    
+
     def __init__(self):
-        self.df: Optional[pd.DataFrame] = None
-        self.filename: Optional[str] = None
-        self.file_path: Optional[str] = None
-        # Initialize upload directory and try to load last uploaded CSV
+        # Initialize upload directory and the registry of uploaded datasets
         project_root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-        self.UPLOAD_DIR = os.path.join(project_root, "uploads")
+        self.UPLOAD_DIR = os.environ.get("CSVAI_UPLOAD_DIR") or os.path.join(project_root, "uploads")
         os.makedirs(self.UPLOAD_DIR, exist_ok=True)
+        self.query_engine = QueryEngine()
+        self.chunked = ChunkedExecutor(self.query_engine)
+        self.row_index = RowIndexService()
+        self.registry = DatasetRegistry(self.UPLOAD_DIR)
+
+    def warm_up(self) -> Dict:
+        """Prepare recent datasets so the first requests find them in memory.
+
+        Run in the background at startup: migrates state from older versions,
+        then loads the frame, profile and row index of up to WARM_DATASETS
+        datasets (missing indexes are scheduled for a build).
+        """
         self._load_last_uploaded()
-    
-    def load_csv(self, file_path: str) -> Dict:
-        """Load a CSV file and return basic information"""
+        warmed = []
+        for dataset in self.registry.recent(WARM_DATASETS):
+            try:
+                self.registry.get_profile(dataset)
+                if dataset.out_of_core:
+                    warmed.append(dataset.dataset_id)
+                    continue
+                df = self.registry.get_dataframe(dataset)
+                index = self.row_index.get(
+                    dataset.version, dataset.index_path, dataset.cache_path, len(df))
+                if index is None:
+                    self.row_index.schedule(dataset.version, df, dataset.index_path, dataset.cache_path)
+                warmed.append(dataset.dataset_id)
+            except Exception as e:
+                logger.error("Error warming dataset %s: %s", dataset.dataset_id, e)
+        return {"datasets": warmed}
+
+    def ingest_upload(self, source: IO[bytes], filename: str, session_id: str = "default") -> Dict:
+        """Save an uploaded CSV while parsing it in chunks, write the columnar
+        cache and bind the dataset to the session. Identical uploads reuse the
+        already registered dataset, including one another worker process is
+        still ingesting: the dataset's file lock makes this one wait for it.
+
+        The frame kept in memory is mapped from the cache rather than the
+        parsed copy, so worker processes share its pages. Uploads too large
+        to load whole are split into columnar parts instead."""
         try:
-            print(f"Loading CSV from path: {file_path}")
-            self.df = pd.read_csv(file_path)
-            self.file_path = file_path
-            self.filename = os.path.basename(file_path)
-            # persist the current csv path so other processes can pick it up
-            self._write_current_csv_path(file_path)
-            print(f"Loaded DataFrame: {self.df.head()} with shape {self.df.shape}")
-
-            return self.get_csv_info()
+            dataset_id = content_hash(source)
+            size = source.seek(0, os.SEEK_END)
+            source.seek(0)
+            if self.registry.contains(dataset_id):
+                logger.info("Upload matches registered dataset %s, reusing it", dataset_id)
+                self.registry.bind(session_id, dataset_id)
+                return self.get_csv_info(session_id)
+
+            dataset_dir = os.path.join(self.UPLOAD_DIR, dataset_id)
+            os.makedirs(dataset_dir, exist_ok=True)
+            file_path = os.path.join(dataset_dir, os.path.basename(filename))
+            with file_lock(lock_path_for(file_path)):
+                if self.registry.contains(dataset_id):
+                    logger.info("Dataset %s was ingested by another worker, reusing it", dataset_id)
+                    self.registry.bind(session_id, dataset_id)
+                    return self.get_csv_info(session_id)
+                logger.info("Ingesting upload into %s", file_path)
+                if wants_parts(file_path, size):
+                    return self._ingest_parts(source, filename, file_path, dataset_id, session_id)
+                with span("csv_parse"), open(file_path, "wb") as sink:
+                    tee = TeeReader(source, sink)
+                    df = read_csv_chunked(tee)
+                    tee.drain()
+                with span("cache_write"):
+                    write_cache(df, cache_path_for(file_path))
+                with span("cache_read"):
+                    df = read_cache(cache_path_for(file_path))
+                dataset = self.registry.register(dataset_id, os.path.basename(filename), file_path, df)
+            self.registry.bind(session_id, dataset_id)
+            logger.info("Ingested upload", extra={"dataset_id": dataset_id, "bytes": tee.bytes_read,
+                                                  "rows": df.shape[0], "columns": df.shape[1]})
+            self.row_index.schedule(dataset.version, df, dataset.index_path, dataset.cache_path)
+
+            return self.get_csv_info(session_id)
         except Exception as e:
-            print(f"Error loading CSV: {str(e)}")
+            logger.exception("Error ingesting CSV")
             raise Exception(f"Error loading CSV: {str(e)}")
-    
-    def get_csv_info(self) -> Optional[Dict]:
-        """Get information about the loaded CSV"""
-        # If we currently have no DataFrame, attempt to reload any persisted state from disk
-        if self.df is None:
-            try:
-                self._load_last_uploaded()
-            except Exception:
-                pass
-        if self.df is None:
+
+    def _ingest_parts(self, source: IO[bytes], filename: str, file_path: str,
+                      dataset_id: str, session_id: str) -> Dict:
+        """Save an out-of-core upload while splitting it into parts; called
+        with the dataset lock held. No row index is built for it."""
+        with span("csv_parse"), open(file_path, "wb") as sink:
+            tee = TeeReader(source, sink)
+            store, profile = write_parts(tee, parts_path_for(file_path))
+        save_profile(profile, profile_path_for(file_path))
+        self.registry.register(dataset_id, os.path.basename(filename), file_path)
+        self.registry.bind(session_id, dataset_id)
+        logger.info("Ingested upload out of core", extra={
+            "dataset_id": dataset_id, "bytes": tee.bytes_read, "rows": store.rows,
+            "columns": len(store.columns), "parts": len(store.files)})
+        return self.get_csv_info(session_id)
+
+    def load_csv(self, file_path: str, session_id: str = "default") -> Dict:
+        """Register a CSV already on disk and return basic information"""
+        try:
+            logger.info("Loading CSV from path %s", file_path)
+            with open(file_path, "rb") as f:
+                dataset_id = content_hash(f)
+            self.registry.register(dataset_id, os.path.basename(file_path), file_path)
+            self.registry.bind(session_id, dataset_id)
+
+            return self.get_csv_info(session_id)
+        except Exception as e:
+            logger.exception("Error loading CSV %s", file_path)
+            raise Exception(f"Error loading CSV: {str(e)}")
+
+    def release_session(self, session_id: str = "default"):
+        """Drop a session's dataset binding; the dataset stays registered"""
+        self.registry.unbind(session_id)
+
+    def _resolve(self, session_id: str):
+        """Return the session's dataset and its (lazily loaded) DataFrame; for
+        an out-of-core dataset, the first part stands in for the frame"""
+        dataset = self.registry.dataset_for_session(session_id)
+        if dataset is None:
+            return None, None
+        try:
+            if dataset.out_of_core:
+                return dataset, self.registry.get_parts(dataset).sample
+            return dataset, self.registry.get_dataframe(dataset)
+        except Exception as e:
+            logger.error("Error loading dataset %s: %s", dataset.dataset_id, e)
+            return None, None
+
+    def get_csv_info(self, session_id: str = "default") -> Optional[Dict]:
+        """Get information about the session's CSV from its precomputed profile"""
+        dataset = self.registry.dataset_for_session(session_id)
+        if dataset is None:
             return None
-        
+        try:
+            profile = self.registry.get_profile(dataset)
+        except Exception as e:
+            logger.error("Error loading dataset %s: %s", dataset.dataset_id, e)
+            return None
+
         return {
-            "filename": self.filename,
-            "rows": len(self.df),
-            "columns": len(self.df.columns),
-            "column_names": self.df.columns.tolist(),
-            "dtypes": {col: str(dtype) for col, dtype in self.df.dtypes.items()},
-            "memory_usage": f"{self.df.memory_usage(deep=True).sum() / 1024 / 1024:.2f} MB"
+            "dataset_id": dataset.dataset_id,
+            # Changes when the CSV does (e.g. rows appended); keys derived caches
+            "version": dataset.version,
+            # Kept on disk in parts; queries scan it, retrieval is unavailable
+            "out_of_core": dataset.out_of_core,
+            "filename": dataset.filename,
+            "rows": profile["rows"],
+            "columns": profile["columns"],
+            "column_names": profile["column_names"],
+            "dtypes": profile["dtypes"],
+            "memory_usage": f"{profile['memory_bytes'] / 1024 / 1024:.2f} MB",
+            "column_stats": profile["column_stats"],
+            "sample_rows": profile["sample_rows"],
         }
-    
-    def get_preview(self, rows: int = 10) -> Optional[List[Dict]]:
+
+    def get_preview(self, rows: int = 10, session_id: str = "default") -> Optional[List[Dict]]:
         """Get a preview of the CSV data"""
-        # Ensure we attempt to reload a persisted CSV if the service is currently empty
-        if self.df is None:
+        dataset, df = self._resolve(session_id)
+        if df is None:
             return None
-        
-        preview_df = self.df.head(rows)
+
+        if dataset.out_of_core:
+            preview_df = self.registry.get_parts(dataset).slice(0, rows)
+        else:
+            preview_df = df.head(rows)
         return preview_df.to_dict(orient='records')
-    
-    def get_dataframe(self) -> Optional[pd.DataFrame]:
-        """Get the loaded DataFrame"""
-        # Make an attempt to reload persisted CSV if needed
-        if self.df is None:
+
+    def get_page(self, session_id: str = "default", offset: int = 0, limit: int = 50,
+                 sort: Optional[str] = None, descending: bool = False,
+                 filters: Optional[List[str]] = None, fmt: str = "json") -> Optional[bytes]:
+        """A page of rows in columnar form, optionally filtered and sorted,
+        encoded as JSON ({"columns", "data": {column: values}, "offset",
+        "limit", "rows", "total"}) or, with fmt "arrow", as an Arrow IPC
+        stream carrying the same counts in its schema metadata.
+
+        Sort orders come from per-column sort indexes built on first use, and
+        the filtered order is cached, so paging through the same view only
+        slices positions. Out-of-core datasets are scanned part by part
+        instead (see _out_of_core_page). Raises ValueError for unknown
+        columns or filters.
+        """
+        if fmt not in ("json", "arrow"):
+            raise ValueError(f"Unsupported format: {fmt}")
+        dataset, df = self._resolve(session_id)
+        if df is None:
+            return None
+        if sort is not None and sort not in df.columns:
+            raise ValueError(f"Unknown column: {sort}")
+        try:
+            parsed = [parse_filter(f) for f in filters or []]
+            for f in parsed:
+                if f.column not in df.columns:
+                    raise QueryError(f"Unknown column: {f.column}")
+        except QueryError as e:
+            raise ValueError(str(e)) from e
+        offset = max(0, offset)
+        limit = max(0, min(limit, MAX_PAGE_ROWS))
+
+        if dataset.out_of_core:
+            page, total = self._out_of_core_page(dataset, offset, limit, sort, descending, parsed)
+        else:
+            positions = self._row_order(dataset, df, sort, descending, parsed)
+            if positions is None:
+                total = len(df)
+                page = df.iloc[offset:offset + limit]
+            else:
+                total = len(positions)
+                page = take_rows(df, positions[offset:offset + limit])
+
+        meta = {"offset": offset, "limit": limit, "rows": len(page), "total": total}
+        with span("serialization"):
+            if fmt == "arrow":
+                return table_bytes(to_table(page, meta))
+            return columnar_json(page, meta)
+
+    def _row_order(self, dataset, df: pd.DataFrame, sort: Optional[str], descending: bool,
+                   filters: List) -> Optional[np.ndarray]:
+        """Row positions for a sorted and/or filtered view; None for the natural order."""
+        if sort is None and not filters:
+            return None
+        key = (sort, descending, tuple((f.column, f.op, f.value) for f in filters))
+        positions = self.registry.row_order(dataset, key)
+        if positions is not None:
+            return positions
+
+        if sort is not None:
+            index, n_valid = self.registry.sort_index(dataset, sort)
+            positions = ordered_positions(index, n_valid, descending)
+        if filters:
             try:
-                self._load_last_uploaded()
-            except Exception:
-                pass
-        return self.df
-    
-    def query_data(self, query: str) -> str:
+                matched = self.query_engine.filter_positions(df, filters, self._lookup(dataset, df))
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Filter does not match the column type: {e}") from e
+            if positions is None:
+                positions = matched
+            else:
+                mask = np.zeros(len(df), dtype=bool)
+                mask[matched] = True
+                positions = positions[mask[positions]]
+        self.registry.store_row_order(dataset, key, positions)
+        return positions
+
+    def _out_of_core_page(self, dataset, offset: int, limit: int, sort: Optional[str],
+                          descending: bool, filters: List) -> Tuple[pd.DataFrame, int]:
+        """A page of an out-of-core dataset and the matching row count. Plain
+        pages read only the parts they span; filtered ones count matches per
+        part once (cached like a row order) and then read only the parts
+        holding the page; sorted ones keep each part's best rows."""
+        store = self.registry.get_parts(dataset)
+        if sort is not None:
+            return self.chunked.sorted_slice(store, filters, sort, descending, offset, offset + limit)
+        if not filters:
+            return store.slice(offset, offset + limit), store.rows
+        key = ("matches", tuple((f.column, f.op, f.value) for f in filters))
+        counts = self.registry.row_order(dataset, key)
+        if counts is None:
+            counts = self.chunked.match_counts(store, filters)
+            self.registry.store_row_order(dataset, key, counts)
+        page = self.chunked.filtered_slice(store, filters, counts, offset, offset + limit)
+        return page, int(counts.sum())
+
+    def retrieve_rows(self, query: str, session_id: str = "default", k: int = 5) -> Optional[pd.DataFrame]:
+        """Rows most relevant to `query` from the session's row index, best
+        first. None if no dataset is loaded, it is out of core (no index is
+        built for those) or its index is not ready yet; a missing index is
+        scheduled for a background build."""
+        dataset, df = self._resolve(session_id)
+        if df is None or dataset.out_of_core:
+            return None
+        index = self.row_index.get(dataset.version, dataset.index_path, dataset.cache_path, len(df))
+        if index is None:
+            self.row_index.schedule(dataset.version, df, dataset.index_path, dataset.cache_path)
+            return None
+        rows = self.row_index.search(index, df, query, k)
+        return df.iloc[rows]
+
+    def get_dataframe(self, session_id: str = "default") -> Optional[pd.DataFrame]:
+        """Get the session's DataFrame; None for an out-of-core dataset"""
+        dataset, df = self._resolve(session_id)
+        return None if dataset is not None and dataset.out_of_core else df
+
+    def get_schema_frame(self, session_id: str = "default") -> Optional[pd.DataFrame]:
+        """The frame questions are parsed against: the whole DataFrame, or the
+        first part of an out-of-core dataset"""
+        _, df = self._resolve(session_id)
+        return df
+
+    def answer_query(self, query: str, session_id: str = "default") -> Optional[str]:
+        """Answer a data question exactly with pandas; None if the question
+        could not be parsed into a query plan."""
+        dataset, df = self._resolve(session_id)
+        if df is None:
+            return None
+        plan = self.query_engine.parse(query, df, dataset_key=dataset.version)
+        if plan is None:
+            return None
+        try:
+            result = self._execute(dataset, df, plan)
+        except QueryError as e:
+            logger.info("Query plan rejected (%s): %s", plan.to_dict(), e)
+            return None
+        return self.query_engine.format_result(plan, result)
+
+    def execute_plan(self, plan: QueryPlan, session_id: str = "default") -> Optional[str]:
+        """Execute a model-written plan over the session's full dataset.
+        Raises QueryError if the plan is invalid or exceeds its bounds."""
+        dataset, df = self._resolve(session_id)
+        if df is None:
+            return None
+        result = self._execute(dataset, df, plan)
+        return self.query_engine.format_result(plan, result)
+
+    def _execute(self, dataset, df: pd.DataFrame, plan: QueryPlan):
+        if dataset.out_of_core:
+            return self.chunked.execute(self.registry.get_parts(dataset), plan)
+        return self.query_engine.execute(df, plan, lookup=self._lookup(dataset, df))
+
+    def _lookup(self, dataset, df: pd.DataFrame):
+        """Answers filters on `df` from the dataset's column indexes."""
+        return functools.partial(self.registry.lookup, dataset, df)
+
+    def query_data(self, query: str, session_id: str = "default") -> str:
         """Execute a query and return results as string"""
-        # Attempt to reload any persisted CSV file if no DataFrame is present
-        if self.df is None:
-            try:
-                self._load_last_uploaded()
-            except Exception:
-                pass
-        if self.df is None:
+        if self.get_schema_frame(session_id) is None:
             return "No CSV file is loaded."
 
         try:
-            query = query.lower()
-            if ("count" in query or "how many" in query) and "female" in query:
-                return str(len(self.df[self.df['Gender'] == 'Female']))
-            elif "average" in query and "salary" in query:
-                return str(self.df['Salary'].mean())
-            elif "total" in query and "revenue" in query:
-                return str(self.df['Revenue'].sum())
-            else:
+            answer = self.answer_query(query, session_id)
+            if answer is None:
                 return "Query not recognized. Please refine your question."
+            return answer
         except Exception as e:
             return f"Error executing query: {str(e)}"
-    
-    def convert_to_json(self) -> Optional[str]:
-        """Convert the loaded CSV file to JSON format"""
-        if self.df is None:
+
+    def convert_to_json(self, session_id: str = "default", max_chars: Optional[int] = None) -> Optional[str]:
+        """Convert the session's CSV to JSON format. With `max_chars` only the
+        leading rows needed to fill that many characters are serialized."""
+        dataset, df = self._resolve(session_id)
+        if df is None:
             return "No CSV file is loaded."
 
         try:
-            json_data = self.df.to_json(orient='records')
-            print(f"Converted CSV to JSON: {json_data[:100]}...")  # Log first 100 characters for debugging
-            return json_data
+            with span("serialization"):
+                if max_chars is not None:
+                    return json_excerpt(df, max_chars)
+                if dataset.out_of_core:
+                    return "The dataset is too large to convert at once; use /api/export."
+                return df.to_json(orient='records')
         except Exception as e:
-            print(f"Error converting CSV to JSON: {str(e)}")
+            logger.exception("Error converting CSV to JSON")
             return f"Error converting CSV to JSON: {str(e)}"
 
-    def _current_csv_state_file(self) -> str:
-        return os.path.join(self.UPLOAD_DIR, "current_csv.json")
+    def export_records(self, session_id: str = "default", fmt: str = "ndjson",
+                       columns: Optional[List[str]] = None, start: int = 0,
+                       limit: Optional[int] = None, gzip: bool = False) -> Optional[Iterator[bytes]]:
+        """Stream the session's rows as NDJSON, a JSON array or (fmt "arrow")
+        an Arrow IPC stream, optionally restricted to `columns` and the row
+        range [start, start + limit). Raises ValueError for unknown columns,
+        formats or ranges."""
+        dataset, df = self._resolve(session_id)
+        if df is None:
+            return None
+        if columns:
+            missing = [c for c in columns if c not in df.columns]
+            if missing:
+                raise ValueError(f"Unknown columns: {', '.join(missing)}")
+        if start < 0 or (limit is not None and limit < 0):
+            raise ValueError("start and limit must not be negative")
 
-    def _write_current_csv_path(self, file_path: str):
-        try:
-            import json
-            state = {"file_path": file_path}
-            with open(self._current_csv_state_file(), "w", encoding="utf-8") as f:
-                json.dump(state, f)
-                print(f"Wrote current CSV state to {self._current_csv_state_file()}")
-        except Exception as e:
-            print(f"Error writing current csv state: {e}")
+        if fmt != "arrow" and fmt not in FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+
+        stop = None if limit is None else start + limit
+        if dataset.out_of_core:
+            # Parts are read one at a time, only the requested columns
+            store = self.registry.get_parts(dataset)
+            rows = store.iter_frames(columns, start, stop)
+        else:
+            # The row slice is a view; columns are selected per chunk while serializing
+            rows = df.iloc[start:stop]
+        if fmt == "arrow":
+            if dataset.out_of_core:
+                # Parts may be downcast differently; the empty sample gives
+                # an empty range its schema
+                rows = itertools.chain(rows, [store.sample.iloc[:0]])
+            chunks = iter_stream(rows, columns, widen=dataset.out_of_core)
+        else:
+            chunks = iter_records(rows, fmt, columns)
+        chunks = timed_iter("serialization", chunks)
+        return gzip_stream(chunks) if gzip else chunks
 
     def _load_last_uploaded(self):
-        # Attempt to load last uploaded CSV if it exists
+        # Migrate the single-file state written by older versions into the registry
         try:
-            import json
-            state_file = self._current_csv_state_file()
+            state_file = os.path.join(self.UPLOAD_DIR, "current_csv.json")
             if os.path.exists(state_file):
                 with open(state_file, "r", encoding="utf-8") as f:
                     state = json.load(f)
-                    file_path = state.get("file_path")
-                    if file_path and os.path.exists(file_path):
-                        print(f"Found last uploaded CSV: {file_path}, attempting to load")
-                        self.load_csv(file_path)
+                file_path = state.get("file_path")
+                if file_path and os.path.exists(file_path):
+                    logger.info("Found last uploaded CSV %s, registering it", file_path)
+                    self.load_csv(file_path)
+                os.remove(state_file)
         except Exception as e:
-            print(f"Error loading last uploaded CSV: {e}")
+            logger.error("Error loading last uploaded CSV: %s", e)
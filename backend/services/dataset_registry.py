@@ -0,0 +1,572 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from utils.columnar_cache import (
+    MAX_CACHE_SEGMENTS,
+    append_segment,
+    cache_path_for,
+    cache_rows,
+    combine_chunks,
+    is_cache_fresh,
+    read_cache,
+    read_csv_chunked,
+    read_csv_tail,
+    segment_paths,
+    write_cache,
+)
+from utils.bm25_index import index_path_for
+from utils.chunked_store import (
+    PartStore,
+    append_parts,
+    meta_path_for,
+    parts_path_for,
+    wants_parts,
+    write_parts,
+)
+from utils.dataset_profile import (
+    ProfileBuilder,
+    build_profile,
+    load_builder,
+    load_profile,
+    profile_path_for,
+    profile_state_path_for,
+    save_builder,
+    save_profile,
+)
+from utils.fingerprint import APPENDED, UNCHANGED, Fingerprint, compare, fingerprint
+from utils.metrics import span
+from utils.shared_state import connect, file_lock, lock_path_for
+from utils.secondary_index import (
+    INDEX_OPS,
+    SORTED,
+    build_index,
+    choose_kind,
+    index_dir_for,
+    index_path,
+    load_index,
+    save_index,
+)
+
+logger = logging.getLogger(__name__)
+
+# Total size of DataFrames kept in memory before cold ones are evicted
+MEMORY_BUDGET_MB = int(os.environ.get("CSVAI_DATASET_MEMORY_MB", "2048"))
+# Filtered/sorted row orders kept per dataset for paging
+ROW_ORDER_CACHE = 8
+# Registrations and session bindings shared by every worker process
+STATE_DB = "state.sqlite3"
+# Session of clients that send no session id; the only one that falls back
+# to the latest upload when nothing is bound to it
+DEFAULT_SESSION = "default"
+
+
+class Dataset:
+    """A registered dataset: its source CSV, its columnar cache and, while
+    resident, the loaded DataFrame."""
+
+    def __init__(self, dataset_id: str, filename: str, file_path: str):
+        self.dataset_id = dataset_id
+        self.filename = filename
+        self.file_path = file_path
+        self.df: Optional[pd.DataFrame] = None
+        # Out-of-core datasets are scanned from their parts instead
+        self.parts: Optional[PartStore] = None
+        self.profile: Optional[Dict] = None
+        self.nbytes = 0
+        self.last_access = 0.0
+        # The CSV as it was when the frame was loaded; None if it is gone
+        self.source: Optional[Fingerprint] = None
+        # Lazily built column indexes by (kind, column), None where a column
+        # cannot have one, and recent filtered row orders
+        self.indexes: Dict[Tuple[str, str], object] = {}
+        self.row_orders: "OrderedDict[Tuple, np.ndarray]" = OrderedDict()
+        # Held while the frame or parts are loaded, refreshed or released, so
+        # a slow load only blocks requests for this dataset
+        self.lock = threading.RLock()
+
+    @property
+    def cache_path(self) -> str:
+        return cache_path_for(self.file_path)
+
+    @property
+    def profile_path(self) -> str:
+        return profile_path_for(self.file_path)
+
+    @property
+    def profile_state_path(self) -> str:
+        return profile_state_path_for(self.file_path)
+
+    @property
+    def index_path(self) -> str:
+        return index_path_for(self.file_path)
+
+    @property
+    def indexes_path(self) -> str:
+        return index_dir_for(self.file_path)
+
+    @property
+    def parts_path(self) -> str:
+        return parts_path_for(self.file_path)
+
+    @property
+    def meta_path(self) -> str:
+        return meta_path_for(self.file_path)
+
+    @property
+    def out_of_core(self) -> bool:
+        """Stored as parts because the CSV is too large to load whole."""
+        return wants_parts(self.file_path)
+
+    @property
+    def lock_path(self) -> str:
+        """Held while the dataset's files are written or rebuilt."""
+        return lock_path_for(self.file_path)
+
+    @property
+    def available(self) -> bool:
+        return any(os.path.exists(path) for path in (self.file_path, self.cache_path, self.meta_path))
+
+    @property
+    def loaded(self) -> bool:
+        return self.df is not None or self.parts is not None
+
+    @property
+    def version(self) -> str:
+        """Identifies the dataset's current content, for keying caches of
+        anything derived from it; the same in every worker process."""
+        if self.source is None:
+            self.source = fingerprint(self.file_path)
+        return f"{self.dataset_id}:{self.source.digest}" if self.source else self.dataset_id
+
+    def release(self):
+        """Drop the DataFrame and everything derived from its rows."""
+        self.df = None
+        self.parts = None
+        self.nbytes = 0
+        self.indexes.clear()
+        self.row_orders.clear()
+
+
+class DatasetRegistry:
+    """Datasets keyed by content hash, with per-session binding and an LRU
+    memory budget. Evicted datasets are memory-mapped back from their cache
+    on next access.
+
+    Registrations and session bindings live in a SQLite database in the
+    upload directory, so every worker process serving the app sees the same
+    datasets and sessions; only the loaded frames are per process, and those
+    are mapped from the shared columnar cache.
+
+    The registry lock only guards the entries and the LRU order; loading a
+    dataset (possibly a full reparse) happens under that dataset's own lock.
+
+    CSVs too large to load whole (see wants_parts) are kept as a store of
+    columnar parts instead and never get a DataFrame; only their first part
+    counts against the memory budget.
+    """
+
+    def __init__(self, upload_dir: str, memory_budget_mb: int = MEMORY_BUDGET_MB):
+        self.upload_dir = upload_dir
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.db_path = os.path.join(upload_dir, STATE_DB)
+        self._datasets: "OrderedDict[str, Dataset]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._db = connect(self.db_path)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS datasets ("
+            "dataset_id TEXT PRIMARY KEY, filename TEXT NOT NULL, file_path TEXT NOT NULL, "
+            "last_used REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, dataset_id TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);"
+        )
+
+    # Registration and session binding
+
+    def register(self, dataset_id: str, filename: str, file_path: str,
+                 df: Optional[pd.DataFrame] = None) -> Dataset:
+        """Add a dataset (or return the existing one with the same content)."""
+        with self._lock:
+            now = time.time()
+            with self._db:
+                self._db.execute("INSERT OR IGNORE INTO datasets VALUES (?, ?, ?, ?)",
+                                 (dataset_id, filename, file_path, now))
+                self._db.execute("UPDATE datasets SET last_used = ? WHERE dataset_id = ?", (now, dataset_id))
+                self._db.execute("INSERT OR REPLACE INTO state VALUES ('current', ?)", (dataset_id,))
+            dataset = self._datasets.get(dataset_id)
+            if dataset is None:
+                dataset = self._datasets[dataset_id] = Dataset(dataset_id, filename, file_path)
+            self._datasets.move_to_end(dataset_id)
+        if df is not None:
+            with dataset.lock:
+                if dataset.df is None:
+                    self._set_frame(dataset, df)
+                    dataset.source = fingerprint(dataset.file_path)
+        return dataset
+
+    def contains(self, dataset_id: str) -> bool:
+        with self._lock:
+            return self._dataset(dataset_id) is not None
+
+    def bind(self, session_id: str, dataset_id: str):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (session_id, dataset_id))
+            self._db.execute("UPDATE datasets SET last_used = ? WHERE dataset_id = ?", (time.time(), dataset_id))
+
+    def unbind(self, session_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def dataset_for_session(self, session_id: str) -> Optional[Dataset]:
+        """Dataset bound to the session, or None. Only the "default" session
+        used by clients that send no session id falls back to the latest
+        upload; other sessions never see a dataset they did not load."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT dataset_id FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            dataset = self._dataset(row[0]) if row else None
+            if dataset is None and session_id == DEFAULT_SESSION:
+                row = self._db.execute("SELECT value FROM state WHERE key = 'current'").fetchone()
+                dataset = self._dataset(row[0]) if row else None
+            return dataset
+
+    def recent(self, limit: int) -> List[Dataset]:
+        """Up to `limit` datasets, most recently used first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT dataset_id FROM datasets ORDER BY last_used DESC").fetchall()
+            datasets = (self._dataset(dataset_id) for (dataset_id,) in rows)
+            return [d for d in datasets if d is not None][:max(0, limit)]
+
+    def _dataset(self, dataset_id: str) -> Optional[Dataset]:
+        """The dataset's in-process entry, created from the shared state when
+        another worker registered it. Datasets whose files are gone are skipped."""
+        dataset = self._datasets.get(dataset_id)
+        if dataset is None:
+            row = self._db.execute(
+                "SELECT filename, file_path FROM datasets WHERE dataset_id = ?", (dataset_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            dataset = Dataset(dataset_id, *row)
+            if not dataset.available:
+                return None
+            self._datasets[dataset_id] = dataset
+        return dataset
+
+    # Loading and eviction
+
+    def get_dataframe(self, dataset: Dataset) -> Optional[pd.DataFrame]:
+        """Return the dataset's DataFrame, loading it lazily if evicted and
+        bringing it up to date if its CSV changed. None for out-of-core
+        datasets, which are never loaded whole (see get_parts)."""
+        if dataset.out_of_core:
+            return None
+        with dataset.lock:
+            if dataset.df is None:
+                self._load(dataset)
+            else:
+                self._refresh(dataset)
+            df = dataset.df
+        self._touch(dataset)
+        return df
+
+    def get_parts(self, dataset: Dataset) -> PartStore:
+        """Return an out-of-core dataset's part store, writing the parts if
+        missing and bringing them up to date if its CSV changed."""
+        with dataset.lock:
+            if dataset.parts is None:
+                self._load_parts(dataset)
+            else:
+                self._refresh_parts(dataset)
+            parts = dataset.parts
+        self._touch(dataset)
+        return parts
+
+    def get_profile(self, dataset: Dataset) -> Dict:
+        """Return the dataset profile, from memory or disk when possible and
+        otherwise computed from the (lazily loaded) DataFrame."""
+        with dataset.lock:
+            if dataset.out_of_core:
+                self.get_parts(dataset)
+                return dataset.profile
+            if dataset.loaded or not is_cache_fresh(dataset.file_path, dataset.cache_path):
+                self.get_dataframe(dataset)
+            if dataset.profile is None:
+                dataset.profile = load_profile(dataset.profile_path, dataset.cache_path)
+            if dataset.profile is None:
+                self.get_dataframe(dataset)
+            return dataset.profile
+
+    def sort_index(self, dataset: Dataset, column: str) -> Tuple[np.ndarray, int]:
+        """Ascending sort index of a column (positions, non-null count)."""
+        index = self.column_index(dataset, column, SORTED)
+        return index.positions, index.n_valid
+
+    def column_index(self, dataset: Dataset, column: str, kind: str):
+        """A secondary index of `kind` over a column, or None if the column
+        cannot have one. Built on first use and saved next to the columnar
+        cache, so other workers and later runs memory-map it; kept with the
+        DataFrame until it is evicted."""
+        key = (kind, column)
+        with self._lock:
+            if key in dataset.indexes:
+                return dataset.indexes[key]
+        df = self.get_dataframe(dataset)
+        path = index_path(dataset.indexes_path, kind, column)
+        index = load_index(path, dataset.cache_path, len(df))
+        if index is None:
+            # One worker process builds; the others wait and map what it saved.
+            # Each index has its own lock, so builds do not queue behind the
+            # search index being written under the dataset's lock
+            os.makedirs(dataset.indexes_path, exist_ok=True)
+            with file_lock(lock_path_for(path)):
+                index = load_index(path, dataset.cache_path, len(df))
+                if index is None:
+                    with span("index_build"):
+                        built = build_index(kind, df[column])
+                    if built is not None:
+                        save_index(built, path)
+                        index = load_index(path, dataset.cache_path, len(df)) or built
+                        logger.info("Built %s index on %s for dataset %s", kind, column,
+                                    dataset.dataset_id)
+        with self._lock:
+            if dataset.df is df and key not in dataset.indexes:
+                dataset.indexes[key] = index
+                dataset.nbytes += index.nbytes if index is not None else 0
+        return index
+
+    def lookup(self, dataset: Dataset, df: pd.DataFrame, filters: List) -> Optional[Tuple[np.ndarray, bool]]:
+        """Answer filters on one column from a column index: the ascending
+        positions of matching rows and whether they match every filter
+        exactly (not for hash candidates or filters no index serves). None
+        when no index applies, the lookup is not selective enough or `df`
+        is no longer current."""
+        column = filters[0].column
+        usable = [f for f in filters if f.op in INDEX_OPS]
+        stats = (dataset.profile or {}).get("column_stats", {}).get(column)
+        kind = choose_kind(df[column], [f.op for f in usable], stats)
+        if kind is None:
+            return None
+        index = self.column_index(dataset, column, kind)
+        if index is None or index.rows != len(df):
+            return None
+        try:
+            found = index.lookup([(f.op, f.value) for f in usable])
+        except (TypeError, ValueError, OverflowError):
+            # Left to the scan, which reports the mismatch
+            return None
+        if found is None:
+            return None
+        positions, exact = found
+        return positions, exact and len(usable) == len(filters)
+
+    def row_order(self, dataset: Dataset, key: Tuple) -> Optional[np.ndarray]:
+        """A recently computed filtered/sorted row order, if still cached."""
+        with self._lock:
+            positions = dataset.row_orders.get(key)
+            if positions is not None:
+                dataset.row_orders.move_to_end(key)
+            return positions
+
+    def store_row_order(self, dataset: Dataset, key: Tuple, positions: np.ndarray):
+        """Keep a row order for paging, dropping the oldest beyond ROW_ORDER_CACHE."""
+        with self._lock:
+            if not dataset.loaded or key in dataset.row_orders:
+                return
+            dataset.row_orders[key] = positions
+            dataset.nbytes += positions.nbytes
+            while len(dataset.row_orders) > ROW_ORDER_CACHE:
+                _, dropped = dataset.row_orders.popitem(last=False)
+                dataset.nbytes -= dropped.nbytes
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(d.nbytes for d in self._datasets.values() if d.loaded)
+
+    def _load(self, dataset: Dataset):
+        cache_path = dataset.cache_path
+        if not is_cache_fresh(dataset.file_path, cache_path):
+            self._rebuild_cache(dataset)
+        with span("cache_read"):
+            df = read_cache(cache_path)
+        self._set_frame(dataset, df)
+        dataset.source = fingerprint(dataset.file_path)
+        logger.info("Loaded dataset %s (%.2f MB)", dataset.dataset_id, dataset.nbytes / 1024 / 1024)
+
+    def _refresh(self, dataset: Dataset):
+        """Check a loaded dataset's CSV for changes: one stat call when there
+        are none, only the new rows parsed when it was appended to, a full
+        reload when it was rewritten."""
+        if dataset.source is None:
+            return
+        change, current = compare(dataset.source)
+        if change == UNCHANGED:
+            dataset.source = current
+        elif change == APPENDED:
+            self._append_rows(dataset, dataset.source, current)
+        else:
+            logger.info("Dataset file %s changed, reloading it", dataset.file_path)
+            dataset.release()
+            dataset.profile = None
+            self._load(dataset)
+
+    def _append_rows(self, dataset: Dataset, previous: Fingerprint, current: Fingerprint):
+        """Add the rows appended to the CSV to the frame. Only they are parsed,
+        cached as a segment next to the columnar cache and added to the saved
+        profile state, so this costs time in the new rows, except when
+        MAX_CACHE_SEGMENTS are merged into the cache, the profile state is
+        first built (from the frame) or the cache no longer holds the rows
+        the frame was loaded from. The frame is still concatenated in memory.
+        A worker that finds the cache already updated by another just maps it."""
+        df = None
+        with file_lock(dataset.lock_path):
+            cache_path = dataset.cache_path
+            if not is_cache_fresh(dataset.file_path, cache_path):
+                rows = len(dataset.df)
+                with span("csv_parse"):
+                    tail = read_csv_tail(dataset.file_path, previous.size, current.size,
+                                         list(dataset.df.columns))
+                df = combine_chunks([dataset.df, tail]).reset_index(drop=True)
+                with span("profile"):
+                    builder = load_builder(dataset.profile_state_path, rows, cache_path)
+                    if builder is None:
+                        builder = ProfileBuilder()
+                        builder.add(dataset.df)
+                    builder.add(tail)
+                    profile = builder.profile()
+                # Typed as the combined frame is, not as each chunk was
+                profile["dtypes"] = {str(col): str(dtype) for col, dtype in df.dtypes.items()}
+                for col, dtype in profile["dtypes"].items():
+                    profile["column_stats"][col]["dtype"] = dtype
+                with span("cache_write"):
+                    if (os.path.exists(cache_path) and cache_rows(cache_path) == rows
+                            and len(segment_paths(cache_path)) + 1 < MAX_CACHE_SEGMENTS):
+                        append_segment(tail, cache_path)
+                    else:
+                        write_cache(df, cache_path)
+                        # Mapped from the cache below instead
+                        df = None
+                save_builder(builder, dataset.profile_state_path)
+                save_profile(profile, dataset.profile_path)
+                logger.info("Appended %d rows to dataset %s", len(tail), dataset.dataset_id)
+        dataset.profile = None
+        if df is None:
+            with span("cache_read"):
+                df = read_cache(cache_path)
+        self._set_frame(dataset, df)
+        dataset.source = current
+
+    def _load_parts(self, dataset: Dataset):
+        if not is_cache_fresh(dataset.file_path, dataset.meta_path):
+            self._rebuild_parts(dataset)
+        dataset.release()
+        dataset.parts = PartStore.open(dataset.parts_path)
+        if dataset.profile is None:
+            dataset.profile = load_profile(dataset.profile_path, dataset.meta_path)
+        if dataset.profile is None:
+            dataset.profile = dataset.parts.load_builder().profile()
+            save_profile(dataset.profile, dataset.profile_path)
+        # Only the sample part is ever held; the rest is mapped in per scan
+        dataset.nbytes = int(dataset.parts.sample.memory_usage(deep=True).sum())
+        dataset.source = fingerprint(dataset.file_path)
+        logger.info("Opened out-of-core dataset %s (%d parts, %d rows)", dataset.dataset_id,
+                    len(dataset.parts.files), dataset.parts.rows)
+
+    def _refresh_parts(self, dataset: Dataset):
+        """Like _refresh, for a dataset stored as parts: appended rows become
+        new parts, a rewritten CSV is split into parts again."""
+        if dataset.source is None:
+            return
+        change, current = compare(dataset.source)
+        if change == UNCHANGED:
+            dataset.source = current
+            return
+        if change == APPENDED:
+            with file_lock(dataset.lock_path):
+                if not is_cache_fresh(dataset.file_path, dataset.meta_path):
+                    with span("csv_parse"):
+                        store, profile = append_parts(dataset.parts, dataset.file_path,
+                                                      dataset.source.size, current.size)
+                    save_profile(profile, dataset.profile_path)
+                    logger.info("Appended %d rows to dataset %s",
+                                store.rows - dataset.parts.rows, dataset.dataset_id)
+        else:
+            logger.info("Dataset file %s changed, splitting it again", dataset.file_path)
+        dataset.profile = None
+        self._load_parts(dataset)
+
+    def _rebuild_parts(self, dataset: Dataset):
+        """Split the CSV into parts, one chunk in memory at a time; under the
+        dataset lock, like _rebuild_cache."""
+        if not os.path.exists(dataset.file_path):
+            raise FileNotFoundError(f"Dataset file not found: {dataset.file_path}")
+        dataset.profile = None
+        with file_lock(dataset.lock_path):
+            if is_cache_fresh(dataset.file_path, dataset.meta_path):
+                return
+            logger.info("Parts missing or stale, splitting %s", dataset.file_path)
+            with span("csv_parse"):
+                _, profile = write_parts(dataset.file_path, dataset.parts_path)
+            save_profile(profile, dataset.profile_path)
+
+    def _rebuild_cache(self, dataset: Dataset):
+        """Reparse the CSV into its columnar cache. The dataset lock keeps
+        other workers from reparsing it at the same time; whoever waited on
+        it reads the cache the first one wrote."""
+        if not os.path.exists(dataset.file_path):
+            raise FileNotFoundError(f"Dataset file not found: {dataset.file_path}")
+        dataset.profile = None
+        with file_lock(dataset.lock_path):
+            if is_cache_fresh(dataset.file_path, dataset.cache_path):
+                return
+            logger.info("Cache missing or stale, reparsing %s", dataset.file_path)
+            with span("csv_parse"):
+                df = read_csv_chunked(dataset.file_path)
+            with span("cache_write"):
+                write_cache(df, dataset.cache_path)
+
+    def _set_frame(self, dataset: Dataset, df: pd.DataFrame):
+        """Install a loaded frame; called under the dataset's lock."""
+        dataset.release()
+        dataset.df = df
+        if dataset.profile is None:
+            dataset.profile = load_profile(dataset.profile_path, dataset.cache_path)
+        if dataset.profile is None:
+            with span("profile"):
+                dataset.profile = build_profile(df)
+            save_profile(dataset.profile, dataset.profile_path)
+        dataset.nbytes = dataset.profile["memory_bytes"]
+        dataset.last_access = time.time()
+
+    def _touch(self, dataset: Dataset):
+        """Mark a dataset most recently used and evict others over budget."""
+        with self._lock:
+            dataset.last_access = time.time()
+            if dataset.dataset_id in self._datasets:
+                self._datasets.move_to_end(dataset.dataset_id)
+            self._enforce_budget(keep=dataset.dataset_id)
+
+    def _enforce_budget(self, keep: Optional[str] = None):
+        """Evict least-recently-used DataFrames until under budget. Datasets
+        another thread is loading or refreshing are skipped rather than
+        waited for."""
+        used = self.memory_usage()
+        for dataset in list(self._datasets.values()):
+            if used <= self.memory_budget:
+                break
+            if not dataset.loaded or dataset.dataset_id == keep:
+                continue
+            if not dataset.lock.acquire(blocking=False):
+                continue
+            try:
+                logger.info("Evicting dataset %s from memory", dataset.dataset_id)
+                used -= dataset.nbytes
+                dataset.release()
+            finally:
+                dataset.lock.release()
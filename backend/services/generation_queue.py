@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from utils.metrics import observe_stage
+
+# Requests admitted (running + waiting) before new ones are rejected
+MAX_PENDING = int(os.environ.get("CSVAI_QUEUE_SIZE", "8"))
+# Seconds a single request may wait and generate before it is cancelled
+GENERATION_TIMEOUT = float(os.environ.get("CSVAI_GENERATION_TIMEOUT", "300"))
+
+
+class QueueFullError(Exception):
+    """Raised when the generation queue has no free slots"""
+
+    def __init__(self, depth: int, max_pending: int):
+        super().__init__(f"Model is busy: {depth} requests queued (limit {max_pending})")
+        self.depth = depth
+        self.max_pending = max_pending
+
+
+class GenerationCancelled(Exception):
+    """Raised when a request was cancelled (client gone or timed out)"""
+
+
+class GenerationQueue:
+    """Runs blocking model work (loading, generation) on a dedicated executor
+    so the event loop stays free, with bounded admission, per-request timeouts
+    and cooperative cancellation through a threading.Event."""
+
+    def __init__(self, workers: int = 1, max_pending: int = MAX_PENDING,
+                 timeout: float = GENERATION_TIMEOUT):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        """Requests currently running or waiting"""
+        return self._pending
+
+    def stats(self) -> Dict:
+        return {"depth": self._pending, "max_pending": self.max_pending, "timeout": self.timeout}
+
+    def admit(self) -> int:
+        """Take a queue slot and return how many requests are ahead of it.
+        Raises QueueFullError when the queue is full."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(self._pending, self.max_pending)
+            self._pending += 1
+            return self._pending - 1
+
+    async def run(self, fn: Callable, *args, cancel_event: Optional[threading.Event] = None,
+                  timeout: Optional[float] = None, admitted: bool = False):
+        """Run `fn` on the executor. Raises QueueFullError when the queue is full
+        and GenerationCancelled when `cancel_event` is set or the timeout expires.
+        `fn` is expected to poll `cancel_event` if it runs for long. Pass
+        `admitted=True` if the slot was already taken with admit()."""
+        if not admitted:
+            self.admit()
+
+        cancel_event = cancel_event or threading.Event()
+        submitted = time.perf_counter()
+
+        def job():
+            observe_stage("queue_wait", time.perf_counter() - submitted)
+            # Skip work whose client went away while it was waiting in the queue
+            if cancel_event.is_set():
+                raise GenerationCancelled("Request cancelled before it started")
+            return fn(*args)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, job)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Let the worker stop at its next token, then release the slot when it does
+            cancel_event.set()
+            future.add_done_callback(self._release_abandoned)
+            if isinstance(e, asyncio.TimeoutError):
+                raise GenerationCancelled("Request timed out") from e
+            raise
+        except BaseException:
+            self._release()
+            raise
+        self._release()
+        if cancel_event.is_set():
+            raise GenerationCancelled("Request cancelled")
+        return result
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _release_abandoned(self, future: asyncio.Future):
+        self._release()
+        if not future.cancelled():
+            future.exception()  # mark retrieved; nobody is waiting for it any more
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Number of model instances; 1 keeps the single-model behaviour
+POOL_SIZE = max(1, int(os.environ.get("CSVAI_POOL_SIZE", "1")))
+
+
+def threads_per_instance(pool_size: int) -> int:
+    """Split the machine's cores between instances unless CSVAI_N_THREADS is set."""
+    configured = os.environ.get("CSVAI_N_THREADS")
+    if configured:
+        return max(1, int(configured))
+    return max(1, (os.cpu_count() or 1) // pool_size)
+
+
+class ModelSlot:
+    """One model instance and its load accounting"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.model = None
+        self.busy = False
+        self.served = 0
+        self.busy_seconds = 0.0
+        self.last_used = 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "index": self.index,
+            "busy": self.busy,
+            "served": self.served,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "device": getattr(self.model, "device", None),
+            "live_session": getattr(self.model, "live_session", None),
+        }
+
+
+class ModelPool:
+    """A fixed set of model instances shared by the generation workers.
+
+    Each job borrows an idle instance for its duration. The scheduler prefers
+    the instance that still holds the session's live chat session (its KV
+    cache), then an instance without a live session, then the one whose
+    session was used least recently; ties go to the least accumulated work.
+    Requests beyond the pool size wait in the generation queue.
+    """
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self.n_threads = threads_per_instance(size)
+        self.slots: List[ModelSlot] = [ModelSlot(i) for i in range(size)]
+        self._cond = threading.Condition()
+
+    @property
+    def loaded(self) -> bool:
+        return all(slot.model is not None for slot in self.slots)
+
+    def load(self, factory: Callable):
+        """Create the instances with `factory(n_threads=...)`. Blocking."""
+        for slot in self.slots:
+            if slot.model is None:
+                logger.info("Loading model instance %d/%d with %d threads",
+                            slot.index + 1, self.size, self.n_threads)
+                slot.model = factory(n_threads=self.n_threads)
+
+    def call(self, fn: Callable, session_id: Optional[str] = None):
+        """Run `fn(model)` on an idle instance, waiting for one if needed."""
+        slot = self._acquire(session_id)
+        started = time.perf_counter()
+        try:
+            return fn(slot.model)
+        finally:
+            self._release(slot, time.perf_counter() - started)
+
+    def _acquire(self, session_id: Optional[str]) -> ModelSlot:
+        with self._cond:
+            while True:
+                idle = [slot for slot in self.slots if not slot.busy]
+                if idle:
+                    slot = min(idle, key=lambda s: self._preference(s, session_id))
+                    slot.busy = True
+                    return slot
+                self._cond.wait()
+
+    @staticmethod
+    def _preference(slot: ModelSlot, session_id: Optional[str]):
+        live = getattr(slot.model, "live_session", None)
+        if session_id is not None and live == session_id:
+            return (0, 0.0, slot.busy_seconds)
+        if live is None:
+            return (1, 0.0, slot.busy_seconds)
+        return (2, slot.last_used, slot.busy_seconds)
+
+    def _release(self, slot: ModelSlot, elapsed: float):
+        with self._cond:
+            slot.busy = False
+            slot.served += 1
+            slot.busy_seconds += elapsed
+            slot.last_used = time.time()
+            self._cond.notify()
+
+    def any_model(self):
+        """An instance for read-only inspection (device, path); None if not loaded."""
+        return self.slots[0].model
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "size": self.size,
+                "threads_per_instance": self.n_threads,
+                "busy": sum(1 for slot in self.slots if slot.busy),
+                "instances": [slot.stats() for slot in self.slots],
+            }
@@ -0,0 +1,751 @@
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from utils.sort_index import take_rows
+
+AGGREGATES = ("count", "sum", "mean", "median", "min", "max", "nunique")
+OPERATORS = ("==", "!=", ">", ">=", "<", "<=", "contains")
+# Groups shown when a grouped result has no explicit limit
+MAX_GROUPS = 20
+# Columns with at most this many distinct values are searched for value mentions
+VALUE_VOCAB_MAX_CARDINALITY = 50
+# Dataset versions whose value vocabularies are kept, most recently used
+VOCAB_CACHE_SIZE = 16
+# Bounds on plans produced by the model
+MAX_FILTERS = 8
+MAX_PLAN_ROWS = 100
+MAX_VALUE_LENGTH = 200
+# Wall-clock seconds and column bytes a single plan may spend
+PLAN_TIMEOUT = float(os.environ.get("CSVAI_PLAN_TIMEOUT", "10"))
+PLAN_MEMORY_MB = int(os.environ.get("CSVAI_PLAN_MEMORY_MB", "1024"))
+
+_AGGREGATE_WORDS = [
+    ("count", r"how many|number of|count"),
+    ("nunique", r"distinct|unique"),
+    ("mean", r"average|mean|avg"),
+    ("median", r"median"),
+    ("sum", r"total|sum"),
+    ("max", r"maximum|max|highest|largest|biggest|most"),
+    ("min", r"minimum|min|lowest|smallest|least"),
+]
+_SUPERLATIVES = {"highest": "desc", "largest": "desc", "biggest": "desc", "most": "desc",
+                 "lowest": "asc", "smallest": "asc", "least": "asc"}
+_OPERATOR_WORDS = [
+    (">=", r">=|at least|no less than|greater than or equal to"),
+    ("<=", r"<=|at most|no more than|less than or equal to"),
+    ("!=", r"!=|is not|isn't|not equal to|other than|excluding|except|not"),
+    (">", r">|greater than|more than|higher than|above|over|exceeds|after"),
+    ("<", r"<|less than|fewer than|lower than|below|under|before"),
+    ("contains", r"contains|containing|like"),
+    ("==", r"==|=|equals|equal to|is"),
+]
+_VALUE = r"'([^']*)'|\"([^\"]*)\"|(-?\d[\d,]*(?:\.\d+)?)|([\w\-./:]+)"
+_GROUP_WORDS = r"grouped by|for each|for every|per|by|across|in each"
+# Key-like column names ("OrderID", "customer_id", "Invoice No"); group 1 is
+# the name without its suffix, which also refers to the column ("order 100042")
+_KEY_NAME = re.compile(r"(.*?[A-Za-z0-9])(?:[\s_\-]+(?i:id|key|code|number|no|num)"
+                       r"|(?<=[a-z])(?:ID|Id|Key|Code|Number|No|Num))\.?")
+_NEGATION = r"(?<![a-z])(?:not|no longer|n't|excluding|except(?: for)?|other than|besides|apart from|aside from|non)"
+# A negation right before a value mention: "not in sales", "non-smokers"
+_NEGATED_VALUE = _NEGATION + r"(?:\s+(?:in|from|of|at|on|for|a|an|the|being))*[\s\-]*$"
+# Words a question may contain besides its columns, values and conditions;
+# anything else may be a condition the parser did not understand
+_QUESTION_WORDS = frozenset("""
+    a an the this that these those it its their there here what what's whats which who whose
+    how is are was were be been do does did have has had can could would will should please
+    me us i we you tell give show list find display get of in on at for from to by with and
+    where per across each every grouped group all overall any in total number count sum
+    average mean avg median maximum max minimum min highest largest biggest most lowest
+    smallest least distinct unique top bottom first last many much value values row rows
+    record records entry entries item items line lines case cases people person persons
+    employee employees user users customer customers member members staff worker workers
+    data dataset table file csv
+""".split())
+
+
+@dataclass
+class Filter:
+    column: str
+    op: str
+    value: object
+
+
+@dataclass
+class QueryPlan:
+    """A structured question: aggregate `column` over rows matching `filters`,
+    optionally per `group_by`, sorted and limited. op "rows" lists rows."""
+    op: str
+    column: Optional[str] = None
+    group_by: Optional[str] = None
+    filters: List[Filter] = field(default_factory=list)
+    order: Optional[str] = None
+    limit: Optional[int] = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QueryPlan":
+        """Build a plan from untrusted JSON. Raises QueryError on unknown or
+        missing fields; run QueryEngine.validate before executing it."""
+        if not isinstance(data, dict) or not isinstance(data.get("op"), str):
+            raise QueryError("A plan must be an object with an 'op'")
+        unknown = set(data) - {"op", "column", "group_by", "filters", "order", "limit"}
+        if unknown:
+            raise QueryError(f"Unknown plan fields: {', '.join(sorted(unknown))}")
+        raw_filters = data.get("filters") or []
+        if not isinstance(raw_filters, list):
+            raise QueryError("'filters' must be a list")
+        filters = []
+        for f in raw_filters:
+            if not isinstance(f, dict) or set(f) != {"column", "op", "value"}:
+                raise QueryError("Each filter needs exactly 'column', 'op' and 'value'")
+            filters.append(Filter(**f))
+        return cls(
+            op=data["op"],
+            column=data.get("column"),
+            group_by=data.get("group_by"),
+            filters=filters,
+            order=data.get("order"),
+            limit=data.get("limit"),
+        )
+
+    def describe(self) -> str:
+        if self.op == "rows":
+            text = "Rows"
+        elif self.op == "count" and self.column is None:
+            text = "Count of rows"
+        else:
+            names = {"mean": "Average", "nunique": "Distinct count of", "sum": "Total",
+                     "median": "Median", "min": "Minimum", "max": "Maximum", "count": "Count of"}
+            text = f"{names[self.op]} {self.column}"
+        if self.group_by:
+            text += f" by {self.group_by}"
+        if self.filters:
+            text += " where " + " and ".join(f"{f.column} {f.op} {f.value}" for f in self.filters)
+        if self.order and self.limit:
+            text += f" ({'top' if self.order == 'desc' else 'bottom'} {self.limit}"
+            text += f" by {self.column})" if self.op == "rows" and self.column else ")"
+        return text
+
+
+class QueryError(Exception):
+    """Raised when a plan does not fit the dataset"""
+
+
+# Answers the filters on one column from an index: (ascending row positions,
+# whether they match every filter exactly), or None
+Lookup = Callable[[List[Filter]], Optional[Tuple[np.ndarray, bool]]]
+
+
+def parse_filter(text: str) -> Filter:
+    """Parse a filter expression such as "Age>=30", "Gender=Female" or
+    "Name~smith" (contains). Raises QueryError if it has no operator."""
+    match = re.match(r"^\s*(.+?)\s*(==|!=|>=|<=|~|=|>|<)\s*(.*?)\s*$", text)
+    if not match:
+        raise QueryError(f"Invalid filter: {text}")
+    column, op, value = match.groups()
+    op = {"=": "==", "~": "contains"}.get(op, op)
+    return Filter(column, op, value)
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"[_\-\s]+", " ", text.strip().lower())
+
+
+def _is_key(column) -> bool:
+    name = str(column).strip()
+    return _KEY_NAME.fullmatch(name) is not None or name.lower() in ("id", "key")
+
+
+def _singular(word: str) -> str:
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+class QueryEngine:
+    """Maps plain-language questions onto vectorized pandas operations.
+
+    Handles counts, sums, averages, medians, min/max and distinct counts,
+    optionally grouped ("by X", "which X has the highest ..."), filtered
+    ("where Y > 10", category values mentioned by name) and ranked ("top 5"),
+    and point lookups on key columns ("show order 100042").
+    Column names are matched fuzzily. parse() returns None when the question
+    is not something that can be answered exactly, so callers can fall back
+    to the model.
+    """
+
+    def __init__(self):
+        # Keyed by dataset version, so a reloaded or appended dataset gets a new entry
+        self._vocab_cache: "OrderedDict[str, Dict[str, List[str]]]" = OrderedDict()
+        self._vocab_lock = threading.Lock()
+
+    # Parsing
+
+    def parse(self, question: str, df: pd.DataFrame, dataset_key: Optional[str] = None
+              ) -> Optional[QueryPlan]:
+        source = " " + re.sub(r"[?!;]", " ", question) + " "
+        text = source.lower()
+        if len(text) != len(source):
+            source = text  # lowercasing changed offsets; values lose their case
+        agg, agg_pos = self._find_aggregate(text)
+        top = re.search(r"\b(top|bottom|first|last)\s+(\d+)\b", text)
+        listing = re.match(r"\s*(show|list|find|display|give me|get)\b", text)
+        if agg is None and top is None and listing is None:
+            return None
+
+        mentions = self._find_columns(text, df)
+        group_by = self._find_group(text, mentions)
+        if top is not None and group_by is None and agg is not None:
+            # "top 5 departments by average salary" ranks the named column's groups
+            group_by = next((col for start, _, col in mentions if start == top.end() + 1), None)
+        filters, filter_columns, spans = self._find_filters(text, mentions, df, source)
+        found = self._find_value_mentions(text, df, mentions, spans, filter_columns, dataset_key)
+        if found is None:
+            return None
+        value_filters, value_spans = found
+        filters += value_filters
+        spans = [(start, end) for start, end, _ in mentions] + spans + value_spans
+        if top is not None:
+            spans.append(top.span())
+        if self._unparsed_condition(text, spans):
+            return None
+
+        used = {group_by} | filter_columns
+        targets = [(pos, col) for pos, end, col in mentions if col not in used]
+        after_agg = [col for pos, col in targets if agg_pos is None or pos >= agg_pos]
+        target = after_agg[0] if after_agg else (targets[0][1] if targets else None)
+
+        order, limit = None, None
+        if top is not None:
+            order = "asc" if top.group(1) in ("bottom", "last") else "desc"
+            limit = int(top.group(2))
+        superlative = re.search(r"\b(" + "|".join(_SUPERLATIVES) + r")\b", text)
+        if group_by and superlative and top is None:
+            order, limit = _SUPERLATIVES[superlative.group(1)], 1
+
+        if agg is None and top is None:
+            # "show rows where age between 30 and 35"
+            if not filters:
+                return None
+            plan = QueryPlan(op="rows", filters=filters, limit=10)
+        elif agg is None or (agg in ("max", "min") and limit is not None and group_by is None):
+            # "top 5 employees by salary": the "by" column is the sort key, not a group
+            if group_by is not None:
+                target, group_by = group_by, None
+            if target is None:
+                return None
+            order = order or ("desc" if agg != "min" else "asc")
+            plan = QueryPlan(op="rows", column=target, filters=filters, order=order, limit=limit or 1)
+        elif agg == "count":
+            if target is None and re.search(r"\bcolumns?\b", text):
+                return None  # "how many columns" is answered from the schema context
+            count_target = target if target is not None and target == group_by else None
+            plan = QueryPlan(op="count", column=count_target, group_by=group_by,
+                             filters=filters, order=order, limit=limit)
+        else:
+            if agg in ("max", "min") and group_by and superlative and top is None:
+                # "which department has the highest salary" ranks groups by their max
+                agg = "max" if order == "desc" else "min"
+            if target is None:
+                return None
+            plan = QueryPlan(op=agg, column=target, group_by=group_by,
+                             filters=filters, order=order, limit=limit)
+        try:
+            self.validate(plan, df)
+        except QueryError:
+            return None
+        return plan
+
+    def _find_aggregate(self, text: str) -> Tuple[Optional[str], Optional[int]]:
+        found = []
+        for name, pattern in _AGGREGATE_WORDS:
+            match = re.search(r"\b(" + pattern + r")\b", text)
+            if match:
+                found.append((name, match.start()))
+        if not found:
+            return None, None
+        names = [name for name, _ in found]
+        # "how many distinct" is a distinct count, "how many"/"number of" win over
+        # "total", and "highest average" is an average
+        for preferred in ("nunique", "count", "mean", "median", "sum"):
+            if preferred in names:
+                return preferred, dict(found)[preferred]
+        return found[0]
+
+    def _column_variants(self, df: pd.DataFrame) -> Dict[str, str]:
+        variants = {}
+        for col in df.columns:
+            name = _normalize(str(col))
+            for variant in (name, name.replace(" ", ""), " ".join(_singular(w) for w in name.split())):
+                variants.setdefault(variant, col)
+        for col in df.columns:
+            # "order" names OrderID unless another column is called that
+            key = _KEY_NAME.fullmatch(str(col).strip())
+            if key:
+                variants.setdefault(_normalize(key.group(1)), col)
+        return variants
+
+    def _find_columns(self, text: str, df: pd.DataFrame) -> List[Tuple[int, int, str]]:
+        """Column mentions as (start, end, column), longest match first, non-overlapping."""
+        variants = self._column_variants(df)
+        by_size: Dict[int, List[str]] = {}
+        for variant in variants:
+            by_size.setdefault(len(variant.split()), []).append(variant)
+        words = [(m.start(), m.end(), m.group()) for m in re.finditer(r"[a-z0-9_]+", text)]
+        taken = [False] * len(words)
+        mentions = []
+        for size in (4, 3, 2, 1):
+            for i in range(len(words) - size + 1):
+                if any(taken[i:i + size]):
+                    continue
+                phrase = _normalize(" ".join(w for _, _, w in words[i:i + size]))
+                singular = " ".join(_singular(w) for w in phrase.split())
+                col = variants.get(phrase) or variants.get(singular) or variants.get(phrase.replace(" ", ""))
+                last_end = words[i + size - 1][1]
+                if col is None and len(phrase) >= 4 and not re.search(r"\d", phrase) \
+                        and text[words[i][0] - 1].isspace() and text[last_end].isspace():
+                    # Typos only: compare against names with the same number of words,
+                    # never taking in a number or part of a value ("customer 17", "inv-0042")
+                    close = difflib.get_close_matches(phrase, by_size.get(size, []), n=1, cutoff=0.8)
+                    col = variants[close[0]] if close else None
+                if col is not None:
+                    mentions.append((words[i][0], words[i + size - 1][1], col))
+                    for j in range(i, i + size):
+                        taken[j] = True
+        return sorted(mentions)
+
+    def _find_group(self, text: str, mentions) -> Optional[str]:
+        for start, end, col in mentions:
+            before = text[:start].rstrip()
+            if re.search(r"\b(" + _GROUP_WORDS + r")$", before):
+                return col
+            if re.search(r"\b(which|what)$", before) and re.search(r"\b(" + "|".join(_SUPERLATIVES) + r")\b", text[end:]):
+                return col
+        return None
+
+    def _find_filters(self, text: str, mentions, df: pd.DataFrame, source: str):
+        """Comparisons that follow a column mention. Values are read from
+        `source`, the question as typed, so keys keep their case. Returns
+        the filters, the filtered columns and the consumed character spans."""
+        filters, columns, spans = [], set(), []
+        for start, end, col in mentions:
+            rest, typed = text[end:], source[end:]
+            between = re.match(r"\s+(?:is\s+)?between\s+(" + _VALUE + r")\s+and\s+(" + _VALUE + r")", rest)
+            if between:
+                low = self._coerce_value(df[col], self._value_text(between, 2, typed))
+                high = self._coerce_value(df[col], self._value_text(between, 7, typed))
+                filters += [Filter(col, ">=", low), Filter(col, "<=", high)]
+                columns.add(col)
+                spans.append((start, end + between.end()))
+                continue
+            for op, pattern in _OPERATOR_WORDS:
+                match = re.match(r"\s*(?:" + pattern + r")(?![a-z])\s*(" + _VALUE + r")", rest)
+                if not match:
+                    continue
+                raw = self._value_text(match, 2, typed)
+                if op in (">", "<", ">=", "<=") and not self._orderable(df[col], raw):
+                    break
+                if op in ("==", "!=") and not self._known_value(df[col], raw):
+                    break
+                filters.append(Filter(col, op, self._coerce_value(df[col], raw)))
+                columns.add(col)
+                spans.append((start, end + match.end()))
+                break
+            else:
+                # "attrition yes": a category value right after its column, or
+                # "order 100042" / "order #100042": a key right after its column
+                key = _is_key(col)
+                prefix = r"\s*(?:(?:number|no\.?|id)\s*)?#?\s*" if key else r"\s+"
+                match = re.match(prefix + r"(" + _VALUE + r")", rest)
+                numeric = pd.api.types.is_numeric_dtype(df[col])
+                if match and (key or not numeric):
+                    raw = self._value_text(match, 2, typed)
+                    # Any key is a valid lookup; one that is missing matches no rows
+                    if self._known_value(df[col], raw) or (key and not numeric):
+                        filters.append(Filter(col, "==", self._coerce_value(df[col], raw)))
+                        columns.add(col)
+                        spans.append((start, end + match.end()))
+        return filters, columns, spans
+
+    @staticmethod
+    def _unparsed_condition(text: str, spans) -> bool:
+        """True if, outside the parsed `spans`, the question still compares
+        ("older than 40", "above the average"), negates ("not in sales") or
+        names something that is neither a column nor a known value ("of
+        women"), so an answer would silently ignore a condition."""
+        def parsed(pos: int) -> bool:
+            return any(s <= pos < e for s, e in spans)
+
+        words = "|".join(pattern for op, pattern in _OPERATOR_WORDS if op != "==")
+        pattern = r"(?<![a-z])(?:" + words + r"|older|younger|newer|earlier|later|between)(?![a-z])"
+        for match in re.finditer(pattern + "|" + _NEGATION + r"(?![a-z])", text):
+            if not parsed(match.start()):
+                return True
+        for match in re.finditer(r"[a-z0-9']+", text):
+            word = match.group().strip("'")
+            if word and word not in _QUESTION_WORDS and not parsed(match.start()):
+                return True
+        return False
+
+    @staticmethod
+    def _value_text(match, first_group: int, typed: str) -> str:
+        """The value a _VALUE match found, cut from `typed` (the matched text
+        in its original case)."""
+        group = next(g for g in range(first_group, first_group + 4) if match.group(g) is not None)
+        return typed[match.start(group):match.end(group)]
+
+    @staticmethod
+    def _orderable(series: pd.Series, raw: str) -> bool:
+        if pd.api.types.is_numeric_dtype(series):
+            return re.fullmatch(r"-?[\d,]+(\.\d+)?", raw) is not None
+        return re.fullmatch(r"\d{4}-\d{2}(-\d{2})?.*", raw) is not None
+
+    def _known_value(self, series: pd.Series, raw: str) -> bool:
+        if pd.api.types.is_numeric_dtype(series):
+            return re.fullmatch(r"-?[\d,]+(\.\d+)?", raw) is not None
+        return self._match_category(series, raw) is not None
+
+    @staticmethod
+    def _match_category(series: pd.Series, raw: str):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.categories
+        else:
+            values = pd.unique(series.dropna())
+            if len(values) > 10000:
+                return raw
+        lowered = {str(v).lower(): v for v in values}
+        return lowered.get(raw.lower())
+
+    def _coerce_value(self, series: pd.Series, raw: str):
+        if pd.api.types.is_numeric_dtype(series):
+            number = float(raw.replace(",", ""))
+            return int(number) if number.is_integer() else number
+        matched = self._match_category(series, raw)
+        return matched if matched is not None else raw
+
+    def _value_vocabulary(self, df: pd.DataFrame, dataset_key: Optional[str]) -> Dict[str, List[str]]:
+        if dataset_key is not None:
+            with self._vocab_lock:
+                if dataset_key in self._vocab_cache:
+                    self._vocab_cache.move_to_end(dataset_key)
+                    return self._vocab_cache[dataset_key]
+        vocab = {}
+        for col in df.columns:
+            series = df[col]
+            if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+                continue
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                values = series.cat.categories
+            elif len(pd.unique(series.head(10000))) > VALUE_VOCAB_MAX_CARDINALITY:
+                continue
+            else:
+                values = pd.unique(series.dropna())
+            if len(values) <= VALUE_VOCAB_MAX_CARDINALITY:
+                vocab[col] = [v for v in values if isinstance(v, str)]
+        if dataset_key is not None:
+            with self._vocab_lock:
+                self._vocab_cache[dataset_key] = vocab
+                while len(self._vocab_cache) > VOCAB_CACHE_SIZE:
+                    self._vocab_cache.popitem(last=False)
+        return vocab
+
+    @staticmethod
+    def _value_pattern(value: str) -> str:
+        """Regex for a category value or its plural ("female" also matches
+        "females", "company" matches "companies")."""
+        value = value.lower()
+        if value.endswith("y") and len(value) > 2:
+            word = re.escape(value[:-1]) + r"(?:y|ies)"
+        else:
+            word = re.escape(value) + r"(?:s|es)?"
+        return r"(?<![a-z0-9])" + word + r"(?![a-z0-9])"
+
+    def _find_value_mentions(self, text: str, df: pd.DataFrame, mentions, filter_spans, filter_columns,
+                             dataset_key: Optional[str]) -> Optional[Tuple[List[Filter], List[Tuple[int, int]]]]:
+        """Category values named in the question ("how many female employees",
+        "not in sales"), with the spans they cover. Returns None if a value is
+        ambiguous between columns or the question names several values of one
+        column ("male and female"), which is not a single filter."""
+        mentioned = {col for _, _, col in mentions}
+        spans = [(start, end) for start, end, _ in mentions] + list(filter_spans)
+        hits: Dict[str, List[Tuple[str, str, str, Tuple[int, int]]]] = {}
+        for col, values in self._value_vocabulary(df, dataset_key).items():
+            if col in filter_columns:
+                continue
+            for value in values:
+                for match in re.finditer(self._value_pattern(value), text):
+                    if any(s <= match.start() < e for s, e in spans):
+                        continue
+                    negated = re.search(_NEGATED_VALUE, text[:match.start()])
+                    op = "!=" if negated else "=="
+                    start = negated.start() if negated else match.start()
+                    hits.setdefault(value.lower(), []).append((col, value, op, (start, match.end())))
+        filters, value_spans = [], []
+        for candidates in hits.values():
+            columns = {col for col, _, _, _ in candidates}
+            if len(columns) > 1:
+                # "yes" could be Overtime or Attrition: use the one the question names
+                columns &= mentioned
+                if len(columns) != 1:
+                    return None
+            col = columns.pop()
+            found = [(v, op, span) for c, v, op, span in candidates if c == col]
+            if len({op for _, op, _ in found}) > 1:
+                return None
+            value, op, _ = found[0]
+            filters.append(Filter(col, op, value))
+            value_spans += [span for _, _, span in found]
+        equal = [f.column for f in filters if f.op == "=="]
+        if len(equal) != len(set(equal)):
+            return None
+        return filters, value_spans
+
+    # Validation and execution
+
+    def validate(self, plan: QueryPlan, df: pd.DataFrame):
+        """Raise QueryError unless the plan only references existing columns
+        with operations that make sense for their dtypes."""
+        if plan.op not in AGGREGATES + ("rows",):
+            raise QueryError(f"Unsupported operation: {plan.op}")
+        for name in (plan.column, plan.group_by):
+            if name is not None and name not in df.columns:
+                raise QueryError(f"Unknown column: {name}")
+        if plan.op not in ("count", "rows") and plan.column is None:
+            raise QueryError(f"Operation {plan.op} needs a column")
+        if plan.op in ("sum", "mean", "median") and not pd.api.types.is_numeric_dtype(df[plan.column]):
+            raise QueryError(f"Column {plan.column} is not numeric")
+        if len(plan.filters) > MAX_FILTERS:
+            raise QueryError(f"At most {MAX_FILTERS} filters are allowed")
+        for f in plan.filters:
+            if f.column not in df.columns:
+                raise QueryError(f"Unknown column: {f.column}")
+            if f.op not in OPERATORS:
+                raise QueryError(f"Unsupported filter operator: {f.op}")
+            if isinstance(f.value, bool) or not isinstance(f.value, (str, int, float)):
+                raise QueryError(f"Filter value for {f.column} must be a string or number")
+            if isinstance(f.value, str) and len(f.value) > MAX_VALUE_LENGTH:
+                raise QueryError(f"Filter value for {f.column} is too long")
+        if plan.order not in (None, "asc", "desc"):
+            raise QueryError(f"Unsupported order: {plan.order}")
+        if plan.limit is not None and plan.op != "rows" and plan.group_by is None:
+            # "total salary of the top 5 employees" would otherwise be the
+            # total over every row, labelled as if it were limited
+            raise QueryError("A limit on an aggregate needs a group_by")
+        if plan.limit is not None and (isinstance(plan.limit, bool) or not isinstance(plan.limit, int)
+                                       or not 1 <= plan.limit <= MAX_PLAN_ROWS):
+            raise QueryError(f"Limit must be an integer between 1 and {MAX_PLAN_ROWS}")
+
+    def filter_mask(self, df: pd.DataFrame, filters: List[Filter],
+                    deadline: Optional[float] = None) -> Optional[np.ndarray]:
+        mask = None
+        for f in filters:
+            self._check_deadline(deadline)
+            series = df[f.column]
+            value = f.value
+            if isinstance(value, str) and f.op != "contains" and pd.api.types.is_numeric_dtype(series):
+                value = float(value.replace(",", ""))
+            if f.op == "contains":
+                part = series.astype(str).str.contains(str(value), case=False, regex=False)
+            elif not pd.api.types.is_numeric_dtype(series) and f.op in (">", "<", ">=", "<="):
+                series = pd.to_datetime(series.astype(str), errors="coerce")
+                value = pd.to_datetime(str(value))
+                part = getattr(series, {">": "gt", "<": "lt", ">=": "ge", "<=": "le"}[f.op])(value)
+            elif isinstance(series.dtype, pd.CategoricalDtype) and f.op in ("==", "!=") \
+                    and value not in series.cat.categories:
+                part = pd.Series(f.op == "!=", index=series.index)
+            else:
+                op = {"==": "eq", "!=": "ne", ">": "gt", "<": "lt", ">=": "ge", "<=": "le"}[f.op]
+                part = getattr(series, op)(value)
+            part = part.fillna(False).to_numpy(dtype=bool)
+            mask = part if mask is None else mask & part
+        return mask
+
+    def filter_positions(self, df: pd.DataFrame, filters: List[Filter], lookup: Optional[Lookup] = None,
+                         deadline: Optional[float] = None) -> Optional[np.ndarray]:
+        """Ascending positions of the rows matching every filter; None without
+        filters. Columns whose filters `lookup` answers from an index are
+        resolved first and the remaining filters are evaluated only on the
+        rows those leave, so a key or narrow range lookup never scans the
+        frame."""
+        if not filters:
+            return None
+        by_column: Dict[str, List[Filter]] = {}
+        for f in filters:
+            by_column.setdefault(f.column, []).append(f)
+        positions, rest = None, []
+        for group in by_column.values():
+            found = lookup(group) if lookup is not None else None
+            if found is None:
+                rest.extend(group)
+                continue
+            matched, exact = found
+            positions = matched if positions is None else np.intersect1d(
+                positions, matched, assume_unique=True)
+            if not exact:
+                rest.extend(group)
+        if positions is None:
+            return np.flatnonzero(self.filter_mask(df, rest, deadline))
+        if rest and len(positions):
+            rows = pd.DataFrame({f.column: take_rows(df[f.column], positions) for f in rest})
+            positions = positions[self.filter_mask(rows, rest, deadline)]
+        return positions
+
+    def execute(self, df: pd.DataFrame, plan: QueryPlan, timeout: Optional[float] = None,
+                lookup: Optional[Lookup] = None):
+        """Run a plan after validating it. Returns a scalar, a Series (grouped)
+        or a DataFrame (rows). `lookup` answers filters from column indexes
+        (see filter_positions).
+
+        Plans are data, never code: only the whitelisted operations above run.
+        Execution is bounded by PLAN_MEMORY_MB (estimated from the columns the
+        plan touches) and by `timeout` seconds (PLAN_TIMEOUT by default), checked
+        between pandas steps; exceeding either raises QueryError.
+        """
+        self.validate(plan, df)
+        self._check_memory(df, plan)
+        deadline = time.monotonic() + (timeout or PLAN_TIMEOUT)
+        try:
+            positions = self.filter_positions(df, plan.filters, lookup, deadline)
+        except (TypeError, ValueError) as e:
+            raise QueryError(f"Filter does not match the column type: {e}") from e
+        self._check_deadline(deadline)
+        if plan.op == "rows":
+            sub = take_rows(df, positions) if positions is not None else df
+        else:
+            # Aggregates only need their own columns; avoid copying the whole frame
+            needed = [c for c in dict.fromkeys((plan.column, plan.group_by)) if c is not None]
+            sub = df[needed] if needed else df.iloc[:, :0]
+            sub = take_rows(sub, positions) if positions is not None else sub
+
+        if plan.op == "rows":
+            if plan.column is not None:
+                ascending = plan.order == "asc"
+                picker = sub.nsmallest if ascending else sub.nlargest
+                if pd.api.types.is_numeric_dtype(sub[plan.column]):
+                    return picker(plan.limit or 10, plan.column)
+                sub = sub.sort_values(plan.column, ascending=ascending)
+            return sub.head(plan.limit or 10)
+
+        if plan.group_by:
+            groups = sub.groupby(plan.group_by, observed=True, sort=False)
+            if plan.op == "count":
+                result = groups.size()
+            else:
+                result = getattr(groups[plan.column], plan.op)()
+            if plan.order:
+                result = result.sort_values(ascending=plan.order == "asc")
+            else:
+                result = result.sort_index()
+            return result.head(plan.limit or MAX_GROUPS)
+
+        if plan.op == "count":
+            return int(len(sub))
+        return getattr(sub[plan.column], plan.op)()
+
+    @staticmethod
+    def _check_deadline(deadline: Optional[float]):
+        if deadline is not None and time.monotonic() > deadline:
+            raise QueryError("Query took too long and was stopped")
+
+    @staticmethod
+    def _check_memory(df: pd.DataFrame, plan: QueryPlan):
+        """Refuse plans whose working set (filter masks plus the touched
+        columns) would exceed PLAN_MEMORY_MB."""
+        columns = {f.column for f in plan.filters} | {plan.column, plan.group_by} - {None}
+        if plan.op == "rows":
+            columns = set(df.columns)
+        estimate = len(df) * (len(plan.filters) + 1)
+        estimate += sum(int(df[c].memory_usage(index=False, deep=False)) for c in columns)
+        if estimate > PLAN_MEMORY_MB * 1024 * 1024:
+            raise QueryError(f"Query needs about {estimate // (1024 * 1024)} MB, "
+                             f"over the {PLAN_MEMORY_MB} MB limit")
+
+    # Model-written plans
+
+    def plan_prompt(self, csv_info: Dict) -> str:
+        """System prompt asking the model to translate a question into a plan."""
+        columns = []
+        for name in csv_info["column_names"]:
+            stats = csv_info["column_stats"].get(name, {})
+            line = f"- {name} ({stats.get('dtype', '?')})"
+            if stats.get("top_values") and "min" not in stats:
+                line += ": " + ", ".join(json.dumps(v["value"]) for v in stats["top_values"][:5])
+            columns.append(line)
+        return "\n".join([
+            "Translate the user's question about a table into a JSON query plan. "
+            "Reply with one JSON object and nothing else.",
+            "Columns:",
+            *columns,
+            "",
+            'Plan format: {"op": OP, "column": COLUMN or null, "group_by": COLUMN or null, '
+            '"filters": [{"column": COLUMN, "op": CMP, "value": VALUE}], '
+            '"order": "asc"|"desc"|null, "limit": INTEGER or null}',
+            f"OP is one of: {', '.join(AGGREGATES)}, rows. "
+            "count with column null counts rows; rows lists matching rows sorted by column.",
+            f"CMP is one of: {', '.join(OPERATORS)}.",
+            'If the question cannot be answered from the table with such a plan, reply {"op": "none"}.',
+            'Example: "average salary by department for people over 30" -> '
+            '{"op": "mean", "column": "Salary", "group_by": "Department", '
+            '"filters": [{"column": "Age", "op": ">", "value": 30}], "order": null, "limit": null}',
+        ])
+
+    @staticmethod
+    def parse_plan_text(text: str) -> Optional[QueryPlan]:
+        """Extract the JSON plan from model output. None if the model declined;
+        QueryError if the output is not a well-formed plan."""
+        start, end = text.find("{"), text.rfind("}")
+        if start < 0 or end < start:
+            raise QueryError("No JSON object in the model output")
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError as e:
+            raise QueryError(f"Invalid JSON plan: {e}") from e
+        if isinstance(data, dict) and data.get("op") == "none":
+            return None
+        return QueryPlan.from_dict(data)
+
+    def mentions_data(self, question: str, df: pd.DataFrame, dataset_key: Optional[str] = None) -> bool:
+        """True if the question names a column or a known category value, i.e.
+        it is worth asking the model for a query plan."""
+        text = " " + re.sub(r"[?!;]", " ", question.lower()) + " "
+        if self._find_columns(text, df):
+            return True
+        vocab = self._value_vocabulary(df, dataset_key)
+        return any(re.search(r"(?<![a-z0-9])" + re.escape(value.lower()) + r"(?![a-z0-9])", text)
+                   for values in vocab.values() for value in values)
+
+    def format_result(self, plan: QueryPlan, result) -> str:
+        header = plan.describe()
+        if isinstance(result, pd.DataFrame):
+            if result.empty:
+                return f"{header}: no matching rows."
+            return f"{header}:\n{result.to_string(index=False, max_colwidth=40)}"
+        if isinstance(result, pd.Series):
+            if result.empty:
+                return f"{header}: no matching rows."
+            lines = [f"- {key}: {self._format_value(value)}" for key, value in result.items()]
+            return f"{header}:\n" + "\n".join(lines)
+        return f"{header}: {self._format_value(result)}"
+
+    @staticmethod
+    def _format_value(value) -> str:
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return "n/a"
+        if isinstance(value, (int, np.integer)):
+            return f"{int(value):,}"
+        if isinstance(value, (float, np.floating)):
+            return f"{float(value):,.2f}" if not float(value).is_integer() else f"{int(value):,}"
+        return str(value)
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """Startup progress of the components warmed up in the background.
+
+    The app is live as soon as it answers requests and ready once every
+    registered component has finished warming up. A component that fails is
+    reported (overall status "degraded") instead of holding readiness back:
+    uploads, previews and data answers still work without a model.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._components: Dict[str, Dict] = {}
+
+    def register(self, name: str, state: str = "pending", detail: Optional[str] = None):
+        self._components[name] = {"state": state}
+        if detail:
+            self._components[name]["detail"] = detail
+
+    async def track(self, name: str, work: Awaitable):
+        """Await `work`, recording its state, duration and result or error."""
+        self.register(name, "loading")
+        started = time.perf_counter()
+        try:
+            result = await work
+        except asyncio.CancelledError:
+            self.register(name, "failed", "cancelled")
+            raise
+        except Exception as e:
+            logger.warning("Warm-up of %s failed: %s", name, e)
+            self.register(name, "failed", str(e))
+        else:
+            self.register(name, "ready")
+            if result:
+                self._components[name]["result"] = result
+        self._components[name]["seconds"] = round(time.perf_counter() - started, 3)
+
+    @property
+    def ready(self) -> bool:
+        return all(c["state"] not in ("pending", "loading") for c in self._components.values())
+
+    def snapshot(self) -> Dict:
+        states = [c["state"] for c in self._components.values()]
+        if not self.ready:
+            status = "starting"
+        elif "failed" in states:
+            status = "degraded"
+        else:
+            status = "ready"
+        return {
+            "status": status,
+            "live": True,
+            "ready": self.ready,
+            "uptime": round(time.time() - self.started, 3),
+            "components": {name: dict(c) for name, c in self._components.items()},
+        }
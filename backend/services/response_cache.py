@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from utils.shared_state import connect
+
+logger = logging.getLogger(__name__)
+
+# Entries kept in memory and on disk, and how long an entry stays valid
+CACHE_SIZE = int(os.environ.get("CSVAI_RESPONSE_CACHE_SIZE", "256"))
+DISK_CACHE_SIZE = int(os.environ.get("CSVAI_RESPONSE_CACHE_DISK_SIZE", "10000"))
+CACHE_TTL = float(os.environ.get("CSVAI_RESPONSE_CACHE_TTL", "86400"))
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation do not change the question."""
+    return re.sub(r"\s+", " ", question.strip().lower()).rstrip(" ?!.")
+
+
+def cache_key(dataset_version: Optional[str], question: str, history: List[Dict], params: Dict) -> str:
+    """Key for a response: dataset content, normalized question, the history
+    the prompt includes and the generation parameters."""
+    material = json.dumps(
+        [dataset_version, normalize_question(question),
+         [(m["role"], m["content"]) for m in history], params],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of model responses: an LRU dict in memory in front of a
+    SQLite table that survives restarts. Both tiers expire entries after
+    `ttl` seconds and evict the oldest beyond their size. Each entry records
+    how long the response took to produce so hits can report the time saved.
+    The SQLite tier is shared by every worker process.
+    """
+
+    def __init__(self, db_path: Optional[str], size: int = CACHE_SIZE,
+                 disk_size: int = DISK_CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.size = size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0,
+                          "bypassed": 0, "saved_seconds": 0.0}
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path and disk_size > 0:
+            try:
+                self._db = connect(db_path)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                    "created REAL NOT NULL, seconds REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning("Response cache disk tier disabled: %s", e)
+                self._db = None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] > self.ttl:
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                self._counters["saved_seconds"] += entry[2]
+                return entry[0]
+
+            row = self._disk_get(key, now)
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+            self._remember(key, row)
+            self._counters["disk_hits"] += 1
+            self._counters["saved_seconds"] += row[2]
+            return row[0]
+
+    def put(self, key: str, response: str, seconds: float):
+        """Store a response that took `seconds` to produce."""
+        entry = (response, time.time(), seconds)
+        with self._lock:
+            self._remember(key, entry)
+            self._counters["stores"] += 1
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, *entry))
+                self._db.execute(
+                    "DELETE FROM responses WHERE created < ? OR key IN ("
+                    "SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (entry[1] - self.ttl, self.disk_size),
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error("Error writing response cache: %s", e)
+
+    def record_bypass(self):
+        with self._lock:
+            self._counters["bypassed"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+            counters["hit_rate"] = round((lookups - counters["misses"]) / lookups, 4) if lookups else 0.0
+            counters["saved_seconds"] = round(counters["saved_seconds"], 3)
+            counters["memory_entries"] = len(self._memory)
+            counters["disk_entries"] = self._disk_count()
+            counters["ttl"] = self.ttl
+            return counters
+
+    def _remember(self, key: str, entry: Tuple[str, float, float]):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[str, float, float]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT response, created, seconds FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error("Error reading response cache: %s", e)
+            return None
+        return tuple(row) if row else None
+
+    def _disk_count(self) -> int:
+        if self._db is None:
+            return 0
+        try:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        except sqlite3.Error:
+            return 0
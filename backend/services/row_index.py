@@ -0,0 +1,128 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from utils.bm25_index import BM25Index
+from utils.shared_state import file_lock, lock_path_for
+
+logger = logging.getLogger(__name__)
+
+# Indexes kept loaded (their arrays are memory-mapped; the vocabulary is not)
+LOADED_INDEXES = 4
+# Re-rank BM25 candidates with a local embedding model (gpt4all Embed4All)
+EMBED_RERANK = os.environ.get("CSVAI_EMBED_RERANK", "0") == "1"
+EMBED_MODEL = os.environ.get("CSVAI_EMBED_MODEL")
+RERANK_CANDIDATES = 50
+# Rows scoring below this fraction of the best match are left out
+MIN_RELATIVE_SCORE = 0.5
+
+
+def row_text(row: pd.Series) -> str:
+    """Compact one-line rendering of a row, also used for embedding."""
+    return "; ".join(f"{col}={value}" for col, value in row.items() if not pd.isna(value))
+
+
+class RowIndexService:
+    """Builds row-retrieval indexes in the background and answers searches.
+
+    Builds run one at a time on a dedicated thread so uploads return as soon
+    as the data is cached; until an index is ready, searches return nothing
+    and chat simply goes without retrieved rows.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="row-index")
+        self._indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+        self._building: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._embedder = None
+        self._embed_lock = threading.Lock()
+        self._embed_failed = False
+
+    def schedule(self, dataset_key: str, df: pd.DataFrame, path: str, source_path: str):
+        """Build and save the dataset's index in the background unless one is
+        already loaded or being built."""
+        with self._lock:
+            if dataset_key in self._indexes or dataset_key in self._building:
+                return
+            self._building[dataset_key] = self._executor.submit(
+                self._build, dataset_key, df, path, source_path)
+
+    def _build(self, dataset_key: str, df: pd.DataFrame, path: str, source_path: str):
+        try:
+            # One worker process builds; the others wait and load what it saved
+            with file_lock(lock_path_for(source_path)):
+                index = BM25Index.load(path, source_path)
+                if index is not None and index.n_rows == len(df):
+                    self._remember(dataset_key, index)
+                    return
+                started = time.perf_counter()
+                index = BM25Index.build(df)
+                index.save(path)
+            self._remember(dataset_key, index)
+            logger.info("Built row index for %s: %d terms over %d columns in %.2fs", dataset_key,
+                        len(index.vocab), len(index.columns), time.perf_counter() - started)
+        except Exception:
+            logger.exception("Error building row index for %s", dataset_key)
+        finally:
+            with self._lock:
+                self._building.pop(dataset_key, None)
+
+    def _remember(self, dataset_key: str, index: BM25Index):
+        with self._lock:
+            self._indexes[dataset_key] = index
+            self._indexes.move_to_end(dataset_key)
+            while len(self._indexes) > LOADED_INDEXES:
+                self._indexes.popitem(last=False)
+
+    def get(self, dataset_key: str, path: str, source_path: str, n_rows: int) -> Optional[BM25Index]:
+        """The loaded index, else the one saved on disk if it covers `n_rows`
+        rows; None while building."""
+        with self._lock:
+            index = self._indexes.get(dataset_key)
+            if index is not None:
+                self._indexes.move_to_end(dataset_key)
+                return index
+            if dataset_key in self._building:
+                return None
+        index = BM25Index.load(path, source_path)
+        if index is None or index.n_rows != n_rows:
+            return None
+        self._remember(dataset_key, index)
+        return index
+
+    def search(self, index: BM25Index, df: pd.DataFrame, query: str, k: int) -> List[int]:
+        """Row positions most relevant to `query`, best first."""
+        rerank = EMBED_RERANK and not self._embed_failed
+        hits = index.search(query, RERANK_CANDIDATES if rerank else k)
+        if not hits:
+            return []
+        candidates = [row for row, score in hits if score >= hits[0][1] * MIN_RELATIVE_SCORE]
+        if not rerank:
+            return candidates
+        return self._rerank(query, df, candidates)[:k]
+
+    def _rerank(self, query: str, df: pd.DataFrame, rows: List[int]) -> List[int]:
+        """Order BM25 candidates by embedding similarity to the query."""
+        if len(rows) < 2:
+            return rows
+        texts = [row_text(df.iloc[row]) for row in rows]
+        try:
+            with self._embed_lock:
+                if self._embedder is None:
+                    from gpt4all import Embed4All
+                    self._embedder = Embed4All(EMBED_MODEL) if EMBED_MODEL else Embed4All()
+                vectors = np.asarray(self._embedder.embed([query] + texts), dtype=np.float32)
+        except Exception as e:
+            logger.warning("Embedding re-rank disabled: %s", e)
+            self._embed_failed = True
+            return rows
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+        similarity = vectors[1:] @ vectors[0]
+        return [rows[i] for i in np.argsort(-similarity, kind="stable")]
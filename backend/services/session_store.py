@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import zlib
+from typing import Dict, List, Tuple
+
+from utils.shared_state import connect
+
+# Messages kept per session; older ones are dropped (the prompt only replays
+# the last few, plus a one-line summary of what came before)
+MAX_MESSAGES = int(os.environ.get("CSVAI_HISTORY_MAX_MESSAGES", "200"))
+# Sessions without a new message for this long are deleted
+IDLE_DAYS = float(os.environ.get("CSVAI_SESSION_IDLE_DAYS", "30"))
+# Seconds between sweeps for idle sessions
+SWEEP_INTERVAL = 3600
+# Messages at least this long are stored zlib-compressed
+COMPRESS_MIN_BYTES = 512
+
+
+def _encode(content: str) -> Tuple[object, int]:
+    data = content.encode("utf-8")
+    if len(data) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            return packed, 1
+    return content, 0
+
+
+def _decode(content, compressed: int) -> str:
+    return zlib.decompress(content).decode("utf-8") if compressed else content
+
+
+class SessionStore:
+    """Chat histories in the shared state database.
+
+    Every worker process reads and appends to the same table, so a session's
+    messages can go to any worker and history survives restarts. Nothing is
+    held in memory: each session keeps at most `max_messages` (trimmed to
+    about three quarters of that, in whole exchanges, when exceeded, so a
+    live model session is only restarted now and then), long messages are
+    compressed, and sessions idle for `idle_days` are deleted.
+    """
+
+    def __init__(self, db_path: str, max_messages: int = MAX_MESSAGES, idle_days: float = IDLE_DAYS):
+        self.max_messages = max_messages
+        self.idle_seconds = idle_days * 86400
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        self._db = connect(db_path)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+            "role TEXT NOT NULL, content BLOB NOT NULL, created REAL NOT NULL, "
+            "compressed INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if "compressed" not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN compressed INTEGER NOT NULL DEFAULT 0")
+            self._db.commit()
+
+    def history(self, session_id: str) -> List[Dict]:
+        """The session's messages, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, content, compressed FROM messages WHERE session_id = ? ORDER BY id",
+                (session_id,),
+            ).fetchall()
+        return [{"role": role, "content": _decode(content, compressed)}
+                for role, content, compressed in rows]
+
+    def count(self, session_id: str) -> int:
+        with self._lock:
+            return self._count(session_id)
+
+    def page(self, session_id: str, offset: int, limit: int) -> Tuple[List[Dict], int]:
+        """Messages `offset` to `offset + limit` (oldest first) and the total."""
+        with self._lock:
+            total = self._count(session_id)
+            rows = self._db.execute(
+                "SELECT role, content, compressed, created FROM messages WHERE session_id = ? "
+                "ORDER BY id LIMIT ? OFFSET ?",
+                (session_id, limit, offset),
+            ).fetchall()
+        messages = [{"role": role, "content": _decode(content, compressed), "created": created}
+                    for role, content, compressed, created in rows]
+        return messages, total
+
+    def append(self, session_id: str, messages: List[Dict]):
+        """Add messages to the session in one transaction, trimming it if it
+        went over the cap."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO messages (session_id, role, content, compressed, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(session_id, m["role"], *_encode(m["content"]), now) for m in messages],
+            )
+            if self._count(session_id) > self.max_messages:
+                self._db.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND id <= ("
+                    "SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (session_id, session_id, self.max_messages * 3 // 8 * 2),
+                )
+
+    def _count(self, session_id: str) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def clear(self, session_id: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def evict_idle(self) -> List[str]:
+        """Delete sessions idle for longer than `idle_days`, at most once per
+        SWEEP_INTERVAL; returns the ids of the sessions deleted."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < SWEEP_INTERVAL:
+                return []
+            self._last_sweep = now
+            with self._db:
+                idle = [row[0] for row in self._db.execute(
+                    "SELECT session_id FROM messages GROUP BY session_id HAVING MAX(created) < ?",
+                    (now - self.idle_seconds,),
+                )]
+                self._db.executemany("DELETE FROM messages WHERE session_id = ?", [(s,) for s in idle])
+        return idle
+
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Backend modules import each other as top-level packages (see main.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Importing services creates the shared CSVService; keep its state out of uploads/
+os.environ.setdefault("CSVAI_UPLOAD_DIR", tempfile.mkdtemp(prefix="csvai-tests-"))
@@ -0,0 +1,66 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from utils.chunked_store import PROFILE_STATE_FILE, append_parts, write_parts
+from utils.dataset_profile import build_profile
+
+
+def _frame(start, stop):
+    ids = np.arange(start, stop)
+    return pd.DataFrame({
+        "Id": ids,
+        "Score": ids * 0.5,
+        "Region": np.array(["North", "South", "East"])[ids % 3],
+    })
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / "data.csv"
+    _frame(0, 250).to_csv(path, index=False)
+    parts, _ = write_parts(str(path), str(tmp_path / "data.parts"), chunk_rows=100)
+    return parts, path
+
+
+def _assert_matches(profile, df):
+    expected = build_profile(df)
+    assert profile["rows"] == expected["rows"]
+    for col in df.columns:
+        stats, want = profile["column_stats"][col], expected["column_stats"][col]
+        assert stats["nulls"] == want["nulls"]
+        assert stats["cardinality"] == want["cardinality"]
+        # Values with equal counts may come in either order
+        assert sorted(map(str, stats.get("top_values", []))) == sorted(map(str, want.get("top_values", [])))
+        if "mean" in want:
+            assert (stats["min"], stats["max"]) == (want["min"], want["max"])
+            assert stats["mean"] == pytest.approx(want["mean"])
+
+
+def test_appended_rows_update_the_saved_profile_state(store):
+    parts, path = store
+    with open(os.path.join(parts.path, PROFILE_STATE_FILE), "r", encoding="utf-8") as f:
+        assert json.load(f)["rows"] == 250
+    offset = os.path.getsize(path)
+    _frame(250, 400).to_csv(path, mode="a", header=False, index=False)
+    parts, profile = append_parts(parts, str(path), offset, os.path.getsize(path), chunk_rows=100)
+    assert parts.rows == 400 and len(parts.files) == 5
+    _assert_matches(profile, _frame(0, 400))
+    assert set(parts.load_builder().known_values()["Region"]) == {"North", "South", "East"}
+
+
+@pytest.mark.parametrize("state", [None, "not json", '{"rows": 250}', '{"rows": 7, "memory_bytes": 0, '
+                                   '"columns": {}, "sample_rows": []}'])
+def test_missing_or_unreadable_state_is_rebuilt_from_the_parts(store, state):
+    parts, _ = store
+    state_path = os.path.join(parts.path, PROFILE_STATE_FILE)
+    if state is None:
+        os.remove(state_path)
+    else:
+        with open(state_path, "w", encoding="utf-8") as f:
+            f.write(state)
+    _assert_matches(parts.load_builder().profile(), _frame(0, 250))
+    with open(state_path, "r", encoding="utf-8") as f:
+        assert json.load(f)["rows"] == 250
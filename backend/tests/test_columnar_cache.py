@@ -0,0 +1,33 @@
+import io
+
+import pandas as pd
+from utils.columnar_cache import read_cache, read_csv_chunked, write_cache
+
+
+def _csv(rows):
+    return ("\n".join(rows) + "\n").encode()
+
+
+def test_column_typed_differently_per_chunk_is_cached_as_text(tmp_path):
+    # Numbers in the first chunk, text in the second
+    data = _csv(["Code,Flag,Amount,Count"]
+                + [f"{i},{i % 2 == 1},{i * 1.5},{i}" for i in range(7000)]
+                + [f"A{i},{i % 3},x{i},{i}" for i in range(2010)])
+    df = read_csv_chunked(io.BytesIO(data), chunk_rows=7000)
+    cache = str(tmp_path / "data.arrow")
+    write_cache(df, cache)
+    cached = read_cache(cache)
+
+    expected = pd.read_csv(io.BytesIO(data), low_memory=False)
+    assert len(cached) == len(expected) == 9010
+    for col in ("Code", "Flag", "Amount"):
+        assert cached[col].astype(str).tolist() == expected[col].astype(str).tolist()
+    assert pd.api.types.is_integer_dtype(cached["Count"])
+    assert cached["Count"].tolist() == list(range(7000)) + list(range(2010))
+
+
+def test_all_null_chunk_keeps_numeric_column(tmp_path):
+    data = _csv(["Id,Score"] + [f"{i},{i}" for i in range(50)] + [f"{i}," for i in range(50, 100)])
+    df = read_csv_chunked(io.BytesIO(data), chunk_rows=50)
+    assert pd.api.types.is_numeric_dtype(df["Score"])
+    write_cache(df, str(tmp_path / "data.arrow"))
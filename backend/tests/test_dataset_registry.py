@@ -0,0 +1,69 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from services.dataset_registry import DatasetRegistry
+from utils.columnar_cache import MAX_CACHE_SEGMENTS, segment_paths
+
+
+def _frame(start, stop):
+    ids = np.arange(start, stop)
+    return pd.DataFrame({"Id": ids, "Region": np.array(["North", "South", "East"])[ids % 3]})
+
+
+def _age(directory):
+    # Timestamps are coarse; keep the CSV written next strictly newer than its cache
+    past = time.time() - 100
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name), (past, past))
+
+
+@pytest.fixture
+def loaded(tmp_path):
+    path = tmp_path / "data.csv"
+    _frame(0, 300).to_csv(path, index=False)
+    registry = DatasetRegistry(str(tmp_path))
+    dataset = registry.register("data", "data.csv", str(path))
+    registry.get_dataframe(dataset)
+    _age(tmp_path)
+    return registry, dataset
+
+
+def _append(registry, dataset, start, stop):
+    _frame(start, stop).to_csv(dataset.file_path, mode="a", header=False, index=False)
+    df = registry.get_dataframe(dataset)
+    _age(os.path.dirname(dataset.file_path))
+    return df
+
+
+def test_appended_rows_are_cached_as_segments(loaded, tmp_path):
+    registry, dataset = loaded
+    size = os.path.getsize(dataset.cache_path)
+    _append(registry, dataset, 300, 400)
+    df = _append(registry, dataset, 400, 500)
+    assert df["Id"].tolist() == list(range(500))
+    assert os.path.getsize(dataset.cache_path) == size
+    assert len(segment_paths(dataset.cache_path)) == 2
+
+    profile = registry.get_profile(dataset)
+    assert profile["rows"] == 500
+    assert profile["dtypes"] == {col: str(dtype) for col, dtype in df.dtypes.items()}
+    stats = profile["column_stats"]
+    assert (stats["Id"]["max"], stats["Id"]["cardinality"]) == (499, 500)
+    counts = {top["value"]: top["count"] for top in stats["Region"]["top_values"]}
+    assert counts == _frame(0, 500)["Region"].value_counts().to_dict()
+
+    # Another worker maps the cache and its segments
+    other = DatasetRegistry(str(tmp_path))
+    assert other.get_dataframe(other.register("data", "data.csv", dataset.file_path))["Id"].tolist() == list(range(500))
+
+
+def test_segments_are_merged_into_the_cache(loaded):
+    registry, dataset = loaded
+    for start in range(300, 300 + 10 * MAX_CACHE_SEGMENTS, 10):
+        df = _append(registry, dataset, start, start + 10)
+    assert df["Id"].tolist() == list(range(300 + 10 * MAX_CACHE_SEGMENTS))
+    assert len(segment_paths(dataset.cache_path)) < MAX_CACHE_SEGMENTS
+    assert registry.get_profile(dataset)["rows"] == len(df)
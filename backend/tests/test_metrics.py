@@ -0,0 +1,39 @@
+import re
+
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+
+
+@pytest.fixture(scope="module")
+def exposition():
+    client = TestClient(app)
+    client.get("/api/health/live")
+    client.get("/api/csv-info", params={"session_id": "metrics-test"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    return response.text
+
+
+def test_samples_match_their_declared_family(exposition):
+    families = {}
+    for line in exposition.splitlines():
+        declared = re.match(r"# (HELP|TYPE) (\S+)", line)
+        if declared:
+            families.setdefault(declared.group(2), set()).add(declared.group(1))
+    assert "csvai_http_requests_total" in families and "csvai_generated_tokens_total" in families
+    assert all(kinds == {"HELP", "TYPE"} for kinds in families.values())
+    suffixes = ("", "_bucket", "_sum", "_count")
+    for line in exposition.splitlines():
+        if line and not line.startswith("#"):
+            name = re.match(r"[a-zA-Z_:][\w:]*", line).group()
+            assert any(name[:len(name) - len(s)] in families for s in suffixes if name.endswith(s)), name
+
+
+def test_exposition_parses_with_counter_types(exposition):
+    parser = pytest.importorskip("prometheus_client.parser")
+    types = {family.name: family.type for family in parser.text_string_to_metric_families(exposition)}
+    assert types["csvai_http_requests"] == "counter"
+    assert types["csvai_generated_tokens"] == "counter"
+    assert types["csvai_http_request_duration_seconds"] == "histogram"
+    assert "unknown" not in types.values()
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import pytest
+from services.dataset_registry import DatasetRegistry
+from services.query_engine import VOCAB_CACHE_SIZE, QueryEngine, QueryError, QueryPlan
+
+
+@pytest.fixture(scope="module")
+def df():
+    rng = np.random.default_rng(0)
+    n = 1000
+    return pd.DataFrame({
+        "Name": [f"name{i}" for i in range(n)],
+        "Gender": pd.Categorical(rng.choice(["Male", "Female"], n)),
+        "Age": rng.integers(20, 60, n),
+        "Salary": rng.integers(30000, 120000, n),
+        "Department": rng.choice(["Sales", "HR", "Engineering"], n),
+        "Attrition": rng.choice(["Yes", "No"], n),
+    })
+
+
+@pytest.fixture
+def engine():
+    return QueryEngine()
+
+
+def answer(engine, df, question):
+    plan = engine.parse(question, df)
+    return None if plan is None else engine.execute(df, plan)
+
+
+
+def test_comparison_filters(engine, df):
+    assert answer(engine, df, "how many employees with age >= 30") == int((df["Age"] >= 30).sum())
+    assert answer(engine, df, "how many employees with salary below 50000") == int((df["Salary"] < 50000).sum())
+    between = (df["Age"] >= 30) & (df["Age"] <= 35)
+    assert answer(engine, df, "how many employees with age between 30 and 35") == int(between.sum())
+    rows = answer(engine, df, "show rows where age between 30 and 35")
+    assert len(rows) == 10 and rows["Age"].between(30, 35).all()
+
+
+def test_category_filters_and_combinations(engine, df):
+    expected = df.loc[(df["Gender"] == "Female") & (df["Department"] == "Engineering"), "Salary"].mean()
+    assert answer(engine, df, "average salary for females in engineering") == pytest.approx(expected)
+    assert answer(engine, df, "how many employees where attrition is yes") == int((df["Attrition"] == "Yes").sum())
+    assert answer(engine, df, "how many employees have attrition yes") == int((df["Attrition"] == "Yes").sum())
+
+
+def test_group_by(engine, df):
+    counts = answer(engine, df, "how many employees per department")
+    assert counts.to_dict() == df.groupby("Department").size().to_dict()
+    totals = answer(engine, df, "what is the sum of salary for males by department")
+    males = df[df["Gender"] == "Male"]
+    assert totals.to_dict() == males.groupby("Department")["Salary"].sum().to_dict()
+
+
+def test_ranked_groups_and_rows(engine, df):
+    means = df.groupby("Department")["Salary"].mean()
+    best = answer(engine, df, "which department has the highest average salary")
+    assert list(best.index) == [means.idxmax()]
+    top = answer(engine, df, "top 2 departments by average salary")
+    assert list(top.index) == list(means.sort_values(ascending=False).index[:2])
+    rows = answer(engine, df, "top 5 employees by salary")
+    assert rows["Salary"].tolist() == df["Salary"].nlargest(5).tolist()
+    assert answer(engine, df, "what is the highest salary") == df["Salary"].max()
+
+
+def test_distinct_count(engine, df):
+    assert answer(engine, df, "how many unique departments") == df["Department"].nunique()
+
+
+def test_model_plan_is_validated(engine, df):
+    plan = QueryEngine.parse_plan_text(
+        'Plan: {"op": "mean", "column": "Age", "group_by": null, '
+        '"filters": [{"column": "Department", "op": "!=", "value": "HR"}], "order": null, "limit": null}')
+    assert engine.execute(df, plan) == pytest.approx(df.loc[df["Department"] != "HR", "Age"].mean())
+    assert QueryEngine.parse_plan_text('{"op": "none"}') is None
+    with pytest.raises(QueryError):
+        engine.validate(QueryPlan(op="mean", column="Department"), df)
+
+@pytest.mark.parametrize("question", ["how many females are there?", "count the females",
+                                      "how many female employees"])
+def test_plural_value_mentions_filter(engine, df, question):
+    assert answer(engine, df, question) == int((df["Gender"] == "Female").sum())
+
+
+def test_plural_value_in_aggregate(engine, df):
+    expected = df.loc[df["Gender"] == "Male", "Age"].mean()
+    assert answer(engine, df, "what is the average age of males") == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("question", ["how many employees are not in sales",
+                                      "how many employees excluding sales",
+                                      "how many non-sales employees"])
+def test_negated_value_mentions_exclude(engine, df, question):
+    assert answer(engine, df, question) == int((df["Department"] != "Sales").sum())
+
+
+def test_negated_comparison_on_other_column(engine, df):
+    expected = df.loc[df["Department"] != "HR", "Salary"].mean()
+    assert answer(engine, df, "average salary other than HR") == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("question", [
+    "average salary of women",
+    "how many salaries are above the average",
+    "how many employees don't work in sales",
+    "how many male and female employees",
+    "how many employees in sales or hr",
+    "what percentage are female",
+    "number of employees older than 40",
+])
+def test_unparsed_conditions_go_to_the_model(engine, df, question):
+    assert engine.parse(question, df) is None
+
+
+def test_parsed_questions_still_answered(engine, df):
+    assert answer(engine, df, "how many employees with age over 40") == int((df["Age"] > 40).sum())
+    assert answer(engine, df, "count rows where gender is not female") == int((df["Gender"] != "Female").sum())
+    by_department = answer(engine, df, "average salary by department")
+    assert by_department.to_dict() == pytest.approx(df.groupby("Department")["Salary"].mean().to_dict())
+
+
+
+@pytest.mark.parametrize("question", ["what is the total salary of the top 5 employees",
+                                      "sum of salary for the first 10 rows",
+                                      "how many employees in the top 5"])
+def test_limited_aggregate_without_groups_goes_to_the_model(engine, df, question):
+    # Executing these would aggregate every row under a "(top N)" label
+    assert engine.parse(question, df) is None
+
+
+def test_limited_aggregate_plan_is_rejected(engine, df):
+    with pytest.raises(QueryError):
+        engine.validate(QueryPlan(op="sum", column="Salary", order="desc", limit=5), df)
+    engine.validate(QueryPlan(op="sum", column="Salary", group_by="Department", order="desc", limit=2), df)
+
+@pytest.mark.parametrize("question", ["show order 100042", "show orders 100042", "show order #100042",
+                                      "show order id 100042", "find orderid 100042"])
+def test_key_lookup_parses_to_equality(engine, question):
+    keys = pd.DataFrame({"OrderID": np.arange(100000, 101000), "Amount": np.arange(1000.0)})
+    plan = engine.parse(question, keys)
+    assert plan is not None and plan.op == "rows"
+    assert [(f.column, f.op, f.value) for f in plan.filters] == [("OrderID", "==", 100042)]
+
+
+def test_key_lookup_keeps_value_case_and_numbers(engine):
+    invoices = pd.DataFrame({"Invoice No": [f"INV-{i:05d}" for i in range(20000)]})
+    plan = engine.parse("show invoice INV-00042", invoices)
+    assert [(f.column, f.value) for f in plan.filters] == [("Invoice No", "INV-00042")]
+    customers = pd.DataFrame({"Customer ID": np.arange(100), "Amount": np.arange(100)})
+    plan = engine.parse("how many rows for customer 17", customers)
+    assert [(f.column, f.value) for f in plan.filters] == [("Customer ID", 17)]
+
+
+def test_key_lookup_is_answered_from_the_index(engine, tmp_path):
+    path = tmp_path / "orders.csv"
+    pd.DataFrame({"OrderID": np.arange(100000, 150000), "Amount": np.arange(50000) % 97}).to_csv(path, index=False)
+    registry = DatasetRegistry(str(tmp_path))
+    dataset = registry.register("orders", "orders.csv", str(path))
+    orders = registry.get_dataframe(dataset)
+
+    calls = []
+
+    def lookup(filters):
+        found = registry.lookup(dataset, orders, filters)
+        calls.append(found is not None)
+        return found
+
+    plan = engine.parse("show order 100042", orders)
+    rows = engine.execute(orders, plan, lookup=lookup)
+    assert calls == [True]
+    assert rows.to_dict("records") == [{"OrderID": 100042, "Amount": 42}]
+
+
+def test_value_vocabulary_cache_is_bounded(engine, df):
+    for version in range(VOCAB_CACHE_SIZE + 5):
+        engine.parse("how many females are there", df, dataset_key=f"dataset:{version}")
+    assert list(engine._vocab_cache) == [f"dataset:{v}" for v in range(5, VOCAB_CACHE_SIZE + 5)]
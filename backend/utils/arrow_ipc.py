@@ -0,0 +1,134 @@
+import io
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+from utils.record_stream import EXPORT_CHUNK_ROWS
+
+# Media type of the Arrow IPC streaming format
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def prefers_arrow(accept: Optional[str]) -> bool:
+    """True if an Accept header ranks the Arrow stream format at least as
+    high as JSON; a missing header or */* means JSON."""
+    quality = {}
+    for item in (accept or "").split(","):
+        media, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media.strip().lower()] = q
+    arrow = quality.get(ARROW_MEDIA_TYPE, 0.0)
+    return arrow > 0 and arrow >= quality.get("application/json", 0.0)
+
+
+def _supported(dtype: pa.DataType) -> bool:
+    """Types clients decode (see frontend/js/app.js): plain numbers,
+    booleans, text, timestamps and dates."""
+    return (pa.types.is_integer(dtype) or dtype in (pa.float32(), pa.float64(), pa.bool_())
+            or pa.types.is_string(dtype) or pa.types.is_large_string(dtype)
+            or pa.types.is_timestamp(dtype) or pa.types.is_date32(dtype))
+
+
+def _as_text(series: pd.Series) -> pa.Array:
+    return pa.array(series.astype(str).where(series.notna(), None), type=pa.large_string())
+
+
+def _convert(series: pd.Series) -> pa.Array:
+    """One column on its own; object columns Arrow cannot type become text."""
+    try:
+        return pa.array(series, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return _as_text(series)
+
+
+def _widened(dtype: pa.DataType) -> pa.DataType:
+    if pa.types.is_integer(dtype):
+        return pa.int64()
+    if pa.types.is_floating(dtype):
+        return pa.float64()
+    if pa.types.is_string(dtype):
+        return pa.large_string()
+    return dtype
+
+
+def to_table(frame: pd.DataFrame, metadata: Optional[Dict[str, object]] = None,
+             widen: bool = False) -> pa.Table:
+    """`frame` as an Arrow table of types every client decodes.
+
+    Numeric and Arrow-backed text columns are wrapped without copying.
+    Categoricals stay dictionary-encoded, with only the labels `frame` uses;
+    mixed-type and other columns are sent as text. With `widen` numbers
+    become 64-bit and categoricals plain text, so frames whose columns were
+    downcast differently still share one schema. `metadata` values are
+    stored as text in the schema metadata."""
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        arrays = table.columns
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        arrays = [_convert(frame.iloc[:, i]) for i in range(frame.shape[1])]
+    columns, fields = [], []
+    for i, column in enumerate(arrays):
+        categorical = pa.types.is_dictionary(column.type)
+        if categorical:
+            column = column.cast(column.type.value_type)
+        if pa.types.is_null(column.type) or not _supported(column.type):
+            column = _as_text(frame.iloc[:, i])
+        if widen:
+            column = column.cast(_widened(column.type))
+        else:
+            if pa.types.is_large_string(column.type) and column.nbytes < 2 ** 31:
+                # 32-bit offsets are enough for a page or a chunk
+                column = column.cast(pa.string())
+            if categorical:
+                column = column.dictionary_encode()
+        columns.append(column)
+        fields.append(pa.field(str(frame.columns[i]), column.type))
+    meta = {key: str(value) for key, value in (metadata or {}).items()}
+    return pa.Table.from_arrays(columns, schema=pa.schema(fields, metadata=meta))
+
+
+def table_bytes(table: pa.Table) -> bytes:
+    """A table as one Arrow IPC stream."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def iter_stream(frames: Union[pd.DataFrame, Iterable[pd.DataFrame]], columns: Optional[List[str]] = None,
+                chunk_rows: int = EXPORT_CHUNK_ROWS, widen: bool = False) -> Iterator[bytes]:
+    """Serialize frames (or just `columns`) as one Arrow IPC stream, one
+    record batch of up to `chunk_rows` rows at a time, so only one chunk is
+    held as bytes. The first frame sets the schema, even when empty; pass
+    `widen` when the frames' dtypes may differ."""
+    sink = io.BytesIO()
+    writer, schema = None, None
+    for frame in ([frames] if isinstance(frames, pd.DataFrame) else frames):
+        frame = frame[columns] if columns else frame
+        for start in range(0, max(len(frame), 1), chunk_rows):
+            table = to_table(frame.iloc[start:start + chunk_rows], widen=widen)
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_stream(sink, schema)
+            if len(table):
+                writer.write_table(table if table.schema == schema else table.cast(schema))
+            data = _take(sink)
+            if data:
+                yield data
+    if writer is not None:
+        writer.close()
+        yield _take(sink)
+
+
+def _take(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
@@ -0,0 +1,217 @@
+import json
+import logging
+import math
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from utils.shared_state import temp_path
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".bm25"
+K1 = 1.2
+B = 0.75
+
+_WORD = re.compile(r"[a-z0-9]+")
+# Dates, codes and decimals ("2018-12-21", "a.b") are also kept whole
+_COMPOUND = re.compile(r"[a-z0-9]+(?:[-./:][a-z0-9]+)+")
+
+
+def index_path_for(csv_path: str) -> str:
+    """Index directory stored next to the CSV and its columnar cache."""
+    return os.path.splitext(csv_path)[0] + INDEX_SUFFIX
+
+
+def tokenize(text: str) -> List[str]:
+    text = text.lower()
+    return _WORD.findall(text) + _COMPOUND.findall(text)
+
+
+def _value_texts(uniques) -> pd.Series:
+    """Distinct values as text; whole-number floats drop their ".0"."""
+    values = pd.Series(np.asarray(uniques))
+    if pd.api.types.is_float_dtype(values):
+        values = values.astype(np.int64)
+    return values.astype(str)
+
+
+def _indexable(series: pd.Series) -> bool:
+    """Text-like columns, integers and whole-number floats; other floats
+    (amounts, measurements) only add noise terms."""
+    if pd.api.types.is_float_dtype(series):
+        values = series.dropna().to_numpy()
+        return bool(len(values)) and bool(np.all(np.mod(values, 1) == 0))
+    return True
+
+
+class BM25Index:
+    """BM25 over a table, with each column scored as its own field.
+
+    Values are tokenized once per distinct value, not per row: a field is
+    stored as the row -> value-code array from factorizing the column, and
+    postings point at (field, code). A query scores the codes of each field
+    it touches, then gathers those scores into rows with one vectorized
+    lookup per field, so search cost does not depend on how text is spread
+    across rows.
+    """
+
+    def __init__(self, columns: List[str], vocab: Dict[str, int], offsets: np.ndarray,
+                 post_field: np.ndarray, post_code: np.ndarray, post_tf: np.ndarray,
+                 term_rows: np.ndarray, codes: List[np.ndarray], lengths: List[np.ndarray],
+                 n_rows: int):
+        self.columns = columns
+        self.vocab = vocab
+        self.offsets = offsets
+        self.post_field = post_field
+        self.post_code = post_code
+        self.post_tf = post_tf
+        self.term_rows = term_rows
+        self.codes = codes
+        self.lengths = lengths
+        self.n_rows = n_rows
+        self.avg_lengths = [
+            float(np.average(length, weights=np.bincount(c[c >= 0], minlength=len(length))))
+            if len(length) and (c >= 0).any() else 1.0
+            for c, length in zip(codes, lengths)
+        ]
+
+    @classmethod
+    def build(cls, df: pd.DataFrame) -> "BM25Index":
+        columns, codes, lengths = [], [], []
+        pair_fields, pair_codes, pair_tokens, pair_tfs, pair_rows = [], [], [], [], []
+        for col in df.columns:
+            series = df[col]
+            if not _indexable(series):
+                continue
+            field = len(columns)
+            col_codes, uniques = pd.factorize(series, use_na_sentinel=True)
+            col_codes = col_codes.astype(np.int32, copy=False)
+            rows_per_code = np.bincount(col_codes[col_codes >= 0], minlength=len(uniques))
+
+            texts = _value_texts(uniques)
+            if pd.api.types.is_numeric_dtype(series):
+                # A whole number is a single token: no tokenizer pass needed
+                value_codes = np.arange(len(uniques), dtype=np.int32)
+                value_tokens = texts.str.lstrip("-").to_numpy(dtype=object)
+                value_tfs = np.ones(len(uniques), dtype=np.float32)
+                field_lengths = np.ones(len(uniques), dtype=np.float32)
+            else:
+                # Tokenize each distinct value once, then count (value, token) pairs
+                tokens = texts.map(tokenize)
+                field_lengths = tokens.str.len().to_numpy(dtype=np.float32)
+                exploded = tokens.explode().dropna()
+                pairs = pd.DataFrame({"code": exploded.index.to_numpy(dtype=np.int32),
+                                      "token": exploded.to_numpy()})
+                counts = pairs.groupby(["code", "token"], sort=False).size()
+                value_codes = counts.index.get_level_values("code").to_numpy(dtype=np.int32)
+                value_tokens = counts.index.get_level_values("token").to_numpy()
+                value_tfs = counts.to_numpy(dtype=np.float32)
+            pair_fields.append(np.full(len(value_codes), field, dtype=np.int16))
+            pair_codes.append(value_codes)
+            pair_tokens.append(value_tokens)
+            pair_tfs.append(value_tfs)
+            pair_rows.append(rows_per_code[value_codes])
+
+            columns.append(str(col))
+            codes.append(col_codes)
+            lengths.append(field_lengths)
+
+        empty = np.array([], dtype=object)
+        terms, vocabulary = pd.factorize(np.concatenate(pair_tokens) if pair_tokens else empty)
+        vocab = {token: i for i, token in enumerate(vocabulary)}
+        order = np.argsort(terms, kind="stable")
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=offsets[1:])
+        # Rows containing each term, summed over fields
+        term_rows = np.bincount(terms, weights=np.concatenate(pair_rows) if pair_rows else None,
+                                minlength=len(vocab)).astype(np.int64)
+
+        def joined(parts, dtype):
+            return np.concatenate(parts)[order] if parts else np.array([], dtype=dtype)
+
+        return cls(
+            columns, vocab, offsets,
+            joined(pair_fields, np.int16), joined(pair_codes, np.int32), joined(pair_tfs, np.float32),
+            term_rows, codes, lengths, len(df),
+        )
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[int, float]]:
+        """Top `k` (row position, score) pairs; rows without a matching term are never returned."""
+        terms = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not terms or k <= 0:
+            return []
+        field_scores: Dict[int, np.ndarray] = {}
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            rows = self.term_rows[term]
+            idf = math.log(1 + (self.n_rows - rows + 0.5) / (rows + 0.5))
+            post_field = self.post_field[start:end]
+            for field in np.unique(post_field):
+                selected = post_field == field
+                value_codes = self.post_code[start:end][selected]
+                tf = self.post_tf[start:end][selected]
+                norm = K1 * (1 - B + B * self.lengths[field][value_codes] / self.avg_lengths[field])
+                # One extra slot stays zero for nulls (code -1)
+                scores = field_scores.setdefault(
+                    field, np.zeros(len(self.lengths[field]) + 1, dtype=np.float32))
+                scores[value_codes] += idf * tf * (K1 + 1) / (tf + norm)
+
+        total = np.zeros(self.n_rows, dtype=np.float32)
+        for field, scores in field_scores.items():
+            total += scores[self.codes[field]]
+        k = min(k, self.n_rows)
+        top = np.argpartition(-total, k - 1)[:k]
+        top = top[np.argsort(-total[top], kind="stable")]
+        return [(int(row), float(total[row])) for row in top if total[row] > 0]
+
+    # Persistence
+
+    def save(self, path: str):
+        """Write the index as a directory of .npy arrays plus metadata,
+        replacing any previous index atomically."""
+        tmp_path = temp_path(path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        arrays = {
+            "offsets": self.offsets, "post_field": self.post_field, "post_code": self.post_code,
+            "post_tf": self.post_tf, "term_rows": self.term_rows,
+        }
+        for i, (c, length) in enumerate(zip(self.codes, self.lengths)):
+            arrays[f"codes_{i}"] = c
+            arrays[f"lengths_{i}"] = length
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"columns": self.columns, "n_rows": self.n_rows, "vocab": self.vocab}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, source_path: str) -> Optional["BM25Index"]:
+        """Memory-map a saved index unless it is older than `source_path`."""
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        if os.path.exists(source_path) and os.path.getmtime(meta_path) < os.path.getmtime(source_path):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+
+            def array(name):
+                return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+            fields = range(len(meta["columns"]))
+            return cls(
+                meta["columns"], meta["vocab"], array("offsets"), array("post_field"),
+                array("post_code"), array("post_tf"), array("term_rows"),
+                [array(f"codes_{i}") for i in fields], [array(f"lengths_{i}") for i in fields],
+                meta["n_rows"],
+            )
+        except Exception as e:
+            logger.error("Error reading row index %s: %s", path, e)
+            return None
@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from utils.columnar_cache import (
+    CHUNK_ROWS,
+    cache_path_for,
+    combine_chunks,
+    downcast_dataframe,
+    write_cache,
+)
+from utils.dataset_profile import ProfileBuilder, load_builder, save_builder
+from utils.shared_state import temp_path
+
+# CSV files at least this large are kept on disk as columnar parts and
+# evaluated chunk by chunk instead of being loaded whole; 0 disables this
+OUT_OF_CORE_MB = int(os.environ.get("CSVAI_OUT_OF_CORE_MB", "2048"))
+
+PARTS_SUFFIX = ".parts"
+META_FILE = "meta.json"
+# ProfileBuilder state (JSON), so appended rows update the profile without a rescan
+PROFILE_STATE_FILE = "profile.state.json"
+
+
+def parts_path_for(csv_path: str) -> str:
+    """Directory of columnar parts stored next to the CSV."""
+    return os.path.splitext(csv_path)[0] + PARTS_SUFFIX
+
+
+def meta_path_for(csv_path: str) -> str:
+    return os.path.join(parts_path_for(csv_path), META_FILE)
+
+
+def wants_parts(csv_path: str, size: Optional[int] = None) -> bool:
+    """True if the CSV is (or, being `size` bytes, should be) stored as parts
+    rather than as one columnar cache that is loaded whole."""
+    if os.path.exists(meta_path_for(csv_path)):
+        return True
+    if OUT_OF_CORE_MB <= 0 or os.path.exists(cache_path_for(csv_path)):
+        return False
+    if size is None:
+        try:
+            size = os.path.getsize(csv_path)
+        except OSError:
+            return False
+    return size >= OUT_OF_CORE_MB * 1024 * 1024
+
+
+def read_part(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Memory-map one part, optionally just some of its columns."""
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+class PartStore:
+    """A dataset kept on disk as Feather files of up to CHUNK_ROWS rows each,
+    listed in meta.json. Nothing is held in memory but the list and, once
+    read, the first part (the sample questions are parsed against); every
+    scan maps in one part at a time."""
+
+    def __init__(self, path: str, meta: Dict):
+        self.path = path
+        self.columns: List[str] = meta["columns"]
+        self.files: List[str] = [part["file"] for part in meta["parts"]]
+        self.part_rows = np.array([part["rows"] for part in meta["parts"]], dtype=np.int64)
+        # Row number each part starts at
+        self.starts = np.concatenate([[0], np.cumsum(self.part_rows)])
+        self._sample: Optional[pd.DataFrame] = None
+
+    @classmethod
+    def open(cls, path: str) -> Optional["PartStore"]:
+        try:
+            with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+                return cls(path, json.load(f))
+        except FileNotFoundError:
+            return None
+
+    @property
+    def rows(self) -> int:
+        return int(self.starts[-1])
+
+    @property
+    def paths(self) -> List[str]:
+        return [os.path.join(self.path, name) for name in self.files]
+
+    @property
+    def sample(self) -> pd.DataFrame:
+        """The first part: every column, with real values, in little memory.
+        Text columns with few distinct values become categoricals listing
+        all of them, so values first seen in later parts are still known."""
+        if self._sample is None:
+            if not self.files:
+                return pd.DataFrame(columns=self.columns)
+            sample = read_part(self.paths[0])
+            for col, values in self.load_builder().known_values().items():
+                series = sample[col]
+                if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+                    continue
+                if not isinstance(series.dtype, pd.CategoricalDtype):
+                    series = series.astype("category")
+                missing = [v for v in values if isinstance(v, str) and v not in series.cat.categories]
+                sample[col] = series.cat.add_categories(missing) if missing else series
+            self._sample = sample
+        return self._sample
+
+    def read(self, index: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        return read_part(self.paths[index], columns)
+
+    def iter_frames(self, columns: Optional[List[str]] = None, start: int = 0,
+                    stop: Optional[int] = None) -> Iterator[pd.DataFrame]:
+        """Rows [start, stop) part by part, reading only the parts they span."""
+        stop = self.rows if stop is None else min(stop, self.rows)
+        if start >= stop:
+            return
+        first = int(np.searchsorted(self.starts, start, side="right")) - 1
+        for index in range(first, len(self.files)):
+            part_start = int(self.starts[index])
+            if part_start >= stop:
+                break
+            frame = self.read(index, columns)
+            yield frame.iloc[max(0, start - part_start):stop - part_start]
+
+    def slice(self, start: int, stop: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        frames = list(self.iter_frames(columns, start, stop))
+        if not frames:
+            return self.sample.iloc[:0] if columns is None else self.sample[columns].iloc[:0]
+        return combine_chunks([f.reset_index(drop=True) for f in frames]).reset_index(drop=True)
+
+    def load_builder(self) -> ProfileBuilder:
+        """The saved profile state of these parts; rebuilt from the parts and
+        saved again if it is missing, unreadable or for other rows."""
+        path = os.path.join(self.path, PROFILE_STATE_FILE)
+        builder = load_builder(path, self.rows)
+        if builder is None:
+            builder = ProfileBuilder()
+            for index in range(len(self.files)):
+                builder.add(self.read(index))
+            save_builder(builder, path)
+        return builder
+
+
+def _part_name(index: int) -> str:
+    return f"part-{index:06d}.arrow"
+
+
+def _write_part(directory: str, index: int, chunk: pd.DataFrame, builder: ProfileBuilder) -> Dict:
+    chunk = downcast_dataframe(chunk.reset_index(drop=True))
+    name = _part_name(index)
+    write_cache(chunk, os.path.join(directory, name))
+    builder.add(chunk)
+    return {"file": name, "rows": len(chunk)}
+
+
+def _seal(directory: str, columns: List[str], parts: List[Dict], builder: ProfileBuilder):
+    """Save the profile state, then meta.json; a store whose meta.json lists
+    a part is complete up to that part."""
+    save_builder(builder, os.path.join(directory, PROFILE_STATE_FILE))
+    meta_path = os.path.join(directory, META_FILE)
+    tmp_path = temp_path(meta_path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"columns": columns, "parts": parts}, f)
+    os.replace(tmp_path, meta_path)
+
+
+def write_parts(source, parts_path: str, chunk_rows: int = CHUNK_ROWS) -> Tuple[PartStore, Dict]:
+    """Parse a CSV path or binary file object into a new part store, one
+    chunk in memory at a time, profiling it on the way. Returns the store
+    and its profile.
+
+    The store is written to a temporary directory and renamed into place.
+    A source with a drain() method (TeeReader) is drained first, so the
+    copy it makes is complete and no newer than the store."""
+    tmp_dir = temp_path(parts_path)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    builder = ProfileBuilder()
+    columns, parts = None, []
+    with pd.read_csv(source, chunksize=chunk_rows, low_memory=False) as reader:
+        for chunk in reader:
+            columns = columns or [str(col) for col in chunk.columns]
+            parts.append(_write_part(tmp_dir, len(parts), chunk, builder))
+    if hasattr(source, "drain"):
+        source.drain()
+    _seal(tmp_dir, columns or [], parts, builder)
+    shutil.rmtree(parts_path, ignore_errors=True)
+    os.replace(tmp_dir, parts_path)
+    return PartStore.open(parts_path), builder.profile()
+
+
+class _ByteRange:
+    """File-like view of bytes [offset, end) of an open file."""
+
+    def __init__(self, f: IO[bytes], offset: int, end: int):
+        self.f = f
+        self.end = end
+        f.seek(offset)
+
+    def read(self, size: int = -1) -> bytes:
+        left = self.end - self.f.tell()
+        if left <= 0:
+            return b""
+        return self.f.read(left if size is None or size < 0 else min(size, left))
+
+
+def append_parts(store: PartStore, csv_path: str, offset: int, end: int,
+                 chunk_rows: int = CHUNK_ROWS) -> Tuple[PartStore, Dict]:
+    """Add the rows appended to a CSV between bytes `offset` (a row boundary)
+    and `end` as new parts, streaming them like write_parts. Readers keep
+    seeing the old parts until meta.json is replaced."""
+    builder = store.load_builder()
+    parts = [{"file": name, "rows": int(rows)} for name, rows in zip(store.files, store.part_rows)]
+    with open(csv_path, "rb") as f:
+        try:
+            with pd.read_csv(_ByteRange(f, offset, end), header=None, names=store.columns,
+                             chunksize=chunk_rows, low_memory=False) as reader:
+                for chunk in reader:
+                    parts.append(_write_part(store.path, len(parts), chunk, builder))
+        except pd.errors.EmptyDataError:
+            pass
+    _seal(store.path, store.columns, parts, builder)
+    return PartStore.open(store.path), builder.profile()
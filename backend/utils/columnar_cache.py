@@ -0,0 +1,246 @@
+import hashlib
+import io
+import os
+from typing import IO, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from utils.shared_state import temp_path
+
+# Rows parsed per chunk while ingesting a CSV
+CHUNK_ROWS = int(os.environ.get("CSVAI_CHUNK_ROWS", "200000"))
+# String columns whose unique/total ratio is at or below this become categoricals
+CATEGORY_RATIO = float(os.environ.get("CSVAI_CATEGORY_RATIO", "0.5"))
+
+CACHE_SUFFIX = ".arrow"
+# Rows appended to a CSV are cached as segment files next to its cache;
+# the write that would make this many merges them into the cache instead
+MAX_CACHE_SEGMENTS = int(os.environ.get("CSVAI_CACHE_SEGMENTS", "8"))
+SEGMENT_INFIX = ".segment-"
+
+
+class TeeReader:
+    """File-like wrapper that copies every byte read from `source` into `sink`.
+
+    Lets pandas parse an upload while the same bytes are written to disk, so the
+    file is only traversed once.
+    """
+
+    def __init__(self, source: IO[bytes], sink: IO[bytes]):
+        self.source = source
+        self.sink = sink
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        if data:
+            self.sink.write(data)
+            self.bytes_read += len(data)
+        return data
+
+    def drain(self, block_size: int = 1024 * 1024):
+        """Copy whatever the parser did not consume (e.g. trailing blank lines)
+        and flush the copy."""
+        while self.read(block_size):
+            pass
+        self.sink.flush()
+
+
+def content_hash(source: IO[bytes], block_size: int = 1024 * 1024) -> str:
+    """Hex digest identifying a file's contents; rewinds seekable sources."""
+    digest = hashlib.sha256()
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return digest.hexdigest()[:16]
+
+
+def cache_path_for(csv_path: str) -> str:
+    """Columnar cache file stored next to the CSV."""
+    return os.path.splitext(csv_path)[0] + CACHE_SUFFIX
+
+
+def segment_paths(cache_path: str) -> List[str]:
+    """Segments appended to a cache, oldest first."""
+    directory, name = os.path.split(cache_path)
+    prefix = name + SEGMENT_INFIX
+    try:
+        names = os.listdir(directory or ".")
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, n) for n in sorted(names)
+            if n.startswith(prefix) and n.endswith(CACHE_SUFFIX)]
+
+
+def is_cache_fresh(csv_path: str, cache_path: Optional[str] = None) -> bool:
+    """True if a cache exists and is not older than its CSV."""
+    cache_path = cache_path or cache_path_for(csv_path)
+    if not os.path.exists(cache_path):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    return os.path.getmtime(cache_path) >= os.path.getmtime(csv_path)
+
+
+def _downcast_float(series: pd.Series) -> pd.Series:
+    """Use float32 only when it round-trips every value exactly."""
+    values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    narrowed = values.astype(np.float32)
+    with np.errstate(invalid="ignore"):
+        lossless = (narrowed.astype(np.float64) == values) | np.isnan(values)
+    if lossless.all():
+        return pd.Series(narrowed, index=series.index, name=series.name)
+    return series
+
+
+def downcast_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """Shrink column dtypes: smallest int/float widths and categoricals for
+    low-cardinality strings. Works in place on the frame's columns."""
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(series):
+            df[col] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series):
+            df[col] = _downcast_float(series)
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            total = len(series)
+            if total and series.nunique(dropna=True) / total <= CATEGORY_RATIO:
+                df[col] = series.astype("category")
+    return df
+
+
+def _kind(series: pd.Series) -> str:
+    """Coarse type of a parsed column: "bool", "number", "datetime" or "text"."""
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "bool"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "number"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    return "text"
+
+
+def _as_text(series: pd.Series) -> pd.Series:
+    values = series.astype(object)
+    return values.where(values.isna(), values.astype(str))
+
+
+def combine_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate parsed chunks, merging per-chunk categoricals without going
+    through object dtype, then downcast the result once more.
+
+    Each chunk's dtypes are inferred on its own rows, so a column can be
+    numbers in one chunk and text in the next. Such columns become text in
+    every chunk, as a single parse of the whole file would have made them."""
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0]
+
+    columns = {}
+    for col in chunks[0].columns:
+        parts = [chunk[col] for chunk in chunks]
+        # All-null chunks parse as float and fit any other type
+        kinds = {_kind(part) for part in parts if part.notna().any()}
+        if len(kinds) > 1:
+            columns[col] = pd.concat([_as_text(part) for part in parts], ignore_index=True)
+            continue
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            try:
+                merged = pd.api.types.union_categoricals(parts, ignore_order=True)
+                columns[col] = pd.Series(merged, name=col)
+                continue
+            except TypeError:
+                # categories of different dtypes (e.g. an all-null chunk); fall through
+                pass
+        parts = [
+            part.astype(object) if isinstance(part.dtype, pd.CategoricalDtype) else part
+            for part in parts
+        ]
+        columns[col] = pd.concat(parts, ignore_index=True)
+    return downcast_dataframe(pd.DataFrame(columns))
+
+
+def read_csv_chunked(source, chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+    """Parse a CSV path or binary file object chunk by chunk, downcasting each
+    chunk before the next one is read so peak memory stays close to the
+    compact result instead of the fully-inflated text parse."""
+    chunks = []
+    with pd.read_csv(source, chunksize=chunk_rows, low_memory=False) as reader:
+        for chunk in reader:
+            chunks.append(downcast_dataframe(chunk))
+    df = combine_chunks(chunks)
+    return df.reset_index(drop=True)
+
+
+def read_csv_tail(path: str, offset: int, end: int, columns: List[str],
+                  chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+    """Parse only the rows appended to a CSV between bytes `offset` (a row
+    boundary) and `end`; `columns` names them since the header is not there."""
+    chunks = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = io.BytesIO(f.read(end - offset))
+    try:
+        with pd.read_csv(data, header=None, names=columns, chunksize=chunk_rows,
+                         low_memory=False) as reader:
+            for chunk in reader:
+                chunks.append(downcast_dataframe(chunk))
+    except pd.errors.EmptyDataError:
+        pass
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return combine_chunks(chunks).reset_index(drop=True)
+
+
+def write_cache(df: pd.DataFrame, cache_path: str):
+    """Write an uncompressed Arrow IPC (Feather v2) file so it can be memory-mapped.
+    Segments appended to an earlier cache at the same path are dropped."""
+    tmp_path = temp_path(cache_path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    for path in segment_paths(cache_path):
+        os.remove(path)
+    os.replace(tmp_path, cache_path)
+
+
+def append_segment(df: pd.DataFrame, cache_path: str):
+    """Cache appended rows as a new segment after the existing ones, without
+    rewriting the cache. The cache's mtime is then bumped, since freshness
+    checks against the CSV (and profiles and indexes checked against the
+    cache) go by it."""
+    segments = segment_paths(cache_path)
+    index = int(segments[-1][len(cache_path + SEGMENT_INFIX):-len(CACHE_SUFFIX)]) + 1 if segments else 1
+    write_cache(df, f"{cache_path}{SEGMENT_INFIX}{index:06d}{CACHE_SUFFIX}")
+    os.utime(cache_path)
+
+
+def cache_rows(cache_path: str) -> int:
+    """Rows in the cache and its segments, read from their metadata."""
+    return sum(feather.read_table(path, memory_map=True).num_rows
+               for path in [cache_path] + segment_paths(cache_path))
+
+
+def read_cache(cache_path: str) -> pd.DataFrame:
+    """Memory-map the cache; numeric columns without nulls are zero-copy views
+    on the mapped pages. Appended segments are concatenated to it, which
+    copies, until they are merged into the cache."""
+    table = feather.read_table(cache_path, memory_map=True)
+    df = table.to_pandas(split_blocks=True)
+    segments = segment_paths(cache_path)
+    if not segments:
+        return df
+    frames = [df] + [feather.read_table(path, memory_map=True).to_pandas(split_blocks=True)
+                     for path in segments]
+    return combine_chunks(frames).reset_index(drop=True)
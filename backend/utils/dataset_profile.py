@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from utils.shared_state import temp_path
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = ".profile.json"
+# ProfileBuilder state, so appended rows update the profile without a rescan
+PROFILE_STATE_SUFFIX = ".profile.state.json"
+TOP_K = 5
+SAMPLE_ROWS = 3
+# Columns with more distinct values than this get no top-k list
+TOP_K_MAX_CARDINALITY = 1000
+# Value hashes kept per column by ProfileBuilder; cardinalities up to this
+# are exact, larger ones are estimated from the smallest hashes
+SKETCH_SIZE = 4096
+
+
+def profile_path_for(csv_path: str) -> str:
+    """Profile file stored next to the CSV and its columnar cache."""
+    return os.path.splitext(csv_path)[0] + PROFILE_SUFFIX
+
+
+def profile_state_path_for(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + PROFILE_STATE_SUFFIX
+
+
+def _scalar(value):
+    """Convert numpy/pandas scalars into JSON-serializable Python values."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def _column_profile(series: pd.Series) -> Dict:
+    nulls = int(series.isna().sum())
+    cardinality = int(series.nunique(dropna=True))
+    column = {
+        "dtype": str(series.dtype),
+        "nulls": nulls,
+        "cardinality": cardinality,
+    }
+    is_numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+    if is_numeric and len(series) > nulls:
+        column["min"] = _scalar(series.min())
+        column["max"] = _scalar(series.max())
+        column["mean"] = round(float(series.mean()), 4)
+    if cardinality <= TOP_K_MAX_CARDINALITY and (not is_numeric or cardinality <= TOP_K * 4):
+        counts = series.value_counts(dropna=True).head(TOP_K)
+        column["top_values"] = [
+            {"value": _scalar(value), "count": int(count)} for value, count in counts.items()
+        ]
+    return column
+
+
+def build_profile(df: pd.DataFrame) -> Dict:
+    """Summarize a DataFrame once so info requests and prompts need no scan."""
+    return {
+        "rows": len(df),
+        "columns": len(df.columns),
+        "column_names": [str(col) for col in df.columns],
+        "dtypes": {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+        "memory_bytes": int(df.memory_usage(deep=True).sum()),
+        "column_stats": {str(col): _column_profile(df[col]) for col in df.columns},
+        "sample_rows": json.loads(
+            df.head(SAMPLE_ROWS).to_json(orient="records", date_format="iso")
+        ),
+    }
+
+
+def _common_dtype(dtypes: List[str]) -> str:
+    """The dtype a column's chunks would have once concatenated."""
+    if len(set(dtypes)) == 1:
+        return dtypes[0]
+    if all(dtype == "category" for dtype in dtypes):
+        return "category"
+    try:
+        return str(np.result_type(*[np.dtype(dtype) for dtype in dtypes]))
+    except TypeError:
+        return "object"
+
+
+def value_hashes(series: pd.Series, categorize: bool = True) -> np.ndarray:
+    """64-bit hashes of the non-null values; numbers are hashed as float64
+    so the same value hashes alike in chunks of different widths.
+    categorize=False is faster (and equivalent) when most values differ."""
+    series = series.dropna()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(object)
+    elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        series = series.astype(np.float64)
+    return pd.util.hash_array(series.to_numpy(), categorize=categorize)
+
+
+class _ColumnStats:
+    def __init__(self):
+        self.dtypes: List[str] = []
+        self.nulls = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # Smallest distinct value hashes (a k-minimum-values sketch)
+        self.sketch = np.empty(0, dtype=np.uint64)
+        # Value counts, until the column has too many distinct values
+        self.counts: Optional[Dict] = {}
+
+    def add(self, series: pd.Series):
+        dtype = str(series.dtype)
+        if dtype not in self.dtypes:
+            self.dtypes.append(dtype)
+        self.nulls += int(series.isna().sum())
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            valid = series.dropna()
+            if len(valid):
+                self.count += len(valid)
+                self.total += float(valid.to_numpy(dtype=np.float64).sum())
+                low, high = valid.min(), valid.max()
+                self.min = low if self.min is None else min(self.min, low)
+                self.max = high if self.max is None else max(self.max, high)
+
+        hashes = value_hashes(series)
+        if len(self.sketch) == SKETCH_SIZE:
+            hashes = hashes[hashes < self.sketch[-1]]
+        if len(hashes):
+            self.sketch = np.unique(np.concatenate([self.sketch, hashes]))[:SKETCH_SIZE]
+        if self.counts is not None:
+            if self.cardinality > TOP_K_MAX_CARDINALITY:
+                self.counts = None
+            else:
+                for value, count in series.value_counts(dropna=True).items():
+                    self.counts[value] = self.counts.get(value, 0) + int(count)
+
+    @property
+    def cardinality(self) -> int:
+        if len(self.sketch) < SKETCH_SIZE:
+            return len(self.sketch)
+        return int((SKETCH_SIZE - 1) / (float(self.sketch[-1]) / 2.0 ** 64))
+
+    def profile(self) -> Dict:
+        dtype = _common_dtype(self.dtypes)
+        cardinality = self.cardinality
+        column = {"dtype": dtype, "nulls": self.nulls, "cardinality": cardinality}
+        is_numeric = dtype not in ("object", "category", "bool") and self.count > 0
+        if is_numeric:
+            column["min"] = _scalar(self.min)
+            column["max"] = _scalar(self.max)
+            column["mean"] = round(self.total / self.count, 4)
+        if self.counts is not None and (not is_numeric or cardinality <= TOP_K * 4):
+            top = sorted(self.counts.items(), key=lambda item: -item[1])[:TOP_K]
+            column["top_values"] = [{"value": _scalar(value), "count": count} for value, count in top]
+        return column
+
+    def state(self) -> Dict:
+        return {
+            "dtypes": self.dtypes,
+            "nulls": self.nulls,
+            "count": self.count,
+            "total": self.total,
+            "min": _scalar(self.min),
+            "max": _scalar(self.max),
+            "sketch": self.sketch.tolist(),
+            # Values are not all strings, so not usable as JSON keys
+            "counts": None if self.counts is None else [[_scalar(v), c] for v, c in self.counts.items()],
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict) -> "_ColumnStats":
+        stats = cls()
+        stats.dtypes = list(state["dtypes"])
+        stats.nulls = int(state["nulls"])
+        stats.count = int(state["count"])
+        stats.total = float(state["total"])
+        stats.min, stats.max = state["min"], state["max"]
+        stats.sketch = np.array(state["sketch"], dtype=np.uint64)
+        counts = state["counts"]
+        stats.counts = None if counts is None else {value: int(count) for value, count in counts}
+        return stats
+
+
+class ProfileBuilder:
+    """Builds the same profile as build_profile from a stream of chunks, for
+    datasets never held in memory whole.
+
+    Only running totals are kept per column: null and value counts, sum,
+    min and max, and a sketch of the smallest value hashes from which
+    cardinalities above SKETCH_SIZE are estimated (within a few percent).
+    state() is plain JSON, so the builder can be saved and, restored with
+    from_state(), fed appended rows later.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.memory_bytes = 0
+        self.columns: Dict[str, _ColumnStats] = {}
+        self.sample_rows: List[Dict] = []
+
+    def add(self, chunk: pd.DataFrame):
+        if not self.columns:
+            self.columns = {str(col): _ColumnStats() for col in chunk.columns}
+        if len(self.sample_rows) < SAMPLE_ROWS:
+            head = chunk.head(SAMPLE_ROWS - len(self.sample_rows))
+            self.sample_rows += json.loads(head.to_json(orient="records", date_format="iso"))
+        self.rows += len(chunk)
+        self.memory_bytes += int(chunk.memory_usage(deep=True).sum())
+        for col in chunk.columns:
+            self.columns[str(col)].add(chunk[col])
+
+    def known_values(self) -> Dict[str, List]:
+        """Every distinct value of the columns that have at most
+        TOP_K_MAX_CARDINALITY of them."""
+        return {col: list(stats.counts) for col, stats in self.columns.items()
+                if stats.counts is not None}
+
+    def profile(self) -> Dict:
+        return {
+            "rows": self.rows,
+            "columns": len(self.columns),
+            "column_names": list(self.columns),
+            "dtypes": {col: _common_dtype(stats.dtypes) for col, stats in self.columns.items()},
+            "memory_bytes": self.memory_bytes,
+            "column_stats": {col: stats.profile() for col, stats in self.columns.items()},
+            "sample_rows": self.sample_rows,
+        }
+
+    def state(self) -> Dict:
+        return {
+            "rows": self.rows,
+            "memory_bytes": self.memory_bytes,
+            "columns": {col: stats.state() for col, stats in self.columns.items()},
+            "sample_rows": self.sample_rows,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict) -> "ProfileBuilder":
+        builder = cls()
+        builder.rows = int(state["rows"])
+        builder.memory_bytes = int(state["memory_bytes"])
+        builder.columns = {col: _ColumnStats.from_state(stats)
+                           for col, stats in state["columns"].items()}
+        builder.sample_rows = list(state["sample_rows"])
+        return builder
+
+
+def save_profile(profile: Dict, path: str):
+    tmp_path = temp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, path)
+
+
+def load_profile(path: str, source_path: str) -> Optional[Dict]:
+    """Read a saved profile unless it is older than `source_path`."""
+    if not os.path.exists(path):
+        return None
+    if os.path.exists(source_path) and os.path.getmtime(path) < os.path.getmtime(source_path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error("Error reading dataset profile %s: %s", path, e)
+        return None
+
+
+def save_builder(builder: ProfileBuilder, path: str):
+    tmp_path = temp_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(builder.state(), f)
+    os.replace(tmp_path, path)
+
+
+def load_builder(path: str, rows: int, source_path: Optional[str] = None) -> Optional[ProfileBuilder]:
+    """Restore a saved ProfileBuilder unless it covers a different number of
+    rows or is older than `source_path`. None when it is missing or cannot
+    be read, so the caller rebuilds it."""
+    try:
+        if (source_path and os.path.exists(source_path)
+                and os.path.getmtime(path) < os.path.getmtime(source_path)):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            builder = ProfileBuilder.from_state(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error("Error reading profile state %s: %s", path, e)
+        return None
+    return builder if builder.rows == rows else None
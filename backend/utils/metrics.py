@@ -0,0 +1,308 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds; covers cache hits (sub-millisecond) up to long generations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A metric family: one value (or histogram) per combination of label values."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def labels(self, *values: str):
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _default(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    @property
+    def family(self) -> str:
+        """Name HELP and TYPE declare; it must match the sample names."""
+        return self.name
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.family} {self.documentation}", f"# TYPE {self.family} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from `function` at scrape time."""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    @property
+    def family(self) -> str:
+        return f"{self.name}_total"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield f"{self.family}{_labels(self.labelnames, key)} {_number(child.get())}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(child.get())}"
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Application metrics
+
+HTTP_REQUESTS = Counter(
+    "csvai_http_requests", "HTTP requests by route and status", ["method", "route", "status"])
+HTTP_SECONDS = Histogram(
+    "csvai_http_request_duration_seconds",
+    "Time to the response headers (streamed bodies continue after)", ["method", "route"])
+STAGE_SECONDS = Histogram(
+    "csvai_stage_duration_seconds", "Time spent in each processing stage", ["stage"])
+GENERATED_TOKENS = Counter("csvai_generated_tokens", "Tokens generated by the model")
+TOKENS_PER_SECOND = Gauge(
+    "csvai_generation_tokens_per_second", "Generation speed of the most recent reply")
+PROMPT_TOKENS = Histogram(
+    "csvai_prompt_tokens", "Estimated tokens processed per generation", ["part"],
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192))
+QUEUE_DEPTH = Gauge("csvai_generation_queue_depth", "Generation requests running or waiting")
+MODELS_BUSY = Gauge("csvai_model_instances_busy", "Model instances currently generating")
+DATASETS_MEMORY = Gauge("csvai_datasets_memory_bytes", "Bytes of dataset frames held in memory")
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def span(stage: str):
+    """Time the enclosed block as `stage` in csvai_stage_duration_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def timed_iter(stage: str, iterator: Iterator) -> Iterator:
+    """Yield from `iterator`, counting only the time spent producing items as `stage`."""
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                return
+            elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        observe_stage(stage, elapsed)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them to the response headers.
+
+    Requests are labelled with the route they matched ("/api/csv-preview")
+    rather than the raw path, so unknown paths and mounted static files
+    collapse into "other" and "static" instead of exploding the label set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths: Dict[object, str] = {}
+
+    def _collect(self, routes, prefix: str = ""):
+        for route in routes:
+            included = getattr(route, "original_router", None)
+            if included is not None:
+                # Newer FastAPI keeps included routers nested instead of copying their routes
+                self._collect(included.routes, prefix + route.include_context.prefix)
+            elif getattr(route, "endpoint", None) is not None:
+                self._paths[route.endpoint] = prefix + route.path
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "other"
+        if not self._paths:
+            self._collect(scope["app"].routes)
+        # Mounted apps (the frontend, photos) have no route of their own
+        return self._paths.get(endpoint, "static")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                HTTP_SECONDS.labels(scope["method"], self._route(scope)).observe(
+                    time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            HTTP_REQUESTS.labels(scope["method"], self._route(scope), status["code"]).inc()
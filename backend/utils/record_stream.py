@@ -0,0 +1,86 @@
+import json
+import os
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import pandas as pd
+
+# Rows serialized per chunk when streaming records
+EXPORT_CHUNK_ROWS = int(os.environ.get("CSVAI_EXPORT_CHUNK_ROWS", "10000"))
+
+FORMATS = ("ndjson", "json")
+
+
+def _records_json(chunk: pd.DataFrame) -> str:
+    """Records of one chunk as a JSON array string."""
+    return chunk.to_json(orient="records", date_format="iso", force_ascii=False)
+
+
+def _chunks(frames: Iterable[pd.DataFrame], chunk_rows: int) -> Iterator[pd.DataFrame]:
+    for frame in frames:
+        for start in range(0, len(frame), chunk_rows):
+            yield frame.iloc[start:start + chunk_rows]
+
+
+def iter_records(df: Union[pd.DataFrame, Iterable[pd.DataFrame]], fmt: str = "ndjson",
+                 columns: Optional[List[str]] = None,
+                 chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[bytes]:
+    """Serialize `df` (or just `columns`) chunk by chunk, as newline-delimited
+    records or as one JSON array. Only one chunk is copied and held as text
+    at a time, so memory stays flat however large the frame is. `df` may
+    also be an iterable of frames, serialized one after another."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format: {fmt}")
+    if fmt == "json":
+        yield b"["
+    first = True
+    frames = [df] if isinstance(df, pd.DataFrame) else df
+    for chunk in _chunks(frames, chunk_rows):
+        if columns:
+            chunk = chunk[columns]
+        if fmt == "ndjson":
+            yield (chunk.to_json(orient="records", lines=True, date_format="iso",
+                                 force_ascii=False).rstrip("\n") + "\n").encode("utf-8")
+        else:
+            body = _records_json(chunk)[1:-1]
+            yield (body if first else "," + body).encode("utf-8")
+        first = False
+    if fmt == "json":
+        yield b"]"
+
+
+def columnar_json(frame: pd.DataFrame, meta: Dict[str, object]) -> bytes:
+    """`frame` as {"columns": [...], "data": {column: [values]}, **meta}.
+    Each column is encoded by pandas' C serializer straight from its
+    buffer, without building Python objects per value."""
+    columns = [str(col) for col in frame.columns]
+    data = ",".join(
+        json.dumps(col) + ":" + frame.iloc[:, i].to_json(orient="records", date_format="iso",
+                                                         force_ascii=False)
+        for i, col in enumerate(columns)
+    )
+    head = json.dumps({"columns": columns, **meta})
+    return (head[:-1] + ',"data":{' + data + "}}").encode("utf-8")
+
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """Gzip-compress a byte stream incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def json_excerpt(df: pd.DataFrame, max_chars: int, chunk_rows: int = 10) -> str:
+    """The start of `df` as a JSON array, serializing only the rows needed to
+    fill `max_chars` characters."""
+    parts, size = [], 0
+    for start in range(0, len(df), chunk_rows):
+        body = _records_json(df.iloc[start:start + chunk_rows])[1:-1]
+        parts.append(body)
+        size += len(body) + 1
+        if size >= max_chars:
+            break
+    return "[" + ",".join(parts) + "]"
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from utils.dataset_profile import value_hashes
+from utils.shared_state import temp_path
+from utils.sort_index import build_sort_index
+
+INDEX_SUFFIX = ".indexes"
+META_FILE = "meta.json"
+# Text columns with at least this many distinct values per non-null row are
+# keys and get a hash index for equality lookups
+KEY_RATIO = 0.9
+# Range lookups matching more than this share of the rows fall back to a
+# scan: putting that many positions back in row order costs more than one
+MAX_SELECTIVITY = 0.05
+
+SORTED = "sorted"
+DATES = "dates"
+HASH = "hash"
+
+_RANGE_OPS = (">", ">=", "<", "<=")
+# Filter operators an index can answer
+INDEX_OPS = ("==",) + _RANGE_OPS
+
+# (op, value) pairs that must all hold, as in a plan's filters on one column
+Conditions = List[Tuple[str, object]]
+
+
+def index_dir_for(csv_path: str) -> str:
+    """Directory of secondary indexes stored next to the CSV and its cache."""
+    return os.path.splitext(csv_path)[0] + INDEX_SUFFIX
+
+
+def index_path(directory: str, kind: str, column: str) -> str:
+    slug = re.sub(r"[^A-Za-z0-9_-]+", "_", column)[:40]
+    digest = hashlib.sha1(column.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(directory, f"{kind}-{slug}-{digest}")
+
+
+def choose_kind(series: pd.Series, ops: List[str], stats: Optional[Dict]) -> Optional[str]:
+    """The index that can answer filters with operators `ops` (INDEX_OPS) on
+    this column, if any: sorted values for numeric columns, a hash index
+    for equality on key-like text columns and parsed dates for range
+    comparisons on text."""
+    if not ops or pd.api.types.is_bool_dtype(series):
+        return None
+    if pd.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+        return SORTED
+    if "==" in ops:
+        non_null = len(series) - (stats or {}).get("nulls", 0)
+        if stats and non_null > 0 and stats.get("cardinality", 0) >= KEY_RATIO * non_null:
+            return HASH
+        return None
+    return DATES
+
+
+def _number(value) -> float:
+    """A filter value as QueryEngine.filter_mask compares it with numbers."""
+    return float(value.replace(",", "")) if isinstance(value, str) else float(value)
+
+
+def _dtype_kind(name: str) -> str:
+    try:
+        return np.dtype(name).kind
+    except TypeError:
+        return "O"
+
+
+class SortedIndex:
+    """Row positions in ascending value order, nulls last (the order pages
+    are sorted in), plus the sorted non-null values of numeric columns
+    (kind SORTED) or of text parsed as dates (kind DATES) for binary search.
+    Keys are stored as int64 or float64 so a search never converts them."""
+
+    def __init__(self, kind: str, positions: np.ndarray, n_valid: int,
+                 keys: Optional[np.ndarray], rows: int, source_dtype: str):
+        self.kind = kind
+        self.positions = positions
+        self.n_valid = n_valid
+        self.keys = keys
+        self.rows = rows
+        self.source_dtype = source_dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes + (self.keys.nbytes if self.keys is not None else 0)
+
+    @classmethod
+    def build(cls, series: pd.Series) -> "SortedIndex":
+        positions, n_valid = build_sort_index(series)
+        keys = None
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series) \
+                and not isinstance(series.dtype, pd.CategoricalDtype):
+            key_dtype = np.int64 if pd.api.types.is_integer_dtype(series) else np.float64
+            keys = series.to_numpy()[positions[:n_valid]].astype(key_dtype)
+        return cls(SORTED, positions, n_valid, keys, len(series), str(series.dtype))
+
+    @classmethod
+    def build_dates(cls, series: pd.Series) -> Optional["SortedIndex"]:
+        """Parse text the way filter_mask does for range filters; None if it
+        does not parse into plain (timezone-naive) datetimes."""
+        parsed = pd.to_datetime(series.astype(str), errors="coerce")
+        if not (isinstance(parsed.dtype, np.dtype) and parsed.dtype.kind == "M"):
+            return None
+        try:
+            values = parsed.to_numpy(dtype="datetime64[ns]").view(np.int64)
+        except (OverflowError, ValueError):
+            return None
+        valid = np.flatnonzero(parsed.notna().to_numpy())
+        order = valid[np.argsort(values[valid], kind="stable")]
+        dtype = np.int32 if len(series) < 2 ** 31 else np.int64
+        return cls(DATES, order.astype(dtype), len(order), values[order], len(series),
+                   str(series.dtype))
+
+    def lookup(self, conditions: Conditions) -> Optional[Tuple[np.ndarray, bool]]:
+        """Ascending positions of the rows meeting every condition, exactly,
+        or None if the lookup would match too many rows. The conditions
+        narrow one range of the sorted keys, so a two-sided range is found
+        even when each side alone matches most rows."""
+        if self.keys is None:
+            return None
+        lo, hi = 0, self.n_valid
+        for op, value in conditions:
+            key = self._key(value)
+            if key is None:
+                return None
+            low, high = self._bounds(op, key)
+            lo, hi = max(lo, low), min(hi, high)
+        if hi - lo > MAX_SELECTIVITY * self.rows:
+            return None
+        return np.sort(self.positions[lo:max(lo, hi)]), True
+
+    def _key(self, value):
+        """A filter value as a search key, or None if it cannot be one."""
+        if self.kind == DATES:
+            stamp = pd.to_datetime(str(value))
+            return None if stamp.tzinfo is not None else stamp.as_unit("ns").value
+        number = _number(value)
+        if math.isnan(number):
+            return None
+        if _dtype_kind(self.source_dtype) == "f":
+            # Compared at the column's precision, like pandas does
+            number = float(np.dtype(self.source_dtype).type(number))
+        return number
+
+    def _bounds(self, op: str, value) -> Tuple[int, int]:
+        keys = self.keys
+        if keys.dtype.kind == "i" and isinstance(value, float):
+            # Integer keys: turn the bound into an integer so the search
+            # does not convert every key to float
+            if op == "==" and not value.is_integer():
+                return 0, 0
+            clamped = min(max(value, -2.0 ** 63), 2.0 ** 63 - 1024)
+            low, high = math.floor(clamped), math.ceil(clamped)
+            value = {">": low, "<=": low, ">=": high, "<": high}.get(op, low)
+        left = lambda v: int(np.searchsorted(keys, v, side="left"))
+        right = lambda v: int(np.searchsorted(keys, v, side="right"))
+        if op == "==":
+            return left(value), right(value)
+        if op == ">":
+            return right(value), self.n_valid
+        if op == ">=":
+            return left(value), self.n_valid
+        if op == "<":
+            return 0, left(value)
+        return 0, right(value)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"positions": self.positions}
+        if self.keys is not None:
+            arrays["keys"] = self.keys
+        return arrays
+
+    def meta(self) -> Dict:
+        return {"kind": self.kind, "rows": self.rows, "n_valid": self.n_valid,
+                "source_dtype": self.source_dtype}
+
+    @classmethod
+    def from_saved(cls, meta: Dict, arrays: Dict[str, np.ndarray]) -> "SortedIndex":
+        return cls(meta["kind"], arrays["positions"], meta["n_valid"], arrays.get("keys"),
+                   meta["rows"], meta["source_dtype"])
+
+
+class HashIndex:
+    """Non-null rows grouped by the 64-bit hash of their value, with a
+    bucket directory on the top hash bits: finding a value's rows takes one
+    hash and a look at a bucket of about one entry. Hashes can collide, so
+    the rows found are candidates for the caller to check."""
+
+    kind = HASH
+
+    def __init__(self, hashes: np.ndarray, positions: np.ndarray, buckets: np.ndarray,
+                 rows: int, source_dtype: str):
+        self.hashes = hashes
+        self.positions = positions
+        self.buckets = buckets
+        self.rows = rows
+        self.source_dtype = source_dtype
+
+    @property
+    def bits(self) -> int:
+        return int(len(self.buckets) - 1).bit_length() - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.hashes.nbytes + self.positions.nbytes + self.buckets.nbytes
+
+    @classmethod
+    def build(cls, series: pd.Series) -> "HashIndex":
+        valid = np.flatnonzero(series.notna().to_numpy())
+        hashes = value_hashes(series, categorize=False)
+        order = np.argsort(hashes, kind="stable")
+        hashes = hashes[order]
+        dtype = np.int32 if len(series) < 2 ** 31 else np.int64
+        positions = valid[order].astype(dtype)
+        bits = max(1, min(24, int(len(hashes)).bit_length() - 1))
+        starts = np.arange(2 ** bits, dtype=np.uint64) << np.uint64(64 - bits)
+        buckets = np.append(np.searchsorted(hashes, starts), len(hashes)).astype(np.int64)
+        return cls(hashes, positions, buckets, len(series), str(series.dtype))
+
+    def lookup(self, conditions: Conditions) -> Optional[Tuple[np.ndarray, bool]]:
+        """Candidate positions for the first equality condition; None if
+        there is none."""
+        value = next((value for op, value in conditions if op == "=="), None)
+        if value is None:
+            return None
+        hashed = value_hashes(pd.Series([value], dtype=object))[0]
+        bucket = int(hashed >> np.uint64(64 - self.bits))
+        lo, hi = int(self.buckets[bucket]), int(self.buckets[bucket + 1])
+        found = self.positions[lo:hi][self.hashes[lo:hi] == hashed]
+        return np.sort(found), False
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"hashes": self.hashes, "positions": self.positions, "buckets": self.buckets}
+
+    def meta(self) -> Dict:
+        return {"kind": HASH, "rows": self.rows, "source_dtype": self.source_dtype}
+
+    @classmethod
+    def from_saved(cls, meta: Dict, arrays: Dict[str, np.ndarray]) -> "HashIndex":
+        return cls(arrays["hashes"], arrays["positions"], arrays["buckets"], meta["rows"],
+                   meta["source_dtype"])
+
+
+def build_index(kind: str, series: pd.Series):
+    """Build a column index of `kind`; None if the column cannot have one."""
+    if kind == HASH:
+        return HashIndex.build(series)
+    if kind == DATES:
+        return SortedIndex.build_dates(series)
+    return SortedIndex.build(series)
+
+
+def save_index(index, path: str):
+    """Write the index's arrays as .npy files plus meta.json (last, marking
+    it complete) to a temporary directory renamed into place."""
+    tmp_dir = temp_path(path)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in index.arrays().items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(index.meta(), f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_dir, path)
+
+
+def load_index(path: str, source_path: str, rows: int):
+    """Memory-map a saved index unless it is older than `source_path` (the
+    columnar cache) or covers a different number of rows."""
+    meta_path = os.path.join(path, META_FILE)
+    try:
+        if os.path.exists(source_path) and os.path.getmtime(meta_path) < os.path.getmtime(source_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["rows"] != rows:
+            return None
+        arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode="r")
+                  for name in os.listdir(path) if name.endswith(".npy")}
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    cls = HashIndex if meta["kind"] == HASH else SortedIndex
+    return cls.from_saved(meta, arrays)
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Seconds a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT = float(os.environ.get("CSVAI_DB_BUSY_TIMEOUT", "30"))
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite database shared by every worker process.
+
+    WAL journaling lets readers run while another process writes, and the
+    busy timeout makes concurrent writers wait for each other instead of
+    failing with "database is locked".
+    """
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on `path` (created if missing) for the block.
+
+    The lock is per open file, so it serializes threads of one process as
+    well as separate worker processes.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def lock_path_for(path: str) -> str:
+    """Lock file guarding the files derived from `path`."""
+    return os.path.splitext(path)[0] + ".lock"
+
+
+def temp_path(path: str) -> str:
+    """A temporary sibling of `path` private to this process, to be renamed
+    over it once written."""
+    return f"{path}.{os.getpid()}.tmp"
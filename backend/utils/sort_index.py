@@ -0,0 +1,43 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+# Up to this many rows are gathered as one-row slices rather than one take
+SMALL_TAKE = 32
+
+
+def build_sort_index(series: pd.Series) -> Tuple[np.ndarray, int]:
+    """Row positions of `series` in ascending order with nulls last, and the
+    number of non-null rows. Categoricals sort by their labels, not codes."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        labels = series.cat.categories.astype(str)
+        rank = np.empty(len(labels), dtype=np.int64)
+        rank[np.argsort(labels.to_numpy(), kind="stable")] = np.arange(len(labels))
+        codes = series.cat.codes.to_numpy()
+        valid = codes >= 0
+        keys = np.where(valid, rank[np.maximum(codes, 0)], len(labels))
+        index = np.argsort(keys, kind="stable")
+        n_valid = int(valid.sum())
+    else:
+        ordered = series.reset_index(drop=True).sort_values(kind="stable", na_position="last")
+        index = ordered.index.to_numpy()
+        n_valid = int(series.notna().sum())
+    dtype = np.int32 if len(series) < 2 ** 31 else np.int64
+    return index.astype(dtype, copy=False), n_valid
+
+
+def ordered_positions(index: np.ndarray, n_valid: int, descending: bool) -> np.ndarray:
+    """Row positions in the requested direction, keeping nulls last."""
+    if not descending:
+        return index
+    return np.concatenate([index[:n_valid][::-1], index[n_valid:]])
+
+
+def take_rows(df, positions: np.ndarray):
+    """df.iloc[positions] for a DataFrame or Series, faster for a few rows: a take from an Arrow
+    column of many chunks (as memory-mapped caches have) joins the chunks
+    first, while row slices are views."""
+    if 0 < len(positions) <= SMALL_TAKE:
+        return pd.concat([df.iloc[p:p + 1] for p in positions])
+    return df.iloc[positions]
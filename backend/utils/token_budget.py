@@ -0,0 +1,48 @@
+import re
+from typing import List, Tuple
+
+# Words, single digits and single symbols. Llama-style vocabularies split
+# numbers into digits, so data-heavy text costs far more than chars/4.
+_PIECES = re.compile(r"\d|[^\W\d_]+|[^\w\s]|_")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count: digits and symbols are one token each, words
+    about one token per four letters."""
+    count = 0
+    for piece in _PIECES.findall(text):
+        count += (len(piece) + 3) // 4 if piece[0].isalpha() else 1
+    return count
+
+
+def truncate(text: str, budget: int) -> str:
+    """Cut `text` so it fits in `budget` tokens, marking the cut."""
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) + 1 <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low].rstrip() + "…" if low else ""
+
+
+def fit_lines(lines: List[str], budget: int, keep_last: bool = False) -> Tuple[List[str], int]:
+    """Leading lines that fit in `budget` tokens, and the tokens they use.
+    With `keep_last` the final line (e.g. instructions) is kept first."""
+    kept, used = [], 0
+    last = []
+    if keep_last and lines:
+        tail_tokens = estimate_tokens(lines[-1]) + 1
+        if tail_tokens <= budget:
+            last, used = [lines[-1]], tail_tokens
+        lines = lines[:-1]
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return kept + last, used
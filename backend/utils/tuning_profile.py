@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import platform
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_NAME = "tuning_profile.json"
+PROFILE_VERSION = 1
+# Settings a profile may set; anything else in the file is informational
+SETTINGS = ("device", "n_threads", "n_batch", "n_ctx")
+
+
+def profile_path(model_dir: str) -> str:
+    """Where the tuning profile lives, unless CSVAI_TUNING_PROFILE points elsewhere."""
+    return os.environ.get("CSVAI_TUNING_PROFILE") or os.path.join(model_dir, PROFILE_NAME)
+
+
+def host_fingerprint() -> Dict:
+    """What a profile's measurements depend on besides the model."""
+    return {"cpu_count": os.cpu_count(), "machine": platform.machine(), "system": platform.system()}
+
+
+def save_profile(path: str, model_name: str, settings: Dict, measurements: Dict):
+    profile = {
+        "version": PROFILE_VERSION,
+        "model": model_name,
+        "host": host_fingerprint(),
+        "settings": {key: settings[key] for key in SETTINGS if key in settings},
+        "measurements": measurements,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_profile(path: str, model_name: str) -> Optional[Dict]:
+    """The profile's settings if it was measured for this model on this
+    kind of host; None (with the reason logged) otherwise."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring tuning profile %s: %s", path, e)
+        return None
+    if profile.get("version") != PROFILE_VERSION:
+        logger.warning("Ignoring tuning profile %s: unsupported version %s", path, profile.get("version"))
+        return None
+    if profile.get("model") != model_name:
+        logger.warning("Ignoring tuning profile %s: measured for %s, not %s",
+                       path, profile.get("model"), model_name)
+        return None
+    if profile.get("host") != host_fingerprint():
+        logger.warning("Ignoring tuning profile %s: measured on a different host %s", path, profile.get("host"))
+        return None
+    return {key: value for key, value in profile.get("settings", {}).items() if key in SETTINGS}
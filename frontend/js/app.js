@@ -20,6 +20,16 @@ const viewPreviewBtn = document.getElementById('viewPreviewBtn');
 const previewModal = document.getElementById('previewModal');
 const closePreviewBtn = document.getElementById('closePreviewBtn');
 const previewContent = document.getElementById('previewContent');
+const previewFilter = document.getElementById('previewFilter');
+const previewPrevBtn = document.getElementById('previewPrevBtn');
+const previewNextBtn = document.getElementById('previewNextBtn');
+const previewPageInfo = document.getElementById('previewPageInfo');
+
+// Preview paging state; pages are fetched from the server one at a time
+const PREVIEW_PAGE_SIZE = 50;
+// Pages are requested as Arrow IPC streams, falling back to JSON
+const ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream';
+const previewState = { offset: 0, sort: null, order: 'asc', total: 0 };
 
 // Event Listeners
 uploadBtn.addEventListener('click', () => csvFileInput.click());
@@ -28,6 +38,11 @@ sendBtn.addEventListener('click', sendMessage);
 clearChatBtn.addEventListener('click', clearChatHistory);
 viewPreviewBtn.addEventListener('click', showPreview);
 closePreviewBtn.addEventListener('click', () => previewModal.classList.remove('show'));
+previewPrevBtn.addEventListener('click', () => loadPreviewPage(previewState.offset - PREVIEW_PAGE_SIZE));
+previewNextBtn.addEventListener('click', () => loadPreviewPage(previewState.offset + PREVIEW_PAGE_SIZE));
+previewFilter.addEventListener('keypress', (e) => {
+    if (e.key === 'Enter') loadPreviewPage(0);
+});
 
 // Handle Enter key in chat input
 chatInput.addEventListener('keydown', (e) => {
@@ -55,6 +70,7 @@ async function handleFileUpload(event) {
 
     const formData = new FormData();
     formData.append('file', file);
+    formData.append('session_id', SESSION_ID);
 
     showUploadStatus('Uploading...', 'loading');
 
@@ -113,49 +129,281 @@ function displayCSVInfo(info) {
 
 // Show data preview
 async function showPreview() {
-    try {
-        const response = await fetch(`${API_BASE}/csv-preview?rows=10`);
-        if (!response.ok) throw new Error('Failed to fetch preview');
-
-        const data = await response.json();
-        displayPreview(data.preview);
+    previewState.offset = 0;
+    previewState.sort = null;
+    previewState.order = 'asc';
+    previewFilter.value = '';
+    if (await loadPreviewPage(0)) {
         previewModal.classList.add('show');
+    }
+}
+
+// Fetch one page of rows with the current sort and filter
+async function loadPreviewPage(offset) {
+    const params = new URLSearchParams({
+        session_id: SESSION_ID,
+        offset: Math.max(0, offset),
+        limit: PREVIEW_PAGE_SIZE,
+        order: previewState.order
+    });
+    if (previewState.sort) params.append('sort', previewState.sort);
+    previewFilter.value.split(',').map(f => f.trim()).filter(Boolean)
+        .forEach(f => params.append('filter', f));
 
+    try {
+        const response = await fetch(`${API_BASE}/csv-preview?${params}`, {
+            headers: { Accept: `${ARROW_MEDIA_TYPE}, application/json;q=0.9` }
+        });
+        const isArrow = (response.headers.get('content-type') || '').startsWith(ARROW_MEDIA_TYPE);
+        const data = isArrow ? arrowPage(decodeArrowStream(await response.arrayBuffer())) : await response.json();
+        if (!response.ok) throw new Error(data.detail || 'Failed to fetch preview');
+
+        previewState.offset = data.offset;
+        previewState.total = data.total;
+        displayPreview(data);
+        return true;
     } catch (error) {
         alert(`Error loading preview: ${error.message}`);
+        return false;
+    }
+}
+
+// Sort by a column, toggling the direction when it is already sorted
+function sortPreview(column) {
+    if (previewState.sort === column) {
+        previewState.order = previewState.order === 'asc' ? 'desc' : 'asc';
+    } else {
+        previewState.sort = column;
+        previewState.order = 'asc';
     }
+    loadPreviewPage(0);
 }
 
-// Display preview table
-function displayPreview(preview) {
-    if (!preview || preview.length === 0) {
+// Display preview table from a columnar page
+function displayPreview(page) {
+    const first = page.total === 0 ? 0 : page.offset + 1;
+    previewPageInfo.textContent = `${first}-${page.offset + page.rows} of ${page.total.toLocaleString()}`;
+    previewPrevBtn.disabled = page.offset === 0;
+    previewNextBtn.disabled = page.offset + page.rows >= page.total;
+
+    if (page.rows === 0) {
         previewContent.innerHTML = '<p>No data to display</p>';
         return;
     }
 
-    const columns = Object.keys(preview[0]);
+    const columns = page.columns;
     
     let html = '<table class="preview-table">';
     
     // Header
     html += '<thead><tr>';
     columns.forEach(col => {
-        html += `<th>${col}</th>`;
+        const arrow = previewState.sort === col ? (previewState.order === 'asc' ? ' ▲' : ' ▼') : '';
+        html += `<th class="sortable" data-column="${col}">${col}${arrow}</th>`;
     });
     html += '</tr></thead>';
     
     // Body
     html += '<tbody>';
-    preview.forEach(row => {
+    for (let i = 0; i < page.rows; i++) {
         html += '<tr>';
         columns.forEach(col => {
-            html += `<td>${row[col] !== null ? row[col] : ''}</td>`;
+            const value = page.data[col][i];
+            html += `<td>${value !== null ? value : ''}</td>`;
         });
         html += '</tr>';
-    });
+    }
     html += '</tbody></table>';
     
     previewContent.innerHTML = html;
+    previewContent.querySelectorAll('th.sortable').forEach(th => {
+        th.addEventListener('click', () => sortPreview(th.dataset.column));
+    });
+}
+
+// A page decoded from Arrow; its counts travel in the schema metadata
+function arrowPage(table) {
+    const page = { columns: table.columns, data: table.data };
+    ['offset', 'limit', 'rows', 'total'].forEach(key => { page[key] = Number(table.metadata[key]); });
+    return page;
+}
+
+// Decode an Arrow IPC stream into { columns, data: {column: values}, metadata }.
+// Covers what the server sends: integers, floats, booleans, text (plain or
+// dictionary-encoded), timestamps and dates, uncompressed
+function decodeArrowStream(buffer) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    const utf8 = new TextDecoder();
+
+    // Flatbuffer access: tables, their fields by index, strings and vectors
+    const table = (at) => ({ at, vtable: at - view.getInt32(at, true) });
+    const slot = (t, i) => {
+        const entry = 4 + 2 * i;
+        const offset = entry < view.getUint16(t.vtable, true) ? view.getUint16(t.vtable + entry, true) : 0;
+        return offset ? t.at + offset : 0;
+    };
+    const deref = (at) => at + view.getUint32(at, true);
+    const child = (t, i) => (slot(t, i) ? table(deref(slot(t, i))) : null);
+    const int8 = (t, i) => (slot(t, i) ? view.getInt8(slot(t, i)) : 0);
+    const int16 = (t, i) => (slot(t, i) ? view.getInt16(slot(t, i), true) : 0);
+    const int32 = (t, i) => (slot(t, i) ? view.getInt32(slot(t, i), true) : 0);
+    const int64 = (t, i) => (slot(t, i) ? Number(view.getBigInt64(slot(t, i), true)) : 0);
+    const vector = (t, i) => {
+        if (!slot(t, i)) return { start: 0, length: 0 };
+        const at = deref(slot(t, i));
+        return { start: at + 4, length: view.getUint32(at, true) };
+    };
+    const string = (t, i) => {
+        if (!slot(t, i)) return null;
+        const at = deref(slot(t, i));
+        return utf8.decode(bytes.subarray(at + 4, at + 4 + view.getUint32(at, true)));
+    };
+    const tables = (t, i) => {
+        const { start, length } = vector(t, i);
+        return Array.from({ length }, (_, k) => table(deref(start + 4 * k)));
+    };
+
+    // Schema.fbs: Field and the parts of its Type union read here
+    const readField = (f) => {
+        const typeId = int8(f, 2);
+        const type = child(f, 3);
+        const dictionary = child(f, 4);
+        const indexType = dictionary ? child(dictionary, 1) : null;
+        return {
+            name: string(f, 0),
+            typeId,
+            bitWidth: typeId === 2 ? int32(type, 0) : 0,
+            signed: typeId === 2 && int8(type, 1) !== 0,
+            unit: [3, 8, 10].includes(typeId) ? int16(type, 0) : 0,
+            dictionaryId: dictionary ? int64(dictionary, 0) : null,
+            indexWidth: indexType ? int32(indexType, 0) : 32
+        };
+    };
+
+    const readInt = (at, width, signed) => {
+        switch (width) {
+            case 8: return signed ? view.getInt8(at) : view.getUint8(at);
+            case 16: return signed ? view.getInt16(at, true) : view.getUint16(at, true);
+            case 32: return signed ? view.getInt32(at, true) : view.getUint32(at, true);
+            default: return Number(signed ? view.getBigInt64(at, true) : view.getBigUint64(at, true));
+        }
+    };
+    // Shortest decimal that reads back as the same float32, as JSON shows it
+    const float32 = (value) => {
+        for (let digits = 1; digits < 9; digits++) {
+            const shorter = parseFloat(value.toPrecision(digits));
+            if (Math.fround(shorter) === value) return shorter;
+        }
+        return value;
+    };
+    // ISO text like the JSON pages carry: UTC, milliseconds, no zone suffix
+    const isoTime = (ms) => new Date(ms).toISOString().slice(0, -1);
+    const floorDiv = (a, b) => (a % b < 0n ? a / b - 1n : a / b);
+
+    // Values of each field from a RecordBatch whose buffers start at `body`
+    const dictionaries = new Map();
+    const readBatch = (batch, body, fields) => {
+        const nodes = vector(batch, 1);
+        const buffers = vector(batch, 2);
+        let node = 0, next = 0;
+        const buffer = () => {
+            const at = buffers.start + 16 * next++;
+            return { at: body + Number(view.getBigInt64(at, true)), length: Number(view.getBigInt64(at + 8, true)) };
+        };
+        return fields.map(field => {
+            const at = nodes.start + 16 * node++;
+            const length = Number(view.getBigInt64(at, true));
+            const nullCount = Number(view.getBigInt64(at + 8, true));
+            const validity = buffer();
+            const valid = (i) => nullCount === 0 || validity.length === 0
+                || (bytes[validity.at + (i >> 3)] >> (i & 7)) & 1;
+            const values = new Array(length);
+            if (field.dictionaryId !== null) {
+                const data = buffer();
+                const labels = dictionaries.get(field.dictionaryId) || [];
+                const width = field.indexWidth / 8;
+                for (let i = 0; i < length; i++) {
+                    values[i] = valid(i) ? labels[readInt(data.at + i * width, field.indexWidth, true)] : null;
+                }
+            } else if (field.typeId === 5 || field.typeId === 20) {
+                // Utf8 has 32-bit offsets, LargeUtf8 64-bit ones
+                const offsets = buffer();
+                const data = buffer();
+                const width = field.typeId === 5 ? 4 : 8;
+                const offset = (i) => readInt(offsets.at + i * width, width * 8, true);
+                for (let i = 0; i < length; i++) {
+                    values[i] = valid(i) ? utf8.decode(bytes.subarray(data.at + offset(i), data.at + offset(i + 1))) : null;
+                }
+            } else if (field.typeId === 6) {
+                const data = buffer();
+                for (let i = 0; i < length; i++) {
+                    values[i] = valid(i) ? ((bytes[data.at + (i >> 3)] >> (i & 7)) & 1) === 1 : null;
+                }
+            } else {
+                const data = buffer();
+                for (let i = 0; i < length; i++) {
+                    if (!valid(i)) {
+                        values[i] = null;
+                    } else if (field.typeId === 2) {
+                        values[i] = readInt(data.at + i * field.bitWidth / 8, field.bitWidth, field.signed);
+                    } else if (field.typeId === 3) {
+                        // FloatingPoint precision: 1 single, 2 double
+                        values[i] = field.unit === 1 ? float32(view.getFloat32(data.at + i * 4, true))
+                            : view.getFloat64(data.at + i * 8, true);
+                    } else if (field.typeId === 10) {
+                        // Timestamp units: seconds, milli-, micro-, nanoseconds
+                        const raw = view.getBigInt64(data.at + i * 8, true);
+                        const ms = [raw * 1000n, raw, floorDiv(raw, 1000n), floorDiv(raw, 1000000n)][field.unit];
+                        values[i] = isoTime(Number(ms));
+                    } else if (field.typeId === 8) {
+                        // Date32: days since the epoch
+                        values[i] = isoTime(view.getInt32(data.at + i * 4, true) * 86400000);
+                    } else {
+                        throw new Error(`Unsupported Arrow type ${field.typeId} in column ${field.name}`);
+                    }
+                }
+            }
+            return values;
+        });
+    };
+
+    // Stream of messages: 0xFFFFFFFF, metadata length, Message flatbuffer, body
+    let fields = [];
+    const metadata = {};
+    const data = {};
+    let pos = 0;
+    while (pos + 4 <= buffer.byteLength) {
+        let length = view.getInt32(pos, true);
+        pos += 4;
+        if (length === -1) {
+            length = view.getInt32(pos, true);
+            pos += 4;
+        }
+        if (length === 0) break;
+        const message = table(deref(pos));
+        const headerType = int8(message, 1);
+        const header = child(message, 2);
+        const body = pos + length;
+        pos = body + int64(message, 3);
+        if (headerType === 1) {
+            fields = tables(header, 1).map(readField);
+            tables(header, 2).forEach(kv => { metadata[string(kv, 0)] = string(kv, 1); });
+            fields.forEach(field => { data[field.name] = []; });
+        } else if (headerType === 2) {
+            // DictionaryBatch: labels for dictionary-encoded fields, replaced or extended
+            const id = int64(header, 0);
+            const valueField = { ...fields.find(f => f.dictionaryId === id), dictionaryId: null };
+            const [labels] = readBatch(child(header, 1), body, [valueField]);
+            dictionaries.set(id, int8(header, 2) ? (dictionaries.get(id) || []).concat(labels) : labels);
+        } else if (headerType === 3) {
+            readBatch(header, body, fields).forEach((values, i) => {
+                const column = data[fields[i].name];
+                for (const value of values) column.push(value);
+            });
+        }
+    }
+    return { columns: fields.map(f => f.name), data, metadata };
 }
 
 // Send chat message
@@ -173,7 +421,7 @@ async function sendMessage() {
     chatInput.style.height = 'auto';
 
     try {
-        const response = await fetch(`${API_BASE}/chat`, {
+        const response = await fetch(`${API_BASE}/chat/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -184,10 +432,20 @@ async function sendMessage() {
             })
         });
 
+        if (response.status === 429) throw new Error('The model is busy, please try again in a moment');
         if (!response.ok) throw new Error('Failed to get response');
 
-        const data = await response.json();
-        addMessage(data.response, 'assistant');
+        const p = addMessage('', 'assistant');
+        await readEventStream(response, (event) => {
+            if (event.type === 'token') {
+                p.textContent += event.text;
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+            } else if (event.type === 'done') {
+                p.textContent = event.response;
+            } else if (event.type === 'error') {
+                p.textContent = `Error: ${event.detail}`;
+            }
+        });
 
     } catch (error) {
         addMessage(`Error: ${error.message}`, 'assistant');
@@ -216,6 +474,31 @@ function addMessage(text, role) {
     
     // Scroll to bottom
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return p;
+}
+
+// Read a Server-Sent Events response body, calling onEvent for each JSON event
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const data = chunk.split('\n')
+                .filter(line => line.startsWith('data: '))
+                .map(line => line.slice(6))
+                .join('\n');
+            if (data) onEvent(JSON.parse(data));
+        }
+    }
 }
 
 // Clear chat history
@@ -0,0 +1,540 @@
+"""Benchmark the CSV and chat endpoints with synthetic data and a stub model.
+
+Drives the app in-process (httpx's ASGI transport, no sockets) or over HTTP
+against a uvicorn server started by this script. The model is replaced by
+the deterministic fake in tools/fake_gpt4all.py, so results measure the app,
+not a model or GPU. Each dataset size runs in a fresh process with its own
+upload directory and reports:
+
+- startup: time until the app is live and until its warm-up has finished
+- upload: throughput of POST /api/upload
+- info, preview, sorted_preview, filtered_preview: latency percentiles
+- load: cold reload of the uploaded dataset (a server restart over HTTP,
+  dropping the in-memory frames in-process) and the first requests after it
+- chat: throughput and latency of /api/chat under concurrent sessions
+- peak_rss_bytes: peak resident memory of the process serving the app
+
+Results are written as JSON; `compare` reports changes between two runs.
+
+    python tools/benchmark.py run --rows 10000 1000000
+    python tools/benchmark.py run --mode http --rows 1000000 --concurrency 8
+    python tools/benchmark.py compare base.json head.json --threshold 0.1
+
+Synthetic CSVs (up to tens of millions of rows) are generated once and kept
+in --data-dir. Needs httpx, plus uvicorn for --mode http.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(TOOLS_DIR)
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "backend")
+SESSION = "bench"
+READY_TIMEOUT = 600
+
+# (metric path, higher is better) pairs reported by `compare`
+METRICS = [
+    ("startup.ready_seconds", False),
+    ("upload.rows_per_second", True),
+    ("info.p50_ms", False),
+    ("info.p99_ms", False),
+    ("preview.p50_ms", False),
+    ("preview.p99_ms", False),
+    ("sorted_preview.first_ms", False),
+    ("sorted_preview.p50_ms", False),
+    ("filtered_preview.p50_ms", False),
+    ("load.ready_seconds", False),
+    ("load.first_preview_ms", False),
+    ("chat.requests_per_second", True),
+    ("chat.tokens_per_second", True),
+    ("chat.latency.p90_ms", False),
+    ("peak_rss_bytes", False),
+]
+
+
+# Synthetic data
+
+def generate_csv(path: str, rows: int, seed: int = 0, chunk_rows: int = 1_000_000):
+    """Write an employee-style table of `rows` rows, a chunk at a time."""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    departments = np.array(["Sales", "Research", "HR", "IT", "Operations"])
+    genders = np.array(["Female", "Male"])
+    hire_dates = pd.date_range("2000-01-01", "2024-12-31", freq="D").strftime("%Y-%m-%d").to_numpy()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        for start in range(0, rows, chunk_rows):
+            n = min(chunk_rows, rows - start)
+            ids = np.arange(start, start + n)
+            pd.DataFrame({
+                "Employee_ID": ids,
+                "Age": rng.integers(18, 65, n),
+                "Gender": genders[rng.integers(0, len(genders), n)],
+                "Department": departments[rng.integers(0, len(departments), n)],
+                "Salary": rng.integers(30_000, 150_000, n),
+                "Revenue": np.round(rng.uniform(0, 2000, n), 2),
+                "Name": np.char.add("employee_", ids.astype(str)),
+                "Hire_Date": hire_dates[rng.integers(0, len(hire_dates), n)],
+            }).to_csv(f, header=start == 0, index=False)
+    os.replace(tmp_path, path)
+
+
+def ensure_csv(data_dir: str, rows: int, seed: int) -> str:
+    """Path of the synthetic CSV, generated in a child process if missing so
+    the generator's memory does not count against the benchmark."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"synthetic_{rows}_{seed}.csv")
+    if not os.path.exists(path):
+        print(f"Generating {rows} rows into {path}")
+        subprocess.run([sys.executable, __file__, "generate", path, "--rows", str(rows),
+                        "--seed", str(seed)], check=True)
+    return path
+
+
+# Measurement helpers
+
+def summarize(samples: List[float]) -> Dict:
+    """Latency percentiles in milliseconds for samples in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def self_peak_rss() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def process_peak_rss(pid: int) -> Optional[int]:
+    """Peak RSS of another process (Linux /proc only)."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def timed(request, *args, **kwargs):
+    started = time.perf_counter()
+    response = await request(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    response.raise_for_status()
+    return response, elapsed
+
+
+async def wait_for(client, path: str, timeout: float = READY_TIMEOUT) -> float:
+    """Seconds until `path` answers 200."""
+    import httpx
+
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if (await client.get(path)).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.05)
+    raise RuntimeError(f"{path} did not answer within {timeout}s")
+
+
+def bench_env(workdir: str) -> Dict[str, str]:
+    """Environment pointing the app at an empty upload directory and the stub model."""
+    model_dir = os.path.join(workdir, "model")
+    os.makedirs(model_dir, exist_ok=True)
+    open(os.path.join(model_dir, "bench.gguf"), "w").close()
+    return {
+        "CSVAI_UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "CSVAI_MODEL_DIR": model_dir,
+        "CSVAI_DEVICE": "cpu",
+    }
+
+
+# Targets
+
+class InProcessTarget:
+    """The app imported into this process and called through httpx's ASGI transport."""
+
+    def __init__(self):
+        self.app = None
+        self.client = None
+        self._lifespan = None
+
+    async def start(self) -> Dict:
+        import httpx
+
+        if self.app is None:
+            import fake_gpt4all
+            fake_gpt4all.install()
+            sys.path.insert(0, BACKEND_DIR)
+            import main
+            self.app = main.app
+        started = time.perf_counter()
+        self._lifespan = self.app.router.lifespan_context(self.app)
+        await self._lifespan.__aenter__()
+        live = time.perf_counter() - started
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.app),
+                                        base_url="http://bench", timeout=None)
+        await wait_for(self.client, "/api/health/ready")
+        return {"live_seconds": round(live, 4), "ready_seconds": round(time.perf_counter() - started, 4)}
+
+    async def reload(self) -> Dict:
+        """Drop every in-memory frame so the next request reloads from the cache."""
+        from services import csv_service
+
+        for dataset in csv_service.registry.recent(sys.maxsize):
+            dataset.release()
+        return {}
+
+    def peak_rss(self) -> Optional[int]:
+        return self_peak_rss()
+
+    async def stop(self):
+        await self.client.aclose()
+        await self._lifespan.__aexit__(None, None, None)
+
+
+class HttpTarget:
+    """A uvicorn server in a child process (this script's `serve` command)."""
+
+    def __init__(self, workdir: str):
+        self.log_path = os.path.join(workdir, "server.log")
+        self.process = None
+        self.client = None
+
+    async def start(self) -> Dict:
+        import httpx
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        started = time.perf_counter()
+        with open(self.log_path, "a", encoding="utf-8") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, __file__, "serve", "--port", str(port)],
+                stdout=log, stderr=subprocess.STDOUT,
+            )
+        self.client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None)
+        try:
+            await wait_for(self.client, "/api/health/live")
+            live = time.perf_counter() - started
+            await wait_for(self.client, "/api/health/ready")
+        except RuntimeError as e:
+            raise RuntimeError(f"{e}; see {self.log_path}") from e
+        return {"live_seconds": round(live, 4), "ready_seconds": round(time.perf_counter() - started, 4)}
+
+    async def reload(self) -> Dict:
+        """Restart the server; the dataset is found again in its upload directory."""
+        await self.stop()
+        return await self.start()
+
+    def peak_rss(self) -> Optional[int]:
+        return process_peak_rss(self.process.pid)
+
+    async def stop(self):
+        await self.client.aclose()
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# Scenario
+
+async def preview_latencies(client, rows: int, samples: int, rng: random.Random, **params) -> List[float]:
+    latencies = []
+    for i in range(samples):
+        offset = rng.randrange(max(1, rows - 50))
+        query = {"session_id": SESSION, "offset": offset, "limit": 50, **params}
+        if "sort" in params:
+            query["order"] = "desc" if i % 2 else "asc"
+        _, elapsed = await timed(client.get, "/api/csv-preview", params=query)
+        latencies.append(elapsed)
+    return latencies
+
+
+async def chat_load(client, concurrency: int, messages: int) -> Dict:
+    """`concurrency` sessions each sending `messages` uncached chat messages back to back."""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    tokens = 0
+
+    async def user(i: int):
+        nonlocal tokens
+        for j in range(messages):
+            started = time.perf_counter()
+            response = await client.post("/api/chat", json={
+                "message": f"Write a short note number {j} for reader {i}",
+                "session_id": f"{SESSION}-chat-{i}",
+                "cache": False,
+            })
+            statuses[response.status_code] += 1
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+                tokens += len(response.json()["response"].split())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": concurrency * messages,
+        "ok": statuses[200],
+        "rejected": statuses[429],
+        "errors": sum(n for status, n in statuses.items() if status not in (200, 429)),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(statuses[200] / elapsed, 3),
+        "tokens_per_second": round(tokens / elapsed, 3),
+        "latency": summarize(latencies),
+    }
+
+
+async def run_scenario(target, csv_path: str, rows: int, args) -> Dict:
+    rng = random.Random(args.seed)
+    size = os.path.getsize(csv_path)
+    result = {"rows": rows, "csv_bytes": size, "startup": await target.start()}
+    client = target.client
+    try:
+        with open(csv_path, "rb") as f:
+            _, elapsed = await timed(client.post, "/api/upload", data={"session_id": SESSION},
+                                     files={"file": (os.path.basename(csv_path), f, "text/csv")})
+        result["upload"] = {
+            "seconds": round(elapsed, 3),
+            "mb_per_second": round(size / elapsed / 1024 / 1024, 3),
+            "rows_per_second": round(rows / elapsed, 1),
+        }
+
+        info = []
+        for _ in range(args.samples):
+            _, elapsed = await timed(client.get, "/api/csv-info", params={"session_id": SESSION})
+            info.append(elapsed)
+        result["info"] = summarize(info)
+        result["preview"] = summarize(await preview_latencies(client, rows, args.samples, rng))
+        # The first sorted page builds the sort index; later pages reuse it
+        first = await preview_latencies(client, rows, 1, rng, sort="Salary")
+        result["sorted_preview"] = dict(
+            summarize(await preview_latencies(client, rows, args.samples, rng, sort="Salary")),
+            first_ms=round(first[0] * 1000, 3),
+        )
+        result["filtered_preview"] = summarize(await preview_latencies(
+            client, rows // 5, args.samples, rng, filter="Department=Sales"))
+
+        load = await target.reload()
+        client = target.client
+        _, elapsed = await timed(client.get, "/api/csv-info", params={"session_id": SESSION})
+        load["first_info_ms"] = round(elapsed * 1000, 3)
+        load["first_preview_ms"] = round((await preview_latencies(client, rows, 1, rng))[0] * 1000, 3)
+        result["load"] = load
+
+        if args.concurrency > 0 and args.messages > 0:
+            result["chat"] = await chat_load(client, args.concurrency, args.messages)
+        result["peak_rss_bytes"] = target.peak_rss()
+    finally:
+        await target.stop()
+    return result
+
+
+def scenario(args):
+    """One dataset size in this (fresh) process; writes its result to --output."""
+    workdir = tempfile.mkdtemp(prefix="csvai-bench-")
+    try:
+        os.environ.update(bench_env(workdir))
+        target = InProcessTarget() if args.mode == "inprocess" else HttpTarget(workdir)
+        result = asyncio.run(run_scenario(target, args.csv, args.rows, args))
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+    finally:
+        if args.keep:
+            print(f"Kept benchmark files in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Commands
+
+def git_revision() -> Dict:
+    def git(*command):
+        return subprocess.run(["git", *command], cwd=PROJECT_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def run(args):
+    revision = git_revision()
+    report = {
+        "meta": {
+            **revision,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "mode": args.mode,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {name: value for name, value in os.environ.items() if name.startswith("CSVAI_")},
+            "args": {key: value for key, value in vars(args).items() if key != "func"},
+        },
+        "results": [],
+    }
+    for rows in args.rows:
+        csv_path = ensure_csv(args.data_dir, rows, args.seed)
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            result_path = tmp.name
+        try:
+            command = [sys.executable, __file__, "scenario", "--csv", csv_path, "--rows", str(rows),
+                       "--mode", args.mode, "--samples", str(args.samples), "--seed", str(args.seed),
+                       "--concurrency", str(args.concurrency), "--messages", str(args.messages),
+                       "--output", result_path]
+            if args.keep:
+                command.append("--keep")
+            subprocess.run(command, check=True)
+            with open(result_path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+        finally:
+            os.remove(result_path)
+        report["results"].append(result)
+        chat = result.get("chat", {})
+        print(f"{rows:>11,} rows: upload {result['upload']['mb_per_second']} MB/s, "
+              f"preview p50 {result['preview']['p50_ms']} ms, "
+              f"chat {chat.get('requests_per_second', '-')} req/s, "
+              f"peak RSS {(result['peak_rss_bytes'] or 0) / 1024 / 1024:.0f} MB")
+
+    output = args.output or f"benchmark-{revision['commit'] or 'local'}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+
+def metric(result: Dict, path: str) -> Optional[float]:
+    value = result
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(args) -> int:
+    """Print per-metric changes from `base` to `head`; exit status 1 if any
+    metric got worse by more than --threshold."""
+    with open(args.base, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.head, "r", encoding="utf-8") as f:
+        head = json.load(f)
+    print(f"base {base['meta'].get('commit')} ({base['meta']['mode']}) -> "
+          f"head {head['meta'].get('commit')} ({head['meta']['mode']})")
+    if base["meta"]["mode"] != head["meta"]["mode"]:
+        print("warning: the runs used different modes; latencies are not comparable")
+    base_results = {r["rows"]: r for r in base["results"]}
+    regressions = 0
+    for head_result in head["results"]:
+        base_result = base_results.get(head_result["rows"])
+        if base_result is None:
+            continue
+        print(f"\n{head_result['rows']:,} rows")
+        for path, higher_is_better in METRICS:
+            before, after = metric(base_result, path), metric(head_result, path)
+            if before is None or after is None or before == 0:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > args.threshold else ""
+            regressions += bool(flag)
+            print(f"  {path:<28} {before:>14.3f} -> {after:>14.3f}  {change:+7.1%}{flag}")
+    print(f"\n{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def serve(args):
+    """Run the app under uvicorn with the stub model (used by --mode http)."""
+    import fake_gpt4all
+    import uvicorn
+
+    fake_gpt4all.install()
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(BACKEND_DIR)
+    uvicorn.run("main:app", host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_scenario_options(command):
+        command.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+        command.add_argument("--samples", type=int, default=50, help="requests per latency measurement")
+        command.add_argument("--concurrency", type=int, default=4, help="concurrent chat sessions (0 skips chat)")
+        command.add_argument("--messages", type=int, default=5, help="chat messages per session")
+        command.add_argument("--seed", type=int, default=0)
+        command.add_argument("--keep", action="store_true", help="keep uploads and server logs")
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write a JSON report")
+    run_parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    run_parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "csvai-bench-data"))
+    run_parser.add_argument("--output", help="report path (default benchmark-<commit>.json)")
+    add_scenario_options(run_parser)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    compare_parser.set_defaults(func=compare)
+
+    generate_parser = commands.add_parser("generate", help="write a synthetic CSV")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--rows", type=int, required=True)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.set_defaults(func=lambda a: generate_csv(a.path, a.rows, a.seed))
+
+    scenario_parser = commands.add_parser("scenario", help=argparse.SUPPRESS)
+    scenario_parser.add_argument("--csv", required=True)
+    scenario_parser.add_argument("--rows", type=int, required=True)
+    scenario_parser.add_argument("--output", required=True)
+    add_scenario_options(scenario_parser)
+    scenario_parser.set_defaults(func=scenario)
+
+    serve_parser = commands.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Deterministic stand-in for gpt4all.GPT4All, used by tools/benchmark.py.
+
+Replies are drawn from a fixed vocabulary seeded by the prompt, so the same
+prompt always gets the same reply, and are emitted at a configurable token
+rate. Query-plan prompts get {"op": "none"} so the app falls back to chat.
+
+    CSVAI_BENCH_TOKEN_RATE     tokens per second (default 50; 0 = no delay)
+    CSVAI_BENCH_REPLY_TOKENS   tokens per reply (default 64)
+    CSVAI_BENCH_LOAD_SECONDS   simulated model load time (default 0)
+"""
+import contextlib
+import os
+import random
+import sys
+import time
+import types
+import zlib
+
+TOKEN_RATE = float(os.environ.get("CSVAI_BENCH_TOKEN_RATE", "50"))
+REPLY_TOKENS = int(os.environ.get("CSVAI_BENCH_REPLY_TOKENS", "64"))
+LOAD_SECONDS = float(os.environ.get("CSVAI_BENCH_LOAD_SECONDS", "0"))
+
+VOCABULARY = (
+    "the data shows that most rows fall within a narrow range while a few "
+    "outliers stand out across departments and the average value is stable"
+).split()
+
+
+class FakeGPT4All:
+    """The subset of the GPT4All API that AIService uses."""
+
+    def __init__(self, model_name, model_path=None, device=None, n_threads=None, **kwargs):
+        if LOAD_SECONDS:
+            time.sleep(LOAD_SECONDS)
+        self.model_name = model_name
+        self.device = device or "cpu"
+        self._system_prompt = ""
+
+    @contextlib.contextmanager
+    def chat_session(self, system_prompt=None, prompt_template=None):
+        self._system_prompt = system_prompt or ""
+        try:
+            yield self
+        finally:
+            self._system_prompt = ""
+
+    def generate(self, prompt, max_tokens=200, streaming=False, callback=None, **kwargs):
+        tokens = self._reply(prompt, max_tokens)
+        if streaming:
+            return self._emit(tokens, callback)
+        return "".join(self._emit(tokens, callback))
+
+    def _reply(self, prompt, max_tokens):
+        if "JSON query plan" in self._system_prompt:
+            return ['{"op": "none"}']
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        return [rng.choice(VOCABULARY) + " " for _ in range(min(REPLY_TOKENS, max_tokens))]
+
+    @staticmethod
+    def _emit(tokens, callback):
+        delay = 1.0 / TOKEN_RATE if TOKEN_RATE > 0 else 0.0
+        for token_id, token in enumerate(tokens):
+            if delay:
+                time.sleep(delay)
+            if callback is not None and callback(token_id, token) is False:
+                return
+            yield token
+
+
+def install():
+    """Make `from gpt4all import GPT4All` return FakeGPT4All, whether or not
+    gpt4all is installed. Call before the app loads its model."""
+    module = types.ModuleType("gpt4all")
+    module.GPT4All = FakeGPT4All
+    sys.modules["gpt4all"] = module
@@ -0,0 +1,313 @@
+"""Find the fastest CPU settings for the GPT4All model on this host.
+
+Sweeps thread counts, n_batch and n_ctx over several prompt sizes and
+measures prompt-processing and generation speed (tokens/sec) and peak memory.
+Each model load runs in a child process, so memory readings are clean and one
+configuration cannot affect the next. The sweep is staged to keep the number
+of model loads small:
+
+1. threads: every candidate with the default n_ctx and a mid-size batch
+2. n_batch: every candidate (one load) with the best thread count
+3. n_ctx: every candidate with the best threads and batch; the largest
+   context whose speed is within --tolerance of the best and whose peak
+   memory fits in --max-memory-mb wins
+
+Configurations are ranked by the estimated time of a reference request
+(--ref-prompt tokens in, --ref-output tokens out). The winner is written as a
+tuning profile (ai Model/tuning_profile.json by default, or
+CSVAI_TUNING_PROFILE), which AIService applies at startup when it was
+measured for the same model and host; CSVAI_* env vars still override it.
+
+    python tools/sweep_cpu_params.py
+    python tools/sweep_cpu_params.py --threads 4 6 8 --batches 64 256 --contexts 2048 4096
+    python tools/sweep_cpu_params.py --dry-run          # measure, print, don't write
+
+Token counts use the app's estimator (backend/utils/token_budget.py); the
+gpt4all bindings do not expose the model's tokenizer.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(TOOLS_DIR)
+BACKEND_DIR = os.path.join(PROJECT_ROOT, "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+from utils.token_budget import estimate_tokens  # noqa: E402
+from utils.tuning_profile import profile_path, save_profile  # noqa: E402
+
+# Headroom left in the context beyond prompt and output (chat template etc.)
+CONTEXT_HEADROOM = 64
+
+
+def default_model_dir() -> str:
+    return os.environ.get("CSVAI_MODEL_DIR") or os.path.join(PROJECT_ROOT, "ai Model")
+
+
+def default_threads() -> List[int]:
+    cores = os.cpu_count() or 1
+    candidates = {cores, max(1, cores // 2), max(1, cores - 1)}
+    power = 1
+    while power < cores:
+        candidates.add(power)
+        power *= 2
+    return sorted(candidates)
+
+
+def total_memory_mb() -> Optional[float]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 / 1024
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round((peak if sys.platform == "darwin" else peak * 1024) / 1024 / 1024, 1)
+
+
+def make_prompt(tokens: int) -> str:
+    """A data-like prompt of about `tokens` tokens."""
+    lines = ["Summarize the following records in one sentence."]
+    i = 0
+    while estimate_tokens("\n".join(lines)) < tokens:
+        lines.append(f"record {i}: department sales, age {20 + i % 40}, salary {40000 + i * 37}")
+        i += 1
+    return "\n".join(lines)
+
+
+# Worker: one model load, several generations
+
+def measure(config: Dict) -> Dict:
+    """Load the model once and time each (n_batch, prompt size) pair."""
+    if config.get("stub"):
+        import fake_gpt4all
+        fake_gpt4all.install()
+    from gpt4all import GPT4All
+
+    started = time.perf_counter()
+    model = GPT4All(config["model_name"], model_path=config["model_dir"], device="cpu",
+                    n_threads=config["n_threads"], n_ctx=config["n_ctx"], allow_download=False)
+    result = {
+        "n_threads": config["n_threads"],
+        "n_ctx": config["n_ctx"],
+        "load_seconds": round(time.perf_counter() - started, 3),
+        "rss_after_load_mb": peak_rss_mb(),
+        "runs": [],
+    }
+    # Untimed warm-up: the first generation after a load pays one-off costs
+    model.generate(make_prompt(16), max_tokens=4, temp=0.0)
+
+    for n_batch in config["batches"]:
+        for prompt_tokens in config["prompt_sizes"]:
+            if prompt_tokens + config["gen_tokens"] + CONTEXT_HEADROOM > config["n_ctx"]:
+                continue
+            prompt = make_prompt(prompt_tokens)
+            samples = [time_generation(model, prompt, n_batch, config["gen_tokens"])
+                       for _ in range(config["repeats"])]
+            result["runs"].append({
+                "n_batch": n_batch,
+                "prompt_tokens": estimate_tokens(prompt),
+                "prompt_tps": median([s["prompt_tps"] for s in samples]),
+                "gen_tps": median([s["gen_tps"] for s in samples]),
+                "first_token_seconds": median([s["first_token_seconds"] for s in samples]),
+            })
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def time_generation(model, prompt: str, n_batch: int, gen_tokens: int) -> Dict:
+    """Prompt speed from the time to the first token, generation speed from the rest."""
+    prompt_tokens = estimate_tokens(prompt)
+    started = time.perf_counter()
+    first, count = None, 0
+    for _ in model.generate(prompt, max_tokens=gen_tokens, temp=0.0, n_batch=n_batch, streaming=True):
+        if first is None:
+            first = time.perf_counter()
+        count += 1
+    finished = time.perf_counter()
+    first = first or finished
+    return {
+        "first_token_seconds": first - started,
+        "prompt_tps": prompt_tokens / max(first - started, 1e-9),
+        "gen_tps": (count - 1) / (finished - first) if count > 1 and finished > first else None,
+    }
+
+
+def median(values: List[Optional[float]]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 3) if values else None
+
+
+# Driver
+
+def run_worker(config: Dict) -> Optional[Dict]:
+    label = f"threads={config['n_threads']} n_ctx={config['n_ctx']} batches={config['batches']}"
+    print(f"Measuring {label} ...", flush=True)
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+        result_path = tmp.name
+    try:
+        process = subprocess.run(
+            [sys.executable, __file__, "measure", json.dumps(config), result_path],
+            capture_output=True, text=True,
+        )
+        if process.returncode != 0:
+            print(f"  failed ({label}):\n" + "\n".join(process.stdout.splitlines()[-5:]
+                                                       + process.stderr.splitlines()[-10:]))
+            return None
+        with open(result_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def request_seconds(run: Dict, ref_prompt: int, ref_output: int) -> Optional[float]:
+    """Estimated time of the reference request at a run's measured speeds."""
+    if not run["prompt_tps"] or not run["gen_tps"]:
+        return None
+    return ref_prompt / run["prompt_tps"] + ref_output / run["gen_tps"]
+
+
+def best_run(result: Optional[Dict], args, n_batch: Optional[int] = None):
+    """The run closest to the reference prompt size, with its estimated request time."""
+    if not result:
+        return None, None
+    runs = [r for r in result["runs"] if n_batch is None or r["n_batch"] == n_batch]
+    if not runs:
+        return None, None
+    run = min(runs, key=lambda r: abs(r["prompt_tokens"] - args.ref_prompt))
+    return run, request_seconds(run, args.ref_prompt, args.ref_output)
+
+
+def print_runs(result: Dict):
+    for run in result["runs"]:
+        print(f"  batch {run['n_batch']:>4}  prompt {run['prompt_tokens']:>5} tok  "
+              f"pp {run['prompt_tps'] or 0:>8.1f} tok/s  gen {run['gen_tps'] or 0:>7.2f} tok/s  "
+              f"first token {run['first_token_seconds'] or 0:.2f}s")
+    print(f"  load {result['load_seconds']}s, peak RSS {result['peak_rss_mb']} MB")
+
+
+def sweep(args) -> int:
+    model_dir = args.model_dir
+    # Like AIService: the first .gguf the directory lists
+    model_files = [f for f in os.listdir(model_dir) if f.endswith(".gguf")] if os.path.isdir(model_dir) else []
+    if args.model:
+        model_name = args.model
+    elif model_files:
+        model_name = model_files[0]
+    else:
+        print(f"No .gguf model found in {model_dir}")
+        return 1
+
+    base = {
+        "model_dir": model_dir, "model_name": model_name, "gen_tokens": args.gen_tokens,
+        "repeats": args.repeats, "stub": args.stub,
+    }
+    base_ctx = max(args.contexts[0], args.ref_prompt + args.ref_output + CONTEXT_HEADROOM)
+    mid_batch = sorted(args.batches)[len(args.batches) // 2]
+    measurements: Dict[str, List[Dict]] = {"threads": [], "batches": [], "contexts": []}
+
+    print(f"Model {model_name}; stage 1: threads {args.threads}")
+    scored = []
+    for threads in args.threads:
+        result = run_worker(dict(base, n_threads=threads, n_ctx=base_ctx, batches=[mid_batch],
+                                 prompt_sizes=[args.ref_prompt]))
+        run, seconds = best_run(result, args)
+        if result:
+            print_runs(result)
+            measurements["threads"].append(result)
+        if seconds is not None:
+            scored.append((seconds, threads))
+    if not scored:
+        print("No configuration could be measured")
+        return 1
+    best_threads = min(scored)[1]
+
+    print(f"Stage 2: n_batch {args.batches} with {best_threads} threads")
+    result = run_worker(dict(base, n_threads=best_threads, n_ctx=base_ctx, batches=args.batches,
+                             prompt_sizes=args.prompt_sizes))
+    best_batch = mid_batch
+    if result:
+        print_runs(result)
+        measurements["batches"].append(result)
+        scored = [(best_run(result, args, n_batch)[1], n_batch) for n_batch in args.batches]
+        scored = [(seconds, n_batch) for seconds, n_batch in scored if seconds is not None]
+        if scored:
+            best_batch = min(scored)[1]
+
+    print(f"Stage 3: n_ctx {args.contexts} with {best_threads} threads, batch {best_batch}")
+    candidates = []
+    for n_ctx in args.contexts:
+        if n_ctx < args.ref_prompt + args.ref_output + CONTEXT_HEADROOM:
+            print(f"  skipping n_ctx={n_ctx}: smaller than the reference request")
+            continue
+        result = run_worker(dict(base, n_threads=best_threads, n_ctx=n_ctx, batches=[best_batch],
+                                 prompt_sizes=[args.ref_prompt]))
+        _, seconds = best_run(result, args)
+        if result:
+            print_runs(result)
+            measurements["contexts"].append(result)
+        if seconds is not None:
+            candidates.append((n_ctx, seconds, result["peak_rss_mb"]))
+    fastest = min((seconds for _, seconds, _ in candidates), default=None)
+    fitting = [n_ctx for n_ctx, seconds, rss in candidates
+               if seconds <= fastest * (1 + args.tolerance)
+               and (rss is None or args.max_memory_mb is None or rss <= args.max_memory_mb)]
+    best_ctx = max(fitting) if fitting else base_ctx
+
+    settings = {"device": "cpu", "n_threads": best_threads, "n_batch": best_batch, "n_ctx": best_ctx}
+    print(f"\nRecommended: {settings}")
+    if args.dry_run:
+        return 0
+    path = args.output or profile_path(model_dir)
+    measurements["reference_request"] = {"prompt_tokens": args.ref_prompt, "output_tokens": args.ref_output}
+    save_profile(path, model_name, settings, measurements)
+    print(f"Wrote {path}; AIService uses it on next start (CSVAI_* env vars override it)")
+    return 0
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "measure":
+        with open(sys.argv[3], "w", encoding="utf-8") as f:
+            json.dump(measure(json.loads(sys.argv[2])), f)
+        return
+
+    memory = total_memory_mb()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model-dir", default=default_model_dir())
+    parser.add_argument("--model", help="model file name (default: the one AIService would load)")
+    parser.add_argument("--threads", type=int, nargs="+", default=default_threads())
+    parser.add_argument("--batches", type=int, nargs="+", default=[8, 32, 128, 512])
+    parser.add_argument("--contexts", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--prompt-sizes", type=int, nargs="+", default=[128, 512])
+    parser.add_argument("--gen-tokens", type=int, default=32, help="tokens generated per measurement")
+    parser.add_argument("--repeats", type=int, default=2, help="measurements per setting (median is kept)")
+    parser.add_argument("--ref-prompt", type=int, default=512, help="reference request prompt tokens")
+    parser.add_argument("--ref-output", type=int, default=200, help="reference request output tokens")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown accepted for a larger n_ctx")
+    parser.add_argument("--max-memory-mb", type=float, default=round(memory * 0.8) if memory else None,
+                        help="peak memory allowed for one model instance (default 80%% of RAM)")
+    parser.add_argument("--output", help="profile path (default: tuning_profile.json in the model dir)")
+    parser.add_argument("--dry-run", action="store_true", help="measure and print without writing a profile")
+    parser.add_argument("--stub", action="store_true",
+                        help="use tools/fake_gpt4all.py instead of gpt4all (to try the tool itself)")
+    args = parser.parse_args()
+    args.contexts = sorted(args.contexts)
+    args.prompt_sizes = sorted(set(args.prompt_sizes + [args.ref_prompt]))
+    sys.exit(sweep(args))
+
+
+if __name__ == "__main__":
+    main()